@@ -0,0 +1,589 @@
+'''
+Background acquisition for the Lakeshore Model372 scripts.
+
+The sampler polls the instrument on its own thread using a fixed monotonic
+schedule, so a slow matplotlib redraw can no longer push back the next
+data point. Every reading is timestamped and handed out through queues;
+the plotting and CSV code only ever consume from those queues.
+
+By default all channels, the heater output and the setpoint are read with a
+single compound query (see BatchReader), one round trip per sample no matter
+how many channels are configured.
+
+With a scanner, only one measurement input is live at a time; ScannerScheduler
+then decides when to switch, waits out each channel's pause time and marks
+every reading as fresh or stale.
+
+A read that fails (link drop, timeout, garbled answer) does not stop the
+sampler: it publishes a gap marker, a Sample whose readings are all NaN, and
+keeps to its schedule. ResilientInstrument reconnects the Ethernet link
+with a bounded exponential backoff in between, so the plot shows a break,
+the CSV has a row of 'nan' and acquisition picks up by itself.
+
+Instead of one fixed interval, an AdaptiveRate can set it sample by sample:
+fast while the temperature moves or right after a step starts, slow on a
+plateau.
+'''
+import collections
+import queue
+import threading
+import time
+
+try:
+    from lakeshore.generic_instrument import InstrumentException
+    #The lakeshore package reports socket timeouts as InstrumentException
+    LINK_ERRORS = (OSError, EOFError, InstrumentException)
+except ImportError:
+    LINK_ERRORS = (OSError, EOFError)
+
+
+# One reading of every configured channel
+#   timestamp     : epoch seconds (time.time()) when the reading was taken
+#   monotonic     : time.monotonic() at the same moment, used for jitter/scheduling
+#   readings      : list of Kelvin values in the same order as 'channels'
+#   heater_output : sample heater output in percent (None if not read)
+#   setpoint      : control setpoint in Kelvin (None if not read)
+#   latency       : seconds the instrument exchange for this sample took
+#   fresh         : list of bools per channel, False where the value is the last known
+#                   reading of a channel the scanner is not on (None = all fresh)
+#   loop          : index of the loop/step the script was running (None outside of one)
+Sample = collections.namedtuple('Sample', ['timestamp', 'monotonic', 'readings',
+                                           'heater_output', 'setpoint', 'latency', 'fresh', 'loop'],
+                                defaults = (None, None, None, None, None))
+
+
+def gap_sample(n_channels, timestamp = None, monotonic = None, latency = None, loop = None):
+    #Marks a sample that could not be read: every reading is NaN
+    return Sample(time.time() if timestamp is None else timestamp,
+                  time.monotonic() if monotonic is None else monotonic,
+                  [float('nan')] * n_channels, None, None, latency, None, loop)
+
+
+def is_gap(sample):
+    return all(value != value for value in sample.readings)
+
+
+# Lakeshore instruments accept several queries in one message separated by ';'
+# and answer them in order, also separated by ';'. Longer batches are split
+# into several messages so the instrument's input buffer is never exceeded.
+MAX_MESSAGE_LENGTH = 128
+
+
+class LockedInstrument:
+    '''Wraps a Model372 so every call holds one lock.
+
+    The sampler thread and the loop code (set_heater_pid, set_setpoint_kelvin...)
+    share the same connection, so their request/response pairs must never interleave.
+    '''
+
+    def __init__(self, instrument):
+        self.instrument = instrument
+        self.lock = threading.RLock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.instrument, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with self.lock:
+                return attr(*args, **kwargs)
+        return call
+
+
+class ConnectionLost(ConnectionError):
+    '''Raised by ResilientInstrument while the Lakeshore cannot be reached.'''
+
+
+class ResilientInstrument(LockedInstrument):
+    '''A LockedInstrument that survives the Ethernet link dropping.
+
+    A call failing with one of LINK_ERRORS (timeout, reset, refused) marks
+    the connection as lost and raises ConnectionLost. The next call after the
+    backoff delay first reconnects with 'reconnect()'; until then calls raise
+    ConnectionLost straight away, so nobody waits on a dead socket for more
+    than one timeout. The delay doubles with every failed reconnect, from
+    'backoff' up to 'max_backoff' seconds.
+
+    By default a Model372 connected over TCP is reconnected to the same
+    address with the same timeout; a simulator or serial instrument only has
+    its calls retried after the delay.
+    '''
+
+    def __init__(self, instrument, reconnect = None, backoff = 1.0, max_backoff = 60.0):
+        LockedInstrument.__init__(self, instrument)
+        self.reconnect = reconnect if reconnect is not None else self._default_reconnect()
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.connected = True
+        self.failures = 0               #Failed calls since the last one that worked
+        self.disconnects = 0
+        self.reconnects = 0
+        self.retry_at = None            #Monotonic time of the next reconnect attempt
+
+    def _default_reconnect(self):
+        device_tcp = getattr(self.instrument, 'device_tcp', None)
+        if device_tcp is None:
+            return lambda: None
+        address = device_tcp.getpeername()[:2]
+        timeout = device_tcp.gettimeout()
+
+        def reconnect():
+            if self.instrument.device_tcp is not None:
+                try:
+                    self.instrument.disconnect_tcp()
+                except OSError:
+                    pass
+            self.instrument.connect_tcp(address[0], address[1], timeout)
+        return reconnect
+
+    def _lost(self, ex):
+        if self.failures == 0:
+            self.disconnects += 1
+            print('Lakeshore connection lost:', repr(ex))
+        self.connected = False
+        self.failures += 1
+        delay = min(self.max_backoff, self.backoff * 2 ** (self.failures - 1))
+        self.retry_at = time.monotonic() + delay
+        return ConnectionLost(str('Lakeshore unreachable, retrying in ' + str(round(delay, 1)) + ' s'))
+
+    def _ensure_connected(self):
+        #Called with the lock held
+        if self.connected:
+            return
+        if time.monotonic() < self.retry_at:
+            raise ConnectionLost('Lakeshore unreachable, waiting to reconnect')
+        try:
+            self.reconnect()
+        except LINK_ERRORS as ex:
+            raise self._lost(ex) from ex
+        self.connected = True
+
+    def __getattr__(self, name):
+        attr = getattr(self.instrument, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with self.lock:
+                self._ensure_connected()
+                try:
+                    result = attr(*args, **kwargs)
+                except LINK_ERRORS as ex:
+                    raise self._lost(ex) from ex
+                if self.failures > 0:
+                    #Only counts as back once a call has gone through
+                    self.failures = 0
+                    self.reconnects += 1
+                    print('Lakeshore reconnected')
+                return result
+        return call
+
+
+class BatchReader:
+    '''Reads every channel, plus heater output and setpoint, in one exchange.
+
+    The query string is built once. SETP? answers in the control input's
+    preferred units, which set_setpoint_kelvin() leaves in Kelvin.
+    '''
+
+    def __init__(self, instrument, channels, heater_output = 0, read_heater = True,
+                 max_message_length = MAX_MESSAGE_LENGTH):
+        self.instrument = instrument
+        self.channels = list(channels)
+        self.read_heater = read_heater
+
+        queries = [str('KRDG? ' + str(channel)) for channel in self.channels]
+        if read_heater:
+            queries.append(str('HTR? ' + str(heater_output)))
+            queries.append(str('SETP? ' + str(heater_output)))
+
+        #Group the queries into as few messages as the length limit allows
+        self.messages = []
+        for q in queries:
+            if len(self.messages) > 0 and len(self.messages[-1]) + 1 + len(q) <= max_message_length:
+                self.messages[-1] = self.messages[-1] + ';' + q
+            else:
+                self.messages.append(q)
+        self.n_values = len(queries)
+
+    def read(self):
+        #Returns (readings, heater_output, setpoint)
+        return self.parse([self.instrument.query(message) for message in self.messages])
+
+    def parse(self, responses):
+        #Turn the responses to self.messages (in order) into (readings, heater_output, setpoint)
+        values = []
+        for response in responses:
+            values.extend(float(value) for value in response.split(';'))
+
+        if len(values) != self.n_values:
+            raise ValueError(str('Expected ' + str(self.n_values) + ' values from the Lakeshore, got ' +
+                                 str(len(values))))
+
+        readings = values[:len(self.channels)]
+        if self.read_heater:
+            return readings, values[-2], values[-1]
+        return readings, None, None
+
+
+class ScannerScheduler:
+    '''Reads channels behind the Model372 scanner one at a time, only once settled.
+
+    After a switch (SCAN <channel>,0) a channel is not valid until its pause
+    time has passed; it is then read every 'interval' seconds until its dwell
+    time is over and the scanner moves on to the next channel in order.
+    The first channel is whichever one the scanner is already on, and with a
+    single scanned channel there is never a switch. Channel 'A' (control input)
+    is not on the scanner and is read fresh with every sample.
+
+    dwell / pause are dicts {channel: seconds}; channels missing from them use
+    the values configured on the instrument (INSET?). A dwell of 0 takes a
+    single reading per visit, which gives the highest possible cycle rate.
+    '''
+
+    def __init__(self, instrument, channels, dwell = None, pause = None, heater_output = 0):
+        self.instrument = instrument
+        self.channels = list(channels)
+        self.scanned = [channel for channel in self.channels if str(channel).upper() != 'A']
+        unscanned = [channel for channel in self.channels if channel not in self.scanned]
+        dwell = dwell or {}
+        pause = pause or {}
+
+        self.dwell = {}
+        self.pause = {}
+        for channel in self.scanned:
+            if channel not in dwell or channel not in pause:
+                settings = instrument.get_input_channel_parameters(channel)
+                self.dwell[channel] = dwell.get(channel, settings.dwell_time)
+                self.pause[channel] = pause.get(channel, settings.pause_time)
+            else:
+                self.dwell[channel] = dwell[channel]
+                self.pause[channel] = pause[channel]
+
+        #One compound query per active channel: that channel + the unscanned ones + heater
+        self.readers = {}
+        for channel in (self.scanned or [None]):
+            read_channels = ([channel] if channel is not None else []) + unscanned
+            self.readers[channel] = (read_channels, BatchReader(instrument, read_channels, heater_output))
+
+        self.last = [float('nan') for channel in self.channels]
+        self.active = None
+        self.next_read = None
+        self.leave_at = None
+        self.switches = 0
+
+    def _switch(self, channel, now):
+        self.instrument.set_scanner_status(channel, False)
+        self.switches += 1
+        self.active = channel
+        self.next_read = now + self.pause[channel]
+        self.leave_at = self.next_read + self.dwell[channel]
+
+    def start(self, now):
+        if len(self.scanned) == 0:
+            self.next_read = now
+            return
+        status = self.instrument.get_scanner_status()
+        if status['input_channel'] in self.scanned and not status['status']:
+            #Already parked on one of our channels, no switch (and no pause) needed
+            self.active = status['input_channel']
+            self.next_read = now
+            self.leave_at = now + self.dwell[self.active]
+        else:
+            self._switch(self.scanned[0], now)
+
+    def read(self):
+        #Returns (readings, heater_output, setpoint, fresh) for all channels
+        read_channels, reader = self.readers[self.active]
+        values, heater_output, setpoint = reader.read()
+        for channel, value in zip(read_channels, values):
+            self.last[self.channels.index(channel)] = value
+        fresh = [channel in read_channels for channel in self.channels]
+        return list(self.last), heater_output, setpoint, fresh
+
+    def advance(self, now, interval):
+        #Called after each reading, schedules the next one (switching if the dwell is over)
+        if len(self.scanned) > 1 and now >= self.leave_at:
+            position = self.scanned.index(self.active)
+            self._switch(self.scanned[(position + 1) % len(self.scanned)], now)
+        else:
+            self.next_read = now + interval
+
+
+class Publisher:
+    '''Fans every published item out to any number of subscriber queues.'''
+
+    def __init__(self):
+        self._subscribers = []
+        self._subscribers_lock = threading.Lock()
+
+    def subscribe(self, maxsize = 0):
+        #Every subscriber gets its own queue, so the plot and the CSV writer
+        #can consume at their own pace without stealing samples from each other
+        q = queue.Queue(maxsize)
+        with self._subscribers_lock:
+            self._subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._subscribers_lock:
+            if q in self._subscribers:
+                self._subscribers.remove(q)
+
+    def publish(self, item):
+        with self._subscribers_lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(item)
+            except queue.Full:
+                #A bounded subscriber (e.g. a viewer) that fell behind loses its
+                #oldest sample rather than stalling acquisition
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+                q.put_nowait(item)
+
+
+class AdaptiveRate:
+    '''Sampling interval between 'fastest' and 'slowest' seconds, following the temperature.
+
+    The interval is chosen so a reading moves by about 'resolution' (a
+    fraction of the reading, 1e-3 = 0.1 %) from one sample to the next. The
+    rate of change is the larger of the last step between two samples and
+    the average over the last 'window' seconds, so noise below the
+    resolution never speeds sampling up but a steady drift does. For 'burst'
+    seconds after a step starts (a new loop) or the setpoint changes, samples
+    are taken every 'fastest' seconds. The interval shortens at once and
+    grows by at most 'growth' per sample, so a plateau is approached
+    gradually. Gaps and stale scanner readings are ignored.
+    '''
+
+    def __init__(self, fastest, slowest, resolution = 1e-3, window = 60.0, burst = 120.0, growth = 1.25):
+        assert(0 < fastest <= slowest), "'fastest' must be positive and at most 'slowest'"
+        self.fastest = fastest
+        self.slowest = slowest
+        self.resolution = resolution
+        self.window = window
+        self.burst = burst
+        self.growth = growth
+        self.interval = fastest
+        self.fast_until = None          #Monotonic time the current burst ends
+        self.history = collections.deque()
+        self._loop = None
+        self._setpoint = None
+
+    def hurry(self, now):
+        #Sample at the fastest rate for 'burst' seconds from 'now'
+        self.fast_until = now + self.burst
+        self.interval = self.fastest
+
+    def _target(self, sample):
+        #Interval that keeps the change per sample near 'resolution'
+        target = self.slowest
+        oldest_time, oldest = self.history[0]
+        last_time, last = self.history[-2] if len(self.history) > 1 else self.history[0]
+        for k, value in enumerate(sample.readings):
+            if value != value or (sample.fresh is not None and not sample.fresh[k]):
+                continue
+            step = self.resolution * abs(value)
+            for time_then, then in ((oldest_time, oldest), (last_time, last)):
+                dt = sample.monotonic - time_then
+                if dt > 0 and then[k] == then[k] and abs(value - then[k]) > 0:
+                    target = min(target, step * dt / abs(value - then[k]))
+        return target
+
+    def update(self, sample):
+        '''Takes the latest Sample, returns the interval until the next one.'''
+        now = sample.monotonic
+        if self.fast_until is None or sample.loop != self._loop or \
+                (sample.setpoint is not None and self._setpoint is not None and sample.setpoint != self._setpoint):
+            self.hurry(now)             #First sample, new step or new setpoint
+        self._loop = sample.loop
+        if sample.setpoint is not None:
+            self._setpoint = sample.setpoint
+        if is_gap(sample):
+            return self.interval
+
+        self.history.append((now, list(sample.readings)))
+        while len(self.history) > 2 and now - self.history[0][0] > self.window:
+            self.history.popleft()
+        if now < self.fast_until:
+            target = self.fastest
+        else:
+            target = min(max(self._target(sample), self.fastest), self.slowest)
+        self.interval = target if target < self.interval else min(target, self.interval * self.growth)
+        return self.interval
+
+
+class Sampler(Publisher, threading.Thread):
+    '''Reads 'channels' every 'interval' seconds and publishes Sample tuples.
+
+    Ticks are scheduled against time.monotonic(), not "interval after the last
+    reading finished", so there is no drift over long runs. If a reading takes
+    longer than 'interval', the missed ticks are skipped instead of bursting.
+
+    With batched = True one BatchReader exchange is made per sample, otherwise
+    get_kelvin_reading() is called once per channel as the scripts used to do.
+    Given a ScannerScheduler, the scanner decides when readings are taken instead
+    of the fixed schedule ('interval' is then the spacing during a dwell).
+
+    A failed read publishes a gap_sample() in place of the reading and is
+    counted in 'gaps'; the schedule carries on as if it had succeeded.
+
+    Given an AdaptiveRate ('rate'), every sample sets 'interval' for the next
+    one and hurry() takes a sample right away and starts a burst (the
+    ScheduleRunner calls it when it applies a step). It has no effect with a
+    scanner, whose timing is set by the dwell and pause times.
+    '''
+
+    def __init__(self, instrument, channels, interval, batched = True, heater_output = 0,
+                 scanner = None, metrics = None, rate = None):
+        threading.Thread.__init__(self, daemon = True)
+        Publisher.__init__(self)
+        self.instrument = instrument
+        self.channels = list(channels)
+        self.interval = interval
+        self.batch = BatchReader(instrument, self.channels, heater_output) if batched else None
+        self.scanner = scanner
+        self.metrics = metrics          #Optional Metrics (see Lakeshore_Metrics), read time and tick lateness
+        self.rate = rate
+        self.loop = None                #Set by the script at every new loop, stamped on each Sample
+        self.samples_taken = 0
+        self.ticks_missed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.gaps = 0
+        self.failing = False            #True from a failed read until the next good one
+        self._stop_event = threading.Event()
+        self._wake = threading.Event()  #Set by hurry() and stop() to end the wait for the next tick
+
+    def read(self):
+        #Returns (readings, heater_output, setpoint)
+        if self.batch is not None:
+            return self.batch.read()
+        return [self.instrument.get_kelvin_reading(channel) for channel in self.channels], None, None
+
+    @property
+    def mean_latency(self):
+        if self.samples_taken == 0:
+            return 0.0
+        return self.total_latency / self.samples_taken
+
+    def take_sample(self, due = None):
+        #'due' is the monotonic time the sample was scheduled for
+        timestamp = time.time()
+        monotonic = time.monotonic()
+        try:
+            if self.scanner is not None:
+                readings, heater_output, setpoint, fresh = self.scanner.read()
+            else:
+                readings, heater_output, setpoint = self.read()
+                fresh = None
+        except Exception as ex:
+            self.publish_gap(ex, timestamp, monotonic)
+            return
+        latency = time.monotonic() - monotonic
+        if self.failing:
+            print('Lakeshore readings back after', self.gaps, 'gap samples in total')
+            self.failing = False
+
+        self.samples_taken += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        if self.metrics is not None:
+            self.metrics.observe('instrument_read', latency)
+            if due is not None:
+                self.metrics.observe('sample_lateness', max(0.0, monotonic - due))
+        sample = Sample(timestamp, monotonic, readings, heater_output, setpoint, latency, fresh, self.loop)
+        if self.rate is not None and self.scanner is None:
+            self.interval = self.rate.update(sample)
+        self.publish(sample)
+
+    def publish_gap(self, ex, timestamp, monotonic):
+        #Publishes a gap_sample() for a failed read (or scanner switch) started at 'monotonic'
+        self.gaps += 1
+        if not self.failing:
+            print('Lakeshore read failed, logging a gap until it recovers:', repr(ex))
+            self.failing = True
+        sample = gap_sample(len(self.channels), timestamp, monotonic, time.monotonic() - monotonic, self.loop)
+        if self.rate is not None and self.scanner is None:
+            self.interval = self.rate.update(sample)
+        self.publish(sample)
+
+    def hurry(self):
+        #With an AdaptiveRate: sample now and keep sampling fast for a while (e.g. a step was just applied)
+        if self.rate is None or self.scanner is not None:
+            return
+        self.rate.hurry(time.monotonic())
+        self._wake.set()
+
+    def run(self):
+        if self.scanner is not None:
+            self._run_scanned()
+            return
+
+        next_tick = time.monotonic()
+        while not self._stop_event.is_set():
+            self.take_sample(next_tick)
+
+            next_tick += self.interval
+            now = time.monotonic()
+            if now > next_tick:
+                missed = int((now - next_tick) // self.interval) + 1
+                self.ticks_missed += missed
+                next_tick += missed * self.interval
+            if self._wake.wait(next_tick - now):
+                self._wake.clear()
+                next_tick = time.monotonic()
+
+    def _run_scanned(self):
+        #A scanner query or switch that fails (e.g. ConnectionLost) is logged as a gap
+        #like a failed read and retried at the next tick, the thread keeps going
+        while not self._stop_event.is_set():
+            timestamp = time.time()
+            monotonic = time.monotonic()
+            try:
+                self.scanner.start(monotonic)
+                break
+            except Exception as ex:
+                self.publish_gap(ex, timestamp, monotonic)
+            self._stop_event.wait(self.interval)
+
+        while not self._stop_event.is_set():
+            delay = self.scanner.next_read - time.monotonic()
+            if delay > 0 and self._stop_event.wait(delay):
+                break
+            gaps = self.gaps
+            self.take_sample(self.scanner.next_read)
+            timestamp = time.time()
+            monotonic = time.monotonic()
+            try:
+                self.scanner.advance(monotonic, self.interval)
+            except Exception as ex:
+                #Still on the old channel, advance() switches again once next_read comes round
+                self.scanner.next_read = monotonic + self.interval
+                if self.gaps == gaps:
+                    self.publish_gap(ex, timestamp, monotonic)
+
+    def stop(self, timeout = None):
+        self._stop_event.set()
+        self._wake.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    @property
+    def stopped(self):
+        return self._stop_event.is_set()
+
+
+def drain(q):
+    #Return everything currently waiting in q without blocking
+    items = []
+    while True:
+        try:
+            items.append(q.get_nowait())
+        except queue.Empty:
+            return items
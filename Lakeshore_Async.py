@@ -0,0 +1,194 @@
+'''
+Asyncio client for driving several Model372 controllers from one process.
+
+AsyncModel372 speaks the same Ethernet protocol as the lakeshore package
+(TCP port 7777, one '\n' terminated message, '\r\n' terminated response) but
+never blocks, so one event loop can keep a request in flight to every
+controller at once. MultiSampler runs that loop on a background thread and
+publishes ControllerSample tuples through the same subscribe()/drain()
+queues as the single-controller Sampler, so one plot and one CSV pipeline
+serve every fridge. subscribe(controller = name) gives a queue of plain
+Samples from one fridge, for the writers and dashboard made for Sampler.
+'''
+import asyncio
+import collections
+import threading
+import time
+from Lakeshore_Acquisition import BatchReader, Publisher, Sample, gap_sample
+
+
+# One fridge: a name for plots/files, where to reach its Model372 and what to read
+ControllerConfig = collections.namedtuple('ControllerConfig', ['name', 'ip_address', 'channels', 'tcp_port'],
+                                          defaults = (7777,))
+
+# A Sample (see Lakeshore_Acquisition) tagged with the name of the controller it came from
+ControllerSample = collections.namedtuple('ControllerSample', ['controller', 'sample'])
+
+
+class AsyncModel372:
+
+    def __init__(self, ip_address, tcp_port = 7777, timeout = 2.0):
+        self.ip_address = ip_address
+        self.tcp_port = tcp_port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()      #One exchange at a time per connection
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.ip_address, self.tcp_port), self.timeout)
+
+        #Same as the lakeshore package: send a line break and throw away anything
+        #left over from a previous session
+        self.writer.write(b'\n')
+        await self.writer.drain()
+        await asyncio.sleep(0.1)
+        while True:
+            try:
+                leftover = await asyncio.wait_for(self.reader.read(4096), 0.01)
+            except asyncio.TimeoutError:
+                break
+            if not leftover:
+                break
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.reader = None
+            self.writer = None
+
+    async def command(self, command_string):
+        async with self.lock:
+            self.writer.write(command_string.encode('utf-8') + b'\n')
+            await self.writer.drain()
+
+    async def query(self, query_string):
+        async with self.lock:
+            self.writer.write(query_string.encode('utf-8') + b'\n')
+            await self.writer.drain()
+            response = await asyncio.wait_for(self.reader.readuntil(b'\r\n'), self.timeout)
+        return response.decode('utf-8').rstrip()
+
+    async def get_kelvin_reading(self, input_channel):
+        return float(await self.query(str('KRDG? ' + str(input_channel))))
+
+
+class MultiSampler(Publisher, threading.Thread):
+    '''Samples every controller every 'interval' seconds on one asyncio loop.
+
+    Each controller has its own task and its own monotonic schedule, so a slow
+    or unreachable fridge never delays the others. A controller whose link
+    fails gets a gap sample (all readings NaN) and is reconnected after a
+    delay doubling from 'backoff' up to 'max_backoff' seconds; its last error
+    is kept in 'errors' and the other controllers keep running meanwhile.
+
+    subscribe() queues get every ControllerSample; subscribe(controller = name)
+    queues only that controller's Samples, e.g. for its CSVWriter.
+    '''
+
+    def __init__(self, controllers, interval, heater_output = 0, timeout = 2.0, backoff = 1.0, max_backoff = 60.0):
+        threading.Thread.__init__(self, daemon = True)
+        Publisher.__init__(self)
+        self.controllers = list(controllers)
+        self.interval = interval
+        self.heater_output = heater_output
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.samples_taken = collections.Counter()
+        self.reconnects = collections.Counter()
+        self.failures = collections.Counter()     #Failed attempts in a row, per controller
+        self.errors = {}
+        self.outputs = {config.name: Publisher() for config in self.controllers}   #Per controller subscribers
+        self.loop = None
+        self._stop_event = None
+        self._started = threading.Event()
+
+    async def poll(self, config):
+        client = AsyncModel372(config.ip_address, config.tcp_port, self.timeout)
+        batch = BatchReader(None, config.channels, self.heater_output)
+        await client.connect()
+        try:
+            next_tick = time.monotonic()
+            while not self._stop_event.is_set():
+                timestamp = time.time()
+                monotonic = time.monotonic()
+                responses = []
+                for message in batch.messages:
+                    responses.append(await client.query(message))
+                readings, heater_output, setpoint = batch.parse(responses)
+                latency = time.monotonic() - monotonic
+
+                self.samples_taken[config.name] += 1
+                self.failures[config.name] = 0
+                self.publish_sample(config.name, Sample(timestamp, monotonic, readings, heater_output, setpoint, latency))
+
+                next_tick += self.interval
+                now = time.monotonic()
+                if now > next_tick:
+                    next_tick += (int((now - next_tick) // self.interval) + 1) * self.interval
+                try:
+                    await asyncio.wait_for(self._stop_event.wait(), next_tick - now)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await client.close()
+
+    def subscribe(self, maxsize = 0, controller = None):
+        if controller is None:
+            return Publisher.subscribe(self, maxsize)
+        return self.outputs[controller].subscribe(maxsize)
+
+    def unsubscribe(self, q):
+        Publisher.unsubscribe(self, q)
+        for output in self.outputs.values():
+            output.unsubscribe(q)
+
+    def publish_sample(self, controller, sample):
+        self.publish(ControllerSample(controller, sample))
+        self.outputs[controller].publish(sample)
+
+    async def main(self):
+        self._stop_event = asyncio.Event()
+        self._started.set()
+        await asyncio.gather(*[self.guarded_poll(config) for config in self.controllers])
+
+    async def guarded_poll(self, config):
+        #poll() until stopped, reconnecting with backoff whenever it fails
+        while not self._stop_event.is_set():
+            try:
+                await self.poll(config)
+            except Exception as ex:
+                self.errors[config.name] = ex
+                self.failures[config.name] += 1
+                delay = min(self.max_backoff, self.backoff * 2 ** (self.failures[config.name] - 1))
+                print('Controller', config.name, 'lost:', repr(ex), '- reconnecting in', delay, 's')
+                self.publish_sample(config.name, gap_sample(len(config.channels)))
+                try:
+                    await asyncio.wait_for(self._stop_event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                if not self._stop_event.is_set():
+                    self.reconnects[config.name] += 1
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.main())
+        finally:
+            self.loop.close()
+
+    def stop(self, timeout = None):
+        self._started.wait(timeout)
+        if self.loop is not None and self._stop_event is not None and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(self._stop_event.set)
+            except RuntimeError:
+                pass        #Loop already finished
+        if self.is_alive():
+            self.join(timeout)
@@ -0,0 +1,292 @@
+'''
+PID autotuning for the Model372 sample heater from open-loop step responses.
+
+The experiment is an ordinary open-loop schedule (see Lakeshore_Schedule):
+a staircase of manual heater outputs, each held until the stage has settled
+or 'max_minutes' have passed. Every stair is a step response around a
+different temperature, so one run gives a plant model per temperature band.
+
+For each stair a first-order-plus-dead-time model
+
+    T(t) = T0 + K du (1 - exp(-(t - theta) / tau))        (t > theta)
+
+is fitted to the logged readings. Every (theta, tau) pair of a grid is
+evaluated at once with NumPy; the gain K of each pair has a closed form, so
+the whole fit is one vectorized least-squares pass, no iterative solver.
+PID settings come from the SIMC rules (Skogestad) for a closed-loop time
+constant 'tau_c', and the heater range is chosen so the output the band
+needs sits between 20 and 70 % of it.
+
+PID values use the instrument's form as modelled in Lakeshore_Simulator:
+P is percent output per fractional error (error / setpoint), I and D are in
+seconds. The suggestions are saved as a GainTable (JSON); give one to V3 as
+'gain_table_file' and each step uses the P, I, D and heater range of the
+band its setpoint falls in.
+
+    python Lakeshore_Autotune.py --outputs 5 10 20 40 --heater-range 3 [--channel 6] [--simulate]
+    python Lakeshore_Autotune.py --from-data 'Lakeshore Data/Autotune(10-18-26)_1'     (refit a saved run)
+'''
+import argparse
+import collections
+import datetime as dt
+import json
+import math
+import sys
+import types
+import numpy as np
+from Lakeshore_Simulator import HEATER_RANGES
+
+
+# K: kelvin per percent of output (at the range it was measured on), tau / theta: seconds,
+# rms: fit residual (K)
+FOPDT = collections.namedtuple('FOPDT', ['gain', 'tau', 'theta', 'rms'])
+
+# Limits of the Model372 PID settings
+P_RANGE = (0.001, 1000.0)
+I_RANGE = (0.0, 10000.0)
+D_RANGE = (0.0, 2500.0)
+
+
+def bin_average(t, y, points):
+    #At most 'points' (t, y) pairs, averaging equal-count bins; keeps the fit grid small
+    if len(t) <= points:
+        return t, y
+    edges = np.linspace(0, len(t), points + 1).astype(int)
+    counts = np.diff(edges)
+    return np.add.reduceat(t, edges[:-1]) / counts, np.add.reduceat(y, edges[:-1]) / counts
+
+
+def fit_fopdt(t, dy, du, grid = 80, points = 400):
+    '''Least-squares FOPDT fit of the response 'dy' (K) to an output step 'du' (%) at t = 0.
+
+    theta is searched from 0 to half the record, tau from 1/500 of the record
+    to twice its length (log spaced), both with 'grid' values.
+    '''
+    t, dy = bin_average(np.asarray(t, dtype = np.float64), np.asarray(dy, dtype = np.float64), points)
+    span = max(t[-1], 1e-9)
+    thetas = np.linspace(0.0, 0.5 * span, grid)
+    taus = np.geomspace(span / 500, 2 * span, grid)
+
+    #Unit responses for every (theta, tau) at once: shape (theta, tau, time)
+    lag = np.clip(t[None, None, :] - thetas[:, None, None], 0.0, None)
+    basis = du * -np.expm1(-lag / taus[None, :, None])
+    norm = np.einsum('ijk,ijk->ij', basis, basis)
+    gain = np.einsum('ijk,k->ij', basis, dy) / np.where(norm > 0, norm, np.inf)
+    sse = np.einsum('k,k->', dy, dy) - gain ** 2 * norm       #Residual of the best gain of each pair
+    i, j = np.unravel_index(np.argmin(sse), sse.shape)
+    return FOPDT(float(gain[i, j]), float(taus[j]), float(thetas[i]), math.sqrt(max(sse[i, j], 0.0) / len(t)))
+
+
+def simc_pid(model, setpoint, tau_c = None):
+    '''(P, I, D) for 'model' at 'setpoint' (K), SIMC rules for a first-order plant with delay.
+
+    'tau_c' is the wanted closed-loop time constant (seconds). The default,
+    theta but at least a tenth of tau, is tight but robust; larger is calmer.
+    '''
+    gain, tau, theta = abs(model.gain), model.tau, model.theta
+    if tau_c is None:
+        tau_c = max(theta, 0.1 * tau)
+    kc = (tau + theta / 3) / (gain * (tau_c + theta))        #Percent output per K of error
+    ti = min(tau + theta / 3, 4 * (tau_c + theta))
+    td = theta / 3
+    return (min(max(kc * setpoint, P_RANGE[0]), P_RANGE[1]),
+            min(max(ti, I_RANGE[0]), I_RANGE[1]),
+            min(max(td, D_RANGE[0]), D_RANGE[1]))
+
+
+def choose_range(output, heater_range, low = 20.0, high = 70.0):
+    '''Heater range that puts 'output' (percent of 'heater_range') between 'low' and 'high' %.
+
+    Returns (heater range, output on it). Each range is ~3.16x the current of the one below.
+    '''
+    current = output * HEATER_RANGES[heater_range]
+    while current > high * HEATER_RANGES[heater_range] and heater_range < len(HEATER_RANGES) - 1:
+        heater_range += 1
+    while current < low * HEATER_RANGES[heater_range] and heater_range > 1 and \
+            current <= high * HEATER_RANGES[heater_range - 1]:
+        heater_range -= 1
+    return heater_range, current / HEATER_RANGES[heater_range]
+
+
+class GainTable:
+    '''PID and heater range per temperature band, from an autotune run.
+
+    Each entry holds the temperature it was measured at; a setpoint uses the
+    entry with the nearest temperature (on a log scale, as bands are usually
+    spaced by factors).
+    '''
+
+    def __init__(self, entries, metadata = None):
+        self.entries = sorted(entries, key = lambda entry: entry['temperature'])
+        self.metadata = dict(metadata or {})
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            data = json.load(file)
+        return cls(data['entries'], data.get('metadata'))
+
+    def save(self, path):
+        with open(path, 'w') as file:
+            json.dump({'metadata': self.metadata, 'entries': self.entries}, file, indent = 1)
+
+    def lookup(self, setpoint):
+        assert(len(self.entries) > 0), 'The gain table is empty'
+        return min(self.entries, key = lambda entry: abs(math.log(entry['temperature'] / setpoint)))
+
+    def apply(self, steps):
+        #Returns the Steps with P, I, D and heater_range of every closed loop step taken from the table
+        tuned = []
+        for step in steps:
+            if 'setpoint' in step.settings and 'P' in step.settings:
+                entry = self.lookup(step.settings['setpoint'])
+                settings = dict(step.settings)
+                settings.update((key, entry[key]) for key in ('P', 'I', 'D', 'heater_range'))
+                step = step._replace(settings = settings)
+            tuned.append(step)
+        return tuned
+
+    def summary(self):
+        lines = ['%12s %8s %10s %10s %8s %6s %9s %10s %9s' % ('T (K)', 'output', 'P', 'I (s)', 'D (s)', 'range',
+                                                                'K (K/%)', 'tau (s)', 'theta (s)')]
+        for entry in self.entries:
+            lines.append('%12.6g %8.3g %10.4g %10.4g %8.3g %6d %9.3g %10.4g %9.3g' %
+                         (entry['temperature'], entry['output'], entry['P'], entry['I'], entry['D'],
+                          entry['heater_range'], entry['gain'], entry['tau'], entry['theta']))
+        return '\n'.join(lines)
+
+
+def staircase(outputs, heater_range, max_minutes, settle):
+    #The experiment as open loop schedule entries (Lakeshore_Schedule.make_steps)
+    return [{'name': str('Output ' + format(output, 'g') + ' %'), 'heater_range': heater_range,
+             'manual_output': output, 'duration': max_minutes, 'settle': settle} for output in outputs]
+
+
+def analyse(times, readings, loops, outputs, heater_range, tau_c = None, time_scale = 1.0):
+    '''GainTable from a logged staircase: 'loops' is each sample's stair index.
+
+    The baseline of every stair is the mean of the last quarter of the one
+    before it. 'time_scale' converts logged seconds to plant seconds (a
+    simulator running faster than real time).
+    '''
+    times = np.asarray(times, dtype = np.float64)
+    readings = np.asarray(readings, dtype = np.float64)
+    loops = np.asarray(loops)
+    valid = np.isfinite(readings)
+    entries = []
+    for k in range(1, len(outputs)):
+        before = np.flatnonzero(valid & (loops == k - 1))
+        during = np.flatnonzero(valid & (loops == k))
+        if len(before) < 4 or len(during) < 8:
+            print('Stair', k + 1, 'has too few readings, skipped')
+            continue
+        baseline = readings[before[-max(len(before) // 4, 2):]].mean()
+        final = readings[during[-max(len(during) // 4, 2):]].mean()
+        t = (times[during] - times[during[0]]) * time_scale
+        model = fit_fopdt(t, readings[during] - baseline, outputs[k] - outputs[k - 1])
+
+        #Tune for the range the band's output fits best on; same current -> gain scales with the range
+        band_range, band_output = choose_range(outputs[k], heater_range)
+        band_model = model._replace(gain = model.gain * HEATER_RANGES[band_range] / HEATER_RANGES[heater_range])
+        P, I, D = simc_pid(band_model, final, tau_c)
+        entries.append({'temperature': float(final), 'output': float(band_output), 'heater_range': band_range,
+                        'P': float('%.4g' % P), 'I': float('%.4g' % I), 'D': float('%.4g' % D),
+                        'gain': band_model.gain, 'tau': model.tau,
+                        'theta': model.theta, 'rms': model.rms, 'measured_range': heater_range,
+                        'measured_output': outputs[k]})
+    return GainTable(entries, {'created': dt.datetime.now().isoformat(timespec = 'seconds'),
+                               'outputs': list(outputs), 'heater_range': heater_range, 'tau_c': tau_c})
+
+
+def run_staircase(instrument, channel, outputs, heater_range, interval, max_minutes, settle, base):
+    '''Runs the experiment, saving the data to '<base>.bin' / '.json'. Returns the metadata written.'''
+    from Lakeshore_Acquisition import Sampler
+    from Lakeshore_Schedule import ScheduleRunner, make_steps
+    from Lakeshore_Storage import ColumnarWriter
+
+    metadata = {'script': 'Lakeshore_Autotune', 'outputs': list(outputs), 'heater_range': heater_range,
+                'channel': channel, 'time_scale': getattr(instrument, 'time_scale', 1.0)}
+    steps = make_steps(staircase(outputs, heater_range, max_minutes, settle))
+    sampler = Sampler(instrument, [channel], interval)
+    writer = ColumnarWriter(base, [channel], sampler.subscribe(), metadata = metadata)
+    runner = ScheduleRunner(instrument, steps, sampler.subscribe(), [channel], closed_loop = False, sampler = sampler)
+    sampler.start()
+    writer.start()
+    runner.start()
+    try:
+        runner.finished.wait()
+    finally:
+        runner.stop()
+        sampler.stop()
+        writer.stop()
+        instrument.set_manual_output(0, outputs[0])     #Back to the baseline output
+    if runner.error is not None:
+        raise runner.error
+    return metadata
+
+
+def open_loop_settings(channel, simulate):
+    #Heater settings for open loop on output 0, without needing the lakeshore package to simulate
+    if simulate:
+        return types.SimpleNamespace(output_mode = 2, input_channel = channel, powerup_enable = True,
+                                     reading_filter = False, delay = 1, polarity = 0)
+    from lakeshore.model_372 import Model372HeaterOutputSettings, Model372OutputMode, Model372Polarity
+    return Model372HeaterOutputSettings(output_mode = Model372OutputMode.OPEN_LOOP, input_channel = channel,
+                                        powerup_enable = True, reading_filter = False, delay = 1,
+                                        polarity = Model372Polarity.UNIPOLAR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Fit step responses and suggest PID / heater range per band')
+    parser.add_argument('--outputs', type = float, nargs = '+', default = [5, 10, 20, 40],
+                        help = 'manual outputs (%%) of the staircase, the first is the baseline')
+    parser.add_argument('--heater-range', type = int, default = 3, help = 'heater range during the test (1-8)')
+    parser.add_argument('--channel', type = int, default = 6, help = 'control input channel')
+    parser.add_argument('--interval', type = float, default = 3.0, help = 'seconds between readings')
+    parser.add_argument('--max-minutes', type = float, default = 60.0, help = 'longest time on one stair')
+    parser.add_argument('--settle-window', type = float, default = 10.0, help = 'minutes of settled readings')
+    parser.add_argument('--settle-slope', type = float, default = 1e-5, help = 'settled below this |slope| (K/min)')
+    parser.add_argument('--settle-std', type = float, default = 1e-4, help = 'settled below this noise (K)')
+    parser.add_argument('--tau-c', type = float, default = None, help = 'closed-loop time constant (s)')
+    parser.add_argument('--ip', default = '169.254.25.66', help = 'Lakeshore IP address')
+    parser.add_argument('--simulate', action = 'store_true', help = 'run against Lakeshore_Simulator')
+    parser.add_argument('--time-scale', type = float, default = 1.0, help = 'simulated seconds per real second')
+    parser.add_argument('--from-data', default = None, help = 'refit a saved autotune run (path without .bin)')
+    parser.add_argument('--table', default = 'Lakeshore Data/gain_table.json', help = 'where to save the table')
+    args = parser.parse_args()
+    assert(len(args.outputs) >= 2), '--outputs needs a baseline and at least one step'
+
+    if args.from_data is not None:
+        base = args.from_data
+    else:
+        from Lakeshore_Acquisition import ResilientInstrument
+        from Lakeshore_Storage import allocate_run
+        if args.simulate:
+            from Lakeshore_Simulator import SimulatedModel372
+            instrument = SimulatedModel372(time_scale = args.time_scale)
+        else:
+            from lakeshore import Model372
+            instrument = Model372(9600, ip_address = args.ip)
+        instrument = ResilientInstrument(instrument)
+        instrument.configure_heater(0, open_loop_settings(args.channel, args.simulate))
+
+        today = dt.datetime.now()
+        base = allocate_run(str('Lakeshore Data/Autotune(' + today.strftime('%m') + '-' + today.strftime('%d') +
+                                '-' + today.strftime('%y') + ')_%s.bin'))[:-4]
+        settle = {'window': args.settle_window, 'slope': args.settle_slope, 'std': args.settle_std}
+        print('Step test at outputs', args.outputs, '% on heater range', args.heater_range, ', saving to', base)
+        run_staircase(instrument, args.channel, args.outputs, args.heater_range, args.interval,
+                      args.max_minutes, settle, base)
+
+    from Lakeshore_Storage import load_columnar
+    records, metadata = load_columnar(base)
+    table = analyse(records['time'], records[str('ch' + metadata['channels'][0])], records['loop'],
+                    metadata['outputs'], metadata['heater_range'], args.tau_c, metadata.get('time_scale', 1.0))
+    table.metadata['data'] = base
+    table.save(args.table)
+    print(table.summary())
+    print('\nSaved to', args.table, "- use it in V3 as gain_table_file")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+'''
+Benchmarks for the V3 acquisition / plot / storage pipeline.
+
+Everything runs against SimulatedModel372 (see Lakeshore_Simulator) with a
+configurable round-trip latency, so results are comparable between machines
+and over time without a fridge:
+
+    sampling     samples/s vs number of channels, batched and one query per channel
+    redraw       time of one plot refresh vs history length (10^3 ... 10^6 points)
+    memory       Python memory held by the plot after simulated 24 h runs
+    csv          CSV (and columnar) rows/s through the batched writer thread
+
+Each run is appended as one JSON line to the results file (default
+'Lakeshore Data/benchmarks.jsonl') and printed next to the previous run's
+numbers.
+
+    python Lakeshore_Benchmark.py [--quick] [--latency 0.005] [--results path]
+'''
+import argparse
+import datetime as dt
+import json
+import os
+import platform
+import queue
+import sys
+import tempfile
+import time
+import tracemalloc
+import matplotlib
+matplotlib.use('Agg')       #Render off screen, the same work as a visible window minus the GUI
+import matplotlib.pyplot as plt
+import numpy as np
+from Lakeshore_Acquisition import LockedInstrument, Sample, Sampler
+from Lakeshore_Plot import LivePlot
+from Lakeshore_Simulator import SimulatedModel372
+from Lakeshore_Storage import ColumnarWriter, CSVWriter
+
+
+def synthetic_samples(n, n_channels, interval = 1.0, start = None):
+    #Samples 'interval' seconds apart, without waiting for them
+    start = time.time() if start is None else start
+    readings = 0.01 + 1e-4 * np.random.default_rng(0).standard_normal((n, n_channels))
+    for k in range(n):
+        yield Sample(start + k * interval, k * interval, list(readings[k]), 0.0, 0.01, 0.0)
+
+
+def bench_sampling(channel_counts, latency, duration):
+    '''samples/s for each channel count, batched (one exchange) and one query per channel.'''
+    results = {}
+    for n_channels in channel_counts:
+        channels = list(range(1, n_channels + 1))
+        for batched in (True, False):
+            instrument = LockedInstrument(SimulatedModel372(latency = latency, seed = 0))
+            sampler = Sampler(instrument, channels, 1.0, batched = batched)
+            end = time.perf_counter() + duration
+            count = 0
+            while time.perf_counter() < end:
+                sampler.take_sample()
+                count += 1
+            label = str('sampling: ' + str(n_channels) + ' ch, ' + ('batched' if batched else 'per channel') +
+                        ' (samples/s)')
+            results[label] = count / duration
+    return results
+
+
+def bench_redraw(history_lengths, n_channels, frames):
+    '''Seconds per refresh (plot.draw() + rendering the figure) after N samples.'''
+    results = {}
+    for n in history_lengths:
+        plot = LivePlot(list(range(1, n_channels + 1)), blit = False)
+        for sample in synthetic_samples(n, n_channels):
+            plot.add(sample)
+        plot.draw()
+        plot.fig.canvas.draw()          #First frame sets up the axes, not timed
+
+        start = time.perf_counter()
+        for frame in range(frames):
+            plot.draw()
+            plot.fig.canvas.draw()
+        results[str('redraw: ' + format(n, '.0e') + ' points (ms/frame)')] = \
+            (time.perf_counter() - start) / frames * 1000
+        plt.close(plot.fig)
+    return results
+
+
+def bench_memory(hours, interval, n_channels, redraw_every):
+    '''Memory held by plotting one simulated run, sampled every few simulated hours.'''
+    results = {}
+    tracemalloc.start()
+    plot = LivePlot(list(range(1, n_channels + 1)), blit = False)
+    baseline = tracemalloc.get_traced_memory()[0]
+    n = int(hours * 3600 / interval)
+    checkpoints = {int(n * part / 4): part for part in (1, 2, 3, 4)}
+    for k, sample in enumerate(synthetic_samples(n, n_channels, interval), 1):
+        plot.add(sample)
+        if k % redraw_every == 0:
+            plot.draw()
+        if k in checkpoints:
+            plot.draw()
+            plot.fig.canvas.draw()
+            hour = hours * checkpoints[k] / 4
+            results[str('memory: after ' + format(hour, 'g') + ' h (MB)')] = \
+                (tracemalloc.get_traced_memory()[0] - baseline) / 1e6
+    tracemalloc.stop()
+    plt.close(plot.fig)
+    return results
+
+
+def bench_csv(rows, n_channels):
+    '''rows/s through CSVWriter and ColumnarWriter, from a filled queue to disk.'''
+    results = {}
+    channels = list(range(1, n_channels + 1))
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ('csv', 'columnar'):
+            samples = queue.Queue()
+            for sample in synthetic_samples(rows, n_channels):
+                samples.put(sample)
+
+            start = time.perf_counter()
+            if name == 'csv':
+                file = open(os.path.join(directory, 'bench.csv'), 'w', newline = '')
+                writer = CSVWriter(file, samples, flush_rows = 1000)
+            else:
+                writer = ColumnarWriter(os.path.join(directory, 'bench'), channels, samples, flush_rows = 1000)
+            writer.start()
+            writer.stop()
+            elapsed = time.perf_counter() - start
+            if name == 'csv':
+                file.close()
+            results[str(name + ': ' + str(n_channels) + ' ch (rows/s)')] = rows / elapsed
+    return results
+
+
+def previous_results(path):
+    #Last saved run, or {} if there is none
+    if not os.path.exists(path):
+        return {}
+    last = {}
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                last = json.loads(line)
+    return last.get('results', {})
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the Lakeshore acquisition/plot/storage pipeline')
+    parser.add_argument('--quick', action = 'store_true', help = 'smaller sizes, a few seconds in total')
+    parser.add_argument('--latency', type = float, default = 0.005, help = 'simulated round trip (s)')
+    parser.add_argument('--results', default = 'Lakeshore Data/benchmarks.jsonl', help = 'JSON lines file to append to')
+    args = parser.parse_args()
+
+    if args.quick:
+        settings = {'channel_counts': [1, 4], 'sampling_duration': 0.5, 'history_lengths': [1000, 10000],
+                    'frames': 3, 'memory_hours': 2, 'csv_rows': 10000}
+    else:
+        settings = {'channel_counts': [1, 2, 4, 8, 16], 'sampling_duration': 3.0,
+                    'history_lengths': [1000, 10000, 100000, 1000000], 'frames': 10,
+                    'memory_hours': 24, 'csv_rows': 200000}
+    settings['latency'] = args.latency
+
+    results = {}
+    print('Sampling...')
+    results.update(bench_sampling(settings['channel_counts'], args.latency, settings['sampling_duration']))
+    print('Redraw...')
+    results.update(bench_redraw(settings['history_lengths'], 1, settings['frames']))
+    print('Memory...')
+    results.update(bench_memory(settings['memory_hours'], 1.0, 1, 600))
+    print('CSV...')
+    results.update(bench_csv(settings['csv_rows'], 4))
+
+    previous = previous_results(args.results)
+    print('\n%-45s %14s %14s' % ('benchmark', 'this run', 'previous'))
+    for label, value in results.items():
+        before = previous.get(label)
+        print('%-45s %14.3f %14s' % (label, value, '' if before is None else '%.3f' % before))
+
+    record = {'time': dt.datetime.now().isoformat(timespec = 'seconds'),
+              'platform': platform.platform(), 'python': platform.python_version(),
+              'numpy': np.__version__, 'matplotlib': matplotlib.__version__,
+              'settings': settings, 'results': results}
+    directory = os.path.dirname(args.results)
+    if directory:
+        os.makedirs(directory, exist_ok = True)
+    with open(args.results, 'a') as file:
+        file.write(json.dumps(record) + '\n')
+    print('\nSaved to', args.results)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+'''
+Fixed-size in-memory storage for live plotting.
+
+RingBuffer keeps the most recent samples at full resolution in preallocated
+NumPy arrays (float64 epoch seconds + one float column per channel).
+MinMaxHistory keeps everything older as min/max bins; when it fills up the
+bins are merged pairwise, so any run length fits in the same memory.
+History combines the two for the plot. The CSV is still the full record.
+'''
+import numpy as np
+
+
+class RingBuffer:
+
+    def __init__(self, n_channels, capacity):
+        self.capacity = capacity
+        self.times = np.empty(capacity, dtype = np.float64)
+        self.values = np.empty((capacity, n_channels), dtype = np.float64)
+        self.count = 0             #Number of valid rows, at most capacity
+        self._next = 0             #Row that the next sample is written to
+
+    def __len__(self):
+        return self.count
+
+    def append(self, timestamp, readings):
+        self.times[self._next] = timestamp
+        self.values[self._next] = readings
+        self._next = (self._next + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def data(self):
+        #Returns (times, values) oldest first, a view when the buffer has not wrapped yet
+        if self.count < self.capacity:
+            return self.times[:self.count], self.values[:self.count]
+        order = np.r_[self._next:self.capacity, 0:self._next]
+        return self.times[order], self.values[order]
+
+    def next_out(self):
+        #(time, readings) of the sample the next append() overwrites, None until the buffer is full
+        if self.count < self.capacity:
+            return None
+        return self.times[self._next], self.values[self._next]
+
+    def oldest(self):
+        if self.count == 0:
+            return None
+        if self.count < self.capacity:
+            return self.times[0]
+        return self.times[self._next]
+
+
+class MinMaxHistory:
+    '''Whole-run history as at most 'capacity' bins of (start, end, min, max).
+
+    Each bin starts out covering 'samples_per_bin' samples. When all bins are
+    used, neighbouring bins are merged and every new bin covers twice as many
+    samples, so memory stays constant no matter how long the run is. The time
+    of each channel's min and max is kept too, so data() draws them in the
+    order they happened (a cooldown falls from bin to bin instead of
+    zigzagging up inside each one).
+    '''
+
+    def __init__(self, n_channels, capacity = 2000, samples_per_bin = 1):
+        assert(capacity % 2 == 0), "'capacity' must be even"
+        self.capacity = capacity
+        self.samples_per_bin = samples_per_bin
+        self.start = np.empty(capacity, dtype = np.float64)
+        self.end = np.empty(capacity, dtype = np.float64)
+        self.low = np.empty((capacity, n_channels), dtype = np.float64)
+        self.high = np.empty((capacity, n_channels), dtype = np.float64)
+        self.low_time = np.empty((capacity, n_channels), dtype = np.float64)     #When each min / max was read
+        self.high_time = np.empty((capacity, n_channels), dtype = np.float64)
+        self.count = 0             #Number of finished bins
+        self._pending = 0          #Samples in the bin being filled (bin 'count')
+
+    def __len__(self):
+        return self.count
+
+    def append(self, timestamp, readings):
+        if self.count == self.capacity:
+            self._compact()
+
+        row = self.count
+        if self._pending == 0:
+            self.start[row] = timestamp
+            self.low[row] = readings
+            self.high[row] = readings
+            self.low_time[row] = timestamp
+            self.high_time[row] = timestamp
+        else:
+            #NaN (gap samples) never replaces a reading, a bin is only NaN if all its samples are
+            readings = np.asarray(readings, dtype = np.float64)
+            lower = (readings < self.low[row]) | np.isnan(self.low[row])
+            higher = (readings > self.high[row]) | np.isnan(self.high[row])
+            lower &= ~np.isnan(readings)
+            higher &= ~np.isnan(readings)
+            self.low[row, lower] = readings[lower]
+            self.low_time[row, lower] = timestamp
+            self.high[row, higher] = readings[higher]
+            self.high_time[row, higher] = timestamp
+        self.end[row] = timestamp
+        self._pending += 1
+
+        if self._pending == self.samples_per_bin:
+            self.count += 1
+            self._pending = 0
+
+    def _compact(self):
+        #Merge bin pairs (0,1), (2,3)... into the first half of the arrays, the
+        #extremes keep the time they were read at
+        half = self.capacity // 2
+        self.start[:half] = self.start[0::2]
+        self.end[:half] = self.end[1::2]
+        first, second = self.low[0::2], self.low[1::2]
+        lower = (second < first) | np.isnan(first)
+        self.low_time[:half] = np.where(lower, self.low_time[1::2], self.low_time[0::2])
+        self.low[:half] = np.where(lower, second, first)
+        first, second = self.high[0::2], self.high[1::2]
+        higher = (second > first) | np.isnan(first)
+        self.high_time[:half] = np.where(higher, self.high_time[1::2], self.high_time[0::2])
+        self.high[:half] = np.where(higher, second, first)
+        self.count = half
+        self.samples_per_bin *= 2
+
+    def data(self):
+        #Returns (times, values) with two points per bin, at its start and end: for each
+        #channel whichever of the min and max came first, then the other
+        n = self.count + (1 if self._pending > 0 else 0)
+        low, high = self.low[:n], self.high[:n]
+        low_first = self.low_time[:n] <= self.high_time[:n]
+
+        times = np.empty(2 * n, dtype = np.float64)
+        times[0::2] = self.start[:n]
+        times[1::2] = self.end[:n]
+        values = np.empty((2 * n, low.shape[1]), dtype = np.float64)
+        values[0::2] = np.where(low_first, low, high)
+        values[1::2] = np.where(low_first, high, low)
+        return times, values
+
+
+class History:
+    '''Recent samples at full resolution plus a decimated view of everything older.
+
+    A sample only goes into the decimated history once it drops out of the
+    window, so the two meet exactly: no sample is left out or drawn twice.
+    '''
+
+    def __init__(self, n_channels, window = 2000, history_bins = 2000):
+        self.recent = RingBuffer(n_channels, window)
+        self.older = MinMaxHistory(n_channels, history_bins)
+
+    def __len__(self):
+        return len(self.recent)
+
+    def append(self, timestamp, readings):
+        leaving = self.recent.next_out()
+        if leaving is not None:
+            self.older.append(*leaving)
+        self.recent.append(timestamp, readings)
+
+    def data(self):
+        #Everything to draw: decimated history up to the start of the window, then the window
+        recent_times, recent_values = self.recent.data()
+        if self.recent.count < self.recent.capacity:
+            #Nothing has left the window yet
+            return recent_times, recent_values
+        older_times, older_values = self.older.data()
+        return np.concatenate((older_times, recent_times)), np.concatenate((older_values, recent_values))
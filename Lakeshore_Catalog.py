@@ -0,0 +1,338 @@
+'''
+SQLite catalog of every run in 'Lakeshore Data', for searching across runs.
+
+One row per data file (CSV or .dlt) with its script, start and end time
+and number of samples, one row per channel with count / min / max / mean /
+first / last reading, and one row per step with its heater settings.
+Channel and step columns are indexed, so questions like "every run that
+went below 15 mK on channel 6" are one indexed query instead of opening
+every file:
+
+    catalog = RunCatalog()
+    catalog.find_runs(channel = 6, below = 0.015)
+
+The scripts record their runs as they write them (V3 when the run starts
+and again with the summary at the end, the read-only loggers as each file
+is finished). Older files are added in bulk with index_directory(); a
+CSV's date comes from its name, its schedule from its journal (see
+Lakeshore_Journal) when it has one.
+
+    python Lakeshore_Catalog.py index ['Lakeshore Data']
+    python Lakeshore_Catalog.py find --channel 6 --below 0.015 [--after 2021-11-01] [--setpoint-below 0.02]
+'''
+import argparse
+import csv
+import datetime as dt
+import glob
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+import numpy as np
+from Lakeshore_Storage import RunStats, load_delta
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    file TEXT UNIQUE NOT NULL,
+    script TEXT,
+    started REAL,
+    ended REAL,
+    samples INTEGER,
+    gaps INTEGER,
+    closed_loop INTEGER,
+    schedule TEXT,
+    size INTEGER,
+    mtime REAL,
+    recorded REAL
+);
+CREATE TABLE IF NOT EXISTS channels (
+    run INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    channel TEXT NOT NULL,
+    count INTEGER,
+    min REAL,
+    max REAL,
+    mean REAL,
+    first REAL,
+    last REAL,
+    PRIMARY KEY (run, channel)
+);
+CREATE TABLE IF NOT EXISTS steps (
+    run INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    step INTEGER NOT NULL,
+    name TEXT,
+    setpoint REAL,
+    heater_range INTEGER,
+    P REAL,
+    I REAL,
+    D REAL,
+    ramp_rate REAL,
+    manual_output REAL,
+    PRIMARY KEY (run, step)
+);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+CREATE INDEX IF NOT EXISTS channels_min ON channels (channel, min);
+CREATE INDEX IF NOT EXISTS channels_max ON channels (channel, max);
+CREATE INDEX IF NOT EXISTS steps_setpoint ON steps (setpoint);
+'''
+
+# 'LakeshoreTemp(11-05-21)_3.csv' -> month, day, year
+FILE_DATE = re.compile(r'\((\d\d)-(\d\d)-(\d\d)\)')
+# 'CH. 6 (K):' -> '6'
+CHANNEL_COLUMN = re.compile(r'CH\. (\S+) \(K\):')
+STEP_COLUMNS = ('setpoint', 'heater_range', 'P', 'I', 'D', 'ramp_rate', 'manual_output')
+
+
+def read_csv(path):
+    '''Returns (channels, epoch times, readings array) of one of the scripts' CSVs.
+
+    The CSV only has the time of day: the date is taken from the file name
+    (or its modification time) and a day is added wherever the time goes back.
+    '''
+    with open(path, newline = '') as file:
+        rows = list(csv.reader(file))
+    if len(rows) == 0:
+        return [], np.zeros(0), np.zeros((0, 0))
+    columns = [(k, CHANNEL_COLUMN.match(name)) for k, name in enumerate(rows[0])]
+    columns = [(k, match.group(1)) for k, match in columns if match]
+    rows = [row for row in rows[1:] if len(row) == len(rows[0])]
+
+    match = FILE_DATE.search(os.path.basename(path))
+    if match:
+        date = dt.datetime(2000 + int(match.group(3)), int(match.group(1)), int(match.group(2)))
+    else:
+        date = dt.datetime.fromtimestamp(os.path.getmtime(path)).replace(hour = 0, minute = 0, second = 0,
+                                                                         microsecond = 0)
+    seconds = np.array([sum(int(part) * scale for part, scale in zip(row[0].split(':'), (3600, 60, 1)))
+                        for row in rows], dtype = np.float64)
+    seconds += 86400 * np.concatenate(([0], np.cumsum(np.diff(seconds) < 0)))     #Past midnight
+    readings = np.array([[float(row[k]) for k, channel in columns] for row in rows],
+                        dtype = np.float64).reshape(len(rows), len(columns))
+    return [channel for k, channel in columns], time.mktime(date.timetuple()) + seconds, readings
+
+
+def read_delta(path):
+    #Same as read_csv() for a compressed .dlt file (see Lakeshore_Storage.RotatingDeltaWriter)
+    records, metadata = load_delta(path)
+    channels = metadata['channels']
+    readings = np.array([records[str('ch' + channel)] for channel in channels], dtype = np.float64)
+    return channels, np.asarray(records['time']), readings.T.reshape(len(records), len(channels))
+
+
+def array_stats(channels, times, readings):
+    #RunStats of a whole file at once
+    stats = RunStats(channels)
+    stats.samples = len(times)
+    if len(times) == 0:
+        return stats
+    stats.started, stats.ended = float(times[0]), float(times[-1])
+    valid = np.isfinite(readings)
+    stats.gaps = int((~valid.any(axis = 1)).sum())
+    for k in range(len(channels)):
+        values = readings[valid[:, k], k]
+        stats.count[k] = len(values)
+        if len(values) > 0:
+            stats.min[k], stats.max[k] = float(values.min()), float(values.max())
+            stats.total[k] = float(values.sum())
+            stats.first[k], stats.last[k] = float(values[0]), float(values[-1])
+    return stats
+
+
+class RunCatalog:
+
+    def __init__(self, path = 'Lakeshore Data/catalog.sqlite'):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def _upsert(self, file, script, stats = None, steps = None, closed_loop = None, merge = False):
+        #One run, without committing; 'merge' adds 'stats' to what is already recorded (a resumed run)
+        file = os.path.normpath(file)
+        size, mtime = (os.path.getsize(file), os.path.getmtime(file)) if os.path.exists(file) else (None, None)
+        row = self.connection.execute('SELECT id, started, samples, gaps FROM runs WHERE file = ?', (file,)).fetchone()
+        if row is None:
+            run = self.connection.execute('INSERT INTO runs (file) VALUES (?)', (file,)).lastrowid
+        else:
+            run = row['id']
+
+        values = {'script': script, 'size': size, 'mtime': mtime, 'recorded': time.time()}
+        if closed_loop is not None:
+            values['closed_loop'] = int(closed_loop)
+        if steps is not None:
+            values['schedule'] = json.dumps([step._asdict() for step in steps])
+        if stats is not None:
+            merging = merge and row is not None and row['samples'] is not None
+            values.update({'started': row['started'] if merging and row['started'] is not None else stats.started,
+                           'ended': stats.ended,
+                           'samples': stats.samples + (row['samples'] if merging else 0),
+                           'gaps': stats.gaps + (row['gaps'] if merging else 0)})
+        self.connection.execute(str('UPDATE runs SET ' + ', '.join(str(key + ' = ?') for key in values) +
+                                    ' WHERE id = ?'), list(values.values()) + [run])
+
+        if stats is not None:
+            for summary in stats.channel_summary():
+                old = self.connection.execute('SELECT * FROM channels WHERE run = ? AND channel = ?',
+                                              (run, summary['channel'])).fetchone() if merge else None
+                if old is not None and old['count']:
+                    count = old['count'] + summary['count']
+                    values = [x for x in (old['min'], summary['min']) if x is not None]
+                    summary['min'] = min(values) if values else None
+                    values = [x for x in (old['max'], summary['max']) if x is not None]
+                    summary['max'] = max(values) if values else None
+                    summary['mean'] = (old['mean'] * old['count'] + (summary['mean'] or 0) * summary['count']) / count
+                    summary['first'] = old['first']
+                    summary['last'] = summary['last'] if summary['last'] is not None else old['last']
+                    summary['count'] = count
+                self.connection.execute('INSERT OR REPLACE INTO channels VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                        (run, summary['channel'], summary['count'], summary['min'], summary['max'],
+                                         summary['mean'], summary['first'], summary['last']))
+        if steps is not None:
+            self.connection.execute('DELETE FROM steps WHERE run = ?', (run,))
+            self.connection.executemany('INSERT INTO steps VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                        [(run, n, step.name) + tuple(step.settings.get(key) for key in STEP_COLUMNS)
+                                         for n, step in enumerate(steps)])
+        return run
+
+    def record_run(self, file, script, stats = None, steps = None, closed_loop = None, merge = False):
+        '''Adds or updates the run written to 'file'. Call it again with more as the run goes on.
+
+        'stats' is a RunStats of the samples written, 'steps' the schedule
+        (Lakeshore_Schedule Steps). With merge = True the stats are added to
+        the ones already recorded, for a run resumed into the same file.
+        '''
+        with self.connection:
+            return self._upsert(file, script, stats, steps, closed_loop, merge)
+
+    def index_csv(self, path, force = False):
+        #Adds one existing CSV or .dlt file, returns False if it was already indexed and has not changed since
+        with self.connection:
+            return self._index(path, force)
+
+    def _index(self, path, force):
+        path = os.path.normpath(path)
+        row = self.connection.execute('SELECT size, mtime FROM runs WHERE file = ?', (path,)).fetchone()
+        if not force and row is not None and row['size'] == os.path.getsize(path) and \
+                row['mtime'] == os.path.getmtime(path):
+            return False
+        channels, times, readings = read_delta(path) if path.endswith('.dlt') else read_csv(path)
+        steps, closed_loop, script = None, None, None
+        journal = str(os.path.splitext(path)[0] + '_journal.json')
+        if os.path.exists(journal):
+            from Lakeshore_Journal import RunJournal
+            journal = RunJournal.load(path)
+            steps, closed_loop, script = journal.steps, journal.data.get('closed_loop'), 'Lakeshore_Temp_Control_V3'
+        elif os.path.basename(path).startswith('ReadOnly_'):
+            script = 'READ_ONLY_Lakeshore_Temp_V2'
+        self._upsert(path, script, array_stats(channels, times, readings), steps, closed_loop)
+        return True
+
+    def index_directory(self, directory = 'Lakeshore Data', force = False):
+        '''Adds every CSV and .dlt file in 'directory' in one transaction, returns how many were (re)indexed.'''
+        indexed = 0
+        with self.connection:
+            paths = glob.glob(os.path.join(directory, '*.csv')) + glob.glob(os.path.join(directory, '*.dlt'))
+            for path in sorted(paths):
+                try:
+                    indexed += self._index(path, force)
+                except (ValueError, IndexError, OSError) as ex:
+                    print('Skipped', path, ':', repr(ex))
+        return indexed
+
+    def find_runs(self, channel = None, below = None, above = None, after = None, before = None,
+                  setpoint_below = None, setpoint_above = None, script = None):
+        '''Runs matching every condition given, oldest first, as dicts.
+
+        below / above      : the channel's min went below / max went above (K)
+        after / before     : the run started after / before (epoch seconds or datetime)
+        setpoint_below/... : a step had a setpoint below / above (K)
+        '''
+        if isinstance(after, dt.datetime):
+            after = after.timestamp()
+        if isinstance(before, dt.datetime):
+            before = before.timestamp()
+        query = ['SELECT runs.*'] + ([', channels.channel, channels.min, channels.max, channels.mean']
+                                     if channel is not None else []) + ['FROM runs']
+        conditions = []
+        parameters = []
+        if channel is not None:
+            query.append('JOIN channels ON channels.run = runs.id')
+            conditions.append('channels.channel = ?')
+            parameters.append(str(channel))
+            if below is not None:
+                conditions.append('channels.min < ?')
+                parameters.append(below)
+            if above is not None:
+                conditions.append('channels.max > ?')
+                parameters.append(above)
+        else:
+            assert(below is None and above is None), "'below' / 'above' need a 'channel'"
+        if after is not None:
+            conditions.append('runs.started >= ?')
+            parameters.append(after)
+        if before is not None:
+            conditions.append('runs.started < ?')
+            parameters.append(before)
+        if script is not None:
+            conditions.append('runs.script = ?')
+            parameters.append(script)
+        for column, operator, value in (('setpoint', '<', setpoint_below), ('setpoint', '>', setpoint_above)):
+            if value is not None:
+                conditions.append(str('EXISTS (SELECT 1 FROM steps WHERE steps.run = runs.id AND steps.' +
+                                      column + ' ' + operator + ' ?)'))
+                parameters.append(value)
+        if conditions:
+            query.append('WHERE ' + ' AND '.join(conditions))
+        query.append('ORDER BY runs.started')
+        return [dict(row) for row in self.connection.execute(' '.join(query), parameters)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Index and search the Lakeshore runs')
+    parser.add_argument('--catalog', default = 'Lakeshore Data/catalog.sqlite', help = 'SQLite file')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    index = commands.add_parser('index', help = 'add every CSV and .dlt file of a directory')
+    index.add_argument('directory', nargs = '?', default = 'Lakeshore Data')
+    index.add_argument('--force', action = 'store_true', help = 'reindex unchanged files too')
+    find = commands.add_parser('find', help = 'list the runs matching every condition given')
+    find.add_argument('--channel')
+    find.add_argument('--below', type = float, help = 'min of the channel below (K)')
+    find.add_argument('--above', type = float, help = 'max of the channel above (K)')
+    find.add_argument('--after', help = 'started on or after (YYYY-MM-DD)')
+    find.add_argument('--before', help = 'started before (YYYY-MM-DD)')
+    find.add_argument('--setpoint-below', type = float)
+    find.add_argument('--setpoint-above', type = float)
+    find.add_argument('--script')
+    args = parser.parse_args()
+
+    catalog = RunCatalog(args.catalog)
+    start = time.perf_counter()
+    if args.command == 'index':
+        count = catalog.index_directory(args.directory, args.force)
+        print('Indexed', count, 'files in', round(time.perf_counter() - start, 2), 's')
+        return 0
+
+    runs = catalog.find_runs(args.channel, args.below, args.above,
+                             None if args.after is None else dt.datetime.fromisoformat(args.after),
+                             None if args.before is None else dt.datetime.fromisoformat(args.before),
+                             args.setpoint_below, args.setpoint_above, args.script)
+    elapsed = time.perf_counter() - start
+    for run in runs:
+        started = '' if run['started'] is None else dt.datetime.fromtimestamp(run['started']).strftime('%Y-%m-%d %H:%M')
+        extra = '' if args.channel is None else '   min %.6g K   max %.6g K' % (run['min'] or float('nan'),
+                                                                             run['max'] or float('nan'))
+        print('%-16s %s%s' % (started, run['file'], extra))
+    print(len(runs), 'runs in', round(elapsed * 1000, 1), 'ms')
+    catalog.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
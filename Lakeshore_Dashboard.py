@@ -0,0 +1,255 @@
+'''
+Local web dashboard for watching a run from a browser instead of the plot window.
+
+DashboardServer takes ONE subscription from a Sampler (or MultiSampler) and
+relays it on its own thread: every sample goes into a fixed-size History
+(see Lakeshore_Buffer) and out to every connected viewer through server-sent
+events. The acquisition thread only ever fills that one queue, so adding
+viewers adds no load on it or on the instrument; a viewer that falls behind
+loses its own oldest samples and nobody else's.
+
+    GET /                       page that plots the stream (no external scripts)
+    GET /history?points=N       JSON, the run so far min/max downsampled to ~N points
+                                (&controller=name for one fridge of a MultiSampler)
+    GET /stream                 text/event-stream, one JSON event per new sample
+
+    dashboard = DashboardServer(channels, sampler.subscribe(maxsize = 1000))
+    dashboard.start()           # then browse to http://127.0.0.1:8372/
+
+Given {controller name: channels} and one subscription from a MultiSampler,
+a single server shows every fridge, one section each.
+'''
+import http.server
+import json
+import math
+import queue
+import threading
+import urllib.parse
+import numpy as np
+from Lakeshore_Acquisition import Publisher
+from Lakeshore_Buffer import History
+
+
+def sample_json(sample):
+    #NaN/inf are not valid JSON, missing values are sent as null
+    def number(value):
+        return None if value is None or not math.isfinite(value) else value
+    return {'time': sample.timestamp,
+            'readings': [number(value) for value in sample.readings],
+            'heater_output': number(sample.heater_output),
+            'setpoint': number(sample.setpoint),
+            'fresh': sample.fresh}
+
+
+def downsample(times, values, points):
+    #Min and max of each bucket, so spikes survive; at most ~'points' rows. Gaps (NaN)
+    #are ignored unless a whole bucket is one. Each channel's min and max are drawn in
+    #the order they happened, at the bucket's first and last time
+    buckets = points // 2
+    if buckets < 1 or len(times) <= points:
+        return times, values
+    edges = np.unique(np.linspace(0, len(times), buckets + 1).astype(int))[:-1]
+    sizes = np.diff(np.r_[edges, len(times)])
+    low = np.fmin.reduceat(values, edges, axis = 0)
+    high = np.fmax.reduceat(values, edges, axis = 0)
+    #First row of each bucket holding its min / max
+    rows = np.broadcast_to(np.arange(len(times))[:, None], values.shape)
+    low_at = np.minimum.reduceat(np.where(values == np.repeat(low, sizes, axis = 0), rows, len(times)), edges, axis = 0)
+    high_at = np.minimum.reduceat(np.where(values == np.repeat(high, sizes, axis = 0), rows, len(times)), edges, axis = 0)
+    low_first = low_at <= high_at
+
+    out_times = np.empty(2 * len(edges), dtype = np.float64)
+    out_times[0::2] = times[edges]
+    out_times[1::2] = times[edges + sizes - 1]
+    out_values = np.empty((2 * len(edges), values.shape[1]), dtype = np.float64)
+    out_values[0::2] = np.where(low_first, low, high)
+    out_values[1::2] = np.where(low_first, high, low)
+    return out_times, out_values
+
+
+PAGE = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Lakeshore</title>
+<style>body{font-family:sans-serif;margin:1em}canvas{width:100%;height:220px;border:1px solid #ccc}</style>
+</head><body><h3>Lakeshore Temperature VS Time</h3><div id="plots"></div>
+<script>
+const sections = SECTIONS;
+sections.forEach(s => {
+  s.times = []; s.values = s.channels.map(() => []);
+  const block = document.createElement('div');
+  if (s.controller !== null) {
+    const name = document.createElement('h4'); name.textContent = s.controller; block.append(name);
+  }
+  s.latest = document.createElement('div'); block.append(s.latest);
+  s.canvases = s.channels.map(channel => {
+    const title = document.createElement('div'); title.textContent = 'CH. ' + channel + ' Temp. (K)';
+    const canvas = document.createElement('canvas');
+    block.append(title, canvas); return canvas;
+  });
+  document.getElementById('plots').append(block);
+});
+function draw(s) {
+  s.canvases.forEach((canvas, k) => {
+    canvas.width = canvas.clientWidth; canvas.height = canvas.clientHeight;
+    const c = canvas.getContext('2d'), y = s.values[k].filter(v => v !== null);
+    if (s.times.length < 2 || y.length == 0) return;
+    const t0 = s.times[0], t1 = s.times[s.times.length - 1];
+    let lo = Math.min(...y), hi = Math.max(...y); if (hi == lo) { hi += 1e-3; lo -= 1e-3; }
+    c.strokeStyle = '#348ABD'; c.beginPath();
+    s.times.forEach((t, i) => { if (s.values[k][i] === null) { c.stroke(); c.beginPath(); return; }
+      c.lineTo((t - t0) / (t1 - t0 || 1) * canvas.width, canvas.height * (1 - (s.values[k][i] - lo) / (hi - lo))); });
+    c.stroke(); c.fillText(hi.toPrecision(6), 2, 10); c.fillText(lo.toPrecision(6), 2, canvas.height - 2);
+  });
+}
+Promise.all(sections.map(s =>
+  fetch('history?points=2000' + (s.controller === null ? '' : '&controller=' + encodeURIComponent(s.controller)))
+    .then(r => r.json()).then(h => {
+      s.times = h.times; s.values = s.channels.map((ch, k) => h.values.map(row => row[k])); draw(s);
+    }))).then(() => {
+  const stream = new EventSource('stream');
+  stream.onmessage = e => {
+    const m = JSON.parse(e.data), controller = m.controller === undefined ? null : m.controller;
+    const s = sections.find(s => s.controller === controller);
+    if (s === undefined) return;
+    s.times.push(m.time); m.readings.forEach((v, k) => s.values[k].push(v));
+    if (s.times.length > 4000) { s.times = s.times.slice(-2000); s.values = s.values.map(v => v.slice(-2000)); }
+    s.latest.textContent = new Date(m.time * 1000).toLocaleTimeString() + '   ' +
+      m.readings.map((v, k) => 'CH. ' + s.channels[k] + ': ' + v + ' K').join('   ');
+    draw(s);
+  };
+});
+</script></body></html>
+'''
+
+
+class DashboardServer(Publisher, http.server.ThreadingHTTPServer):
+    '''Serves the dashboard on host:port and relays 'samples' to every viewer.
+
+    'samples' is a queue from Sampler.subscribe(), preferably bounded. For a
+    MultiSampler (ControllerSample items) pass 'channels' as {controller name:
+    channels} to show every fridge, or 'controller' to show only that one.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, channels, samples, host = '127.0.0.1', port = 8372, window = 2000,
+                 history_bins = 2000, controller = None, viewer_queue = 1000):
+        Publisher.__init__(self)
+        http.server.ThreadingHTTPServer.__init__(self, (host, port), _DashboardHandler)
+        if isinstance(channels, dict):
+            self.sections = {name: list(section) for name, section in channels.items()}
+        else:
+            self.sections = {controller: list(channels)}      #One section, named None for a Sampler
+        self.samples = samples
+        self.tagged = isinstance(channels, dict) or controller is not None    #ControllerSample items
+        self.viewer_queue = viewer_queue         #Samples kept per viewer before its oldest are dropped
+        self.histories = {name: History(len(section), window, history_bins) for name, section in self.sections.items()}
+        self.history_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.samples_relayed = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def relay(self):
+        while not self.stopping.is_set():
+            try:
+                sample = self.samples.get(timeout = 0.5)
+            except queue.Empty:
+                continue
+            name = None
+            if self.tagged:
+                name, sample = sample.controller, sample.sample
+                if name not in self.sections:
+                    continue
+            with self.history_lock:
+                self.histories[name].append(sample.timestamp, sample.readings)
+            self.samples_relayed += 1
+            event = sample_json(sample)
+            if name is not None:
+                event['controller'] = name
+            self.publish(json.dumps(event))
+
+    def page_sections(self):
+        #What the page draws, one entry per section
+        return [{'controller': name, 'channels': [str(channel) for channel in section]}
+                for name, section in self.sections.items()]
+
+    def history_json(self, points, controller = None):
+        with self.history_lock:
+            times, values = self.histories[controller].data()
+            times, values = downsample(times, values, points)
+            values = np.where(np.isfinite(values), values, np.nan)
+        return {'controller': controller,
+                'channels': [str(channel) for channel in self.sections[controller]],
+                'times': times.tolist(),
+                'values': [[None if math.isnan(value) else value for value in row] for row in values.tolist()]}
+
+    def start(self):
+        #Relay and HTTP server on background threads
+        threading.Thread(target = self.relay, daemon = True).start()
+        thread = threading.Thread(target = self.serve_forever, daemon = True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopping.set()
+        self.shutdown()
+        self.server_close()
+
+
+class _DashboardHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass        #No line per request on the console
+
+    def send_body(self, content_type, body):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        dashboard = self.server
+        if url.path == '/':
+            sections = json.dumps(dashboard.page_sections())
+            self.send_body('text/html; charset=utf-8', PAGE.replace('SECTIONS', sections).encode('utf-8'))
+        elif url.path == '/history':
+            query = urllib.parse.parse_qs(url.query)
+            try:
+                points = int(query.get('points', ['2000'])[0])
+            except ValueError:
+                self.send_error(400, 'points must be an int')
+                return
+            controller = query.get('controller', [None])[0]
+            if controller is None and len(dashboard.sections) == 1:
+                controller = next(iter(dashboard.sections))
+            if controller not in dashboard.sections:
+                self.send_error(404, 'no such controller')
+                return
+            self.send_body('application/json', json.dumps(dashboard.history_json(points, controller)).encode('utf-8'))
+        elif url.path == '/stream':
+            self.stream(dashboard)
+        else:
+            self.send_error(404)
+
+    def stream(self, dashboard):
+        viewer = dashboard.subscribe(dashboard.viewer_queue)
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            while not dashboard.stopping.is_set():
+                try:
+                    event = str('data: ' + viewer.get(timeout = 15) + '\n\n')
+                except queue.Empty:
+                    event = ': keepalive\n\n'      #Lets a closed browser tab be noticed
+                self.wfile.write(event.encode('utf-8'))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            dashboard.unsubscribe(viewer)
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Read only logger without a GUI.
+
+Same data as READ_ONLY_Lakeshore_Temp_V2 (one CSV per 'loop_runtime', named
+ReadOnly_LakeshoreTemp(date)_run, each following on from the last without
+a gap) but nothing waits on a plot window: the Sampler and CSV writer threads
+do all the work and this script only reports finished files. matplotlib is never imported unless
+'save_plot' is True, so it starts quickly and runs on a headless server
+(e.g. over ssh, or as a service).
+
+For long unattended runs, delta_data = True writes compressed .dlt files
+instead of CSVs: a channel is only stored once it moves by more than
+'deadband', and Lakeshore_Storage.load_delta() rebuilds every sample.
+
+"""
+
+from Lakeshore_Acquisition import AdaptiveRate, ResilientInstrument, Sampler, ScannerScheduler, drain
+from Lakeshore_Catalog import RunCatalog
+from Lakeshore_Dashboard import DashboardServer
+from Lakeshore_Metrics import Metrics, MetricsServer
+from Lakeshore_Storage import ColumnarWriter, RotatingCSVWriter, RotatingDeltaWriter, allocate_run, csv_header
+from Lakeshore_Simulator import SimulatedModel372
+import queue
+import sys
+import time
+import datetime as dt
+
+
+#    Locate and initialize Lakeshore Model, must include USB Baude Rate (Typically 9600)
+'''
+####    NOTE: Always set Lakeshore to ETHERNET MODE by selecting
+####          "interface" --> "Enabled" --> "Ethernet"
+####          after, copy ip_adress from "View IP_Config <Submenu>"
+####          into my_instrument below.
+'''
+SIMULATE = False            #True runs against a simulated Model372 (Lakeshore_Simulator), no fridge needed
+if SIMULATE:
+    my_instrument = SimulatedModel372()
+else:
+    from lakeshore import Model372
+    my_instrument = Model372(9600, ip_address = '169.254.110.0')
+my_instrument = ResilientInstrument(my_instrument)   #Reconnects after a link drop
+
+
+
+# SET PARAMETERS
+channels       =      [6]                       # (MUST BE AN ARRAY) Which lakeshore channels to read
+innerloop_wait =      60                        # (MUST BE AN INT) Wait time (seconds) between individual data points
+adaptive_wait  =      None                      # e.g. (10, 300) to sample every 10 to 300 s instead: faster while the temperature changes (Lakeshore_Acquisition.AdaptiveRate)
+USE_SCANNER    =      False                     # True if 'channels' go through the scanner, only one is live at a time
+loop_runtime   =      1440                      # Length (Minutes) of each file, the next one carries on without a gap
+rotate_mb      =      None                      # e.g. 50 to also start a new file once one reaches this size (MB)
+csv_flush_wait =      60                        # Max time (seconds) rows are kept in memory before being written
+csv_fsync      =      False                     # True forces every write onto the disk (survives a power cut)
+columnar_data  =      False                     # Also save a binary copy (.bin + .json) that loads much faster than the CSV
+delta_data     =      False                     # Compressed .dlt files instead of CSVs: a reading is only stored once it changes (Lakeshore_Storage.load_delta)
+deadband       =      0                         # With delta_data: change (K) before a channel is stored again, one number or {channel: K}, 0 = lossless
+deadband_wait  =      600                       # With delta_data: store each channel at least this often (seconds), changed or not
+dashboard_port =      None                      # e.g. 8372 to also watch the run at http://127.0.0.1:8372/ (Lakeshore_Dashboard)
+metrics_port   =      None                      # e.g. 9372 to serve timing histograms at http://127.0.0.1:9372/metrics (Lakeshore_Metrics)
+catalog_file   =      'Lakeshore Data/catalog.sqlite'  # Run catalog each finished file is added to (Lakeshore_Catalog), None for no catalog
+snapshot_every =      None                      # With save_plot, e.g. 30 to also update the current file's PNG every 30 minutes
+save_plot      =      False                     # Also save a .png of each file (imports matplotlib, no display needed)
+
+
+
+#Error catching when defining variables
+assert(isinstance(loop_runtime, int)), "'loop_runtime' variabel must be an int"
+assert(isinstance(channels, list)), "'channels' variable must be a list"
+assert(isinstance(innerloop_wait, int)), "'innerloop_wait' variable must be an int"
+
+
+
+#Plotting is an optional consumer of the same samples, only loaded when asked for
+if save_plot:
+    import matplotlib
+    matplotlib.use('Agg')           #Render to files only
+    from Lakeshore_Plot import LivePlot, SnapshotRenderer
+
+
+
+def new_file(timestamp):
+    #Name of the file starting at 'timestamp', dated by its first sample
+    start_time = dt.datetime.fromtimestamp(timestamp)
+    filename = str('Lakeshore Data/ReadOnly_LakeshoreTemp(' + start_time.strftime('%m') + '-' +\
+                   start_time.strftime('%d') + '-' + start_time.strftime('%y') + ')_%s' +
+                   ('.dlt' if delta_data else '.csv'))
+    return allocate_run(filename)     #add the next free run number to filename
+
+
+
+#The sampler and the CSV writer run for the whole program, the writer starts every new file itself
+scanner = ScannerScheduler(my_instrument, channels) if USE_SCANNER else None
+metrics = Metrics()             #Timing of reads, writes and redraws, summarized next to each file
+rate = None if adaptive_wait is None else AdaptiveRate(*adaptive_wait)
+sampler = Sampler(my_instrument, channels, innerloop_wait, scanner = scanner, metrics = metrics, rate = rate)
+csv_samples = sampler.subscribe()
+data_samples = sampler.subscribe() if columnar_data else None
+if dashboard_port is not None:
+    dashboard = DashboardServer(channels, sampler.subscribe(maxsize = 1000), port = dashboard_port)
+    dashboard.start()     #Any number of browser viewers share this one bounded subscription
+if metrics_port is not None:
+    MetricsServer(metrics, port = metrics_port).start()
+plot_samples = sampler.subscribe() if save_plot else None
+
+finished_files = queue.Queue()      #(filename, RunStats) from the writer thread
+catalog = None if catalog_file is None else RunCatalog(catalog_file)
+if delta_data:
+    #Same files, rotation and reports, only the format differs (see Lakeshore_Storage.RotatingDeltaWriter)
+    csv_writer = RotatingDeltaWriter(new_file, channels, csv_samples, deadband = deadband, max_interval = deadband_wait,
+                                     rotate_minutes = loop_runtime,
+                                     rotate_bytes = None if rotate_mb is None else rotate_mb * 1e6,
+                                     on_rotate = lambda *finished: finished_files.put(finished),
+                                     flush_interval = csv_flush_wait, fsync = csv_fsync, metrics = metrics,
+                                     metadata = {'script': 'Lakeshore_Headless_Logger'})
+else:
+    csv_writer = RotatingCSVWriter(new_file, csv_header(channels), csv_samples,
+                                   rotate_minutes = loop_runtime,
+                                   rotate_bytes = None if rotate_mb is None else rotate_mb * 1e6,
+                                   on_rotate = lambda *finished: finished_files.put(finished), channels = channels,
+                                   flush_interval = csv_flush_wait, fsync = csv_fsync, metrics = metrics)
+csv_writer.start()
+
+if columnar_data:
+    data_writer = ColumnarWriter(csv_writer.filename[:-4], channels, data_samples,
+                                 flush_interval = csv_flush_wait, fsync = csv_fsync, metrics = metrics,
+                                 metadata = {'script': 'Lakeshore_Headless_Logger', 'csv': csv_writer.filename})
+    data_writer.start()
+
+if save_plot:
+    #Only the fixed-size history of the plot is used, nothing is drawn until a file is finished
+    plot = LivePlot(channels, '(READ ONLY) Temp vs Time', title_color = 'red', blit = False)
+    snapshots = SnapshotRenderer(channels, '(READ ONLY) Temp vs Time', title_color = 'red')
+    snapshots.start()
+
+
+
+def save_file(finished, stats):
+    #SAVE FIGURE of one finished file, only its own time span
+    if save_plot:
+        for sample in drain(plot_samples):
+            plot.add(sample)
+        if stats.started is not None:
+            snapshots.save(str(finished[:-4] + '.png'), *plot.snapshot(stats.started, stats.ended))    #replace .csv with .png
+    metrics.write_summary(str(finished[:-4] + '_timing.txt'))
+    if catalog is not None:
+        catalog.record_run(finished, 'Lakeshore_Headless_Logger', stats)
+
+    print("\n\n" + finished + " has been saved.")
+    print('Lakeshore read time per sample: ', round(sampler.mean_latency * 1000, 1), 'ms average, ', round(sampler.max_latency * 1000, 1), 'ms max')
+    if adaptive_wait is not None:
+        print('Samples in the file: ', stats.samples, ', current interval: ', round(sampler.interval, 1), 's')
+    if sampler.gaps > 0:
+        print('Gap samples (Lakeshore unreachable): ', sampler.gaps, ', reconnects: ', my_instrument.reconnects)
+
+
+
+def save_current():
+    #PNG of the file still being written, from its first sample up to now
+    current, stats = csv_writer.filename, csv_writer.stats
+    if stats.started is not None:
+        for sample in drain(plot_samples):
+            plot.add(sample)
+        snapshots.save(str(current[:-4] + '.png'), *plot.snapshot(stats.started))
+
+
+
+sampler.start()
+print("Begin Measurements\nTaking data once every " +
+      (str(innerloop_wait) if adaptive_wait is None else str(adaptive_wait[0]) + " to " + str(adaptive_wait[1])) +
+      " seconds, saving to " + csv_writer.filename)
+try:
+    #Nothing to do here but report finished files, the threads take and write the data
+    saved_at = time.monotonic()
+    while True == True:
+        try:
+            save_file(*finished_files.get(timeout = 60))
+        except queue.Empty:
+            pass
+        if save_plot:
+            for sample in drain(plot_samples):      #Keeps the queue short, the plot history is fixed-size
+                plot.add(sample)
+            if snapshot_every is not None and time.monotonic() - saved_at >= snapshot_every * 60:
+                save_current()
+                saved_at = time.monotonic()
+
+except KeyboardInterrupt:
+    print("Program halted")
+
+finally:
+    sampler.stop()
+    csv_writer.stop()       #Write out everything queued before the file is closed
+    if columnar_data:
+        data_writer.stop()
+    for finished in drain(finished_files):
+        save_file(*finished)
+    save_file(csv_writer.filename, csv_writer.stats)
+    if save_plot:
+        snapshots.stop()
+
+sys.exit(0)
@@ -0,0 +1,117 @@
+'''
+Crash-safe journal of a scheduled run, for resuming it after an interruption.
+
+The journal is a small JSON file next to the CSV ('<run>_journal.json'). It
+holds the schedule, the steps already completed, the current step with the
+settings written for it and how long it has been running. Every update is
+written to a temporary file, flushed to disk and renamed over the journal,
+so a crash or power cut leaves either the old or the new version, never a
+half-written one.
+
+To resume, V3 loads the journal, reopens the same CSV for appending, checks
+the instrument's settings against the journal and starts the runner at the
+interrupted step with the time already spent in it counted.
+'''
+import json
+import os
+import time
+from Lakeshore_Schedule import Step
+
+
+def journal_path(csv_filename):
+    #'Lakeshore Data/LakeshoreTemp(..)_3.csv' -> 'Lakeshore Data/LakeshoreTemp(..)_3_journal.json'
+    return str(os.path.splitext(csv_filename)[0] + '_journal.json')
+
+
+# Journal setting names -> (SettingsCache.read_back() name, index in it or None)
+READBACK_NAMES = {'heater_range': ('range', None), 'P': ('pid', 0), 'I': ('pid', 1), 'D': ('pid', 2),
+                  'ramp_rate': ('ramp', 1), 'setpoint': ('setpoint', None), 'manual_output': ('manual_output', None)}
+
+
+def device_mismatches(written, device, closed_loop = True):
+    '''Compares the settings a journal says were written with a SettingsCache.read_back().
+
+    Returns {setting: (journal value, instrument value)} for the ones that differ.
+    '''
+    used = ['heater_range'] + (['P', 'I', 'D', 'ramp_rate', 'setpoint'] if closed_loop else ['manual_output'])
+    mismatches = {}
+    for setting in used:
+        if setting not in written:
+            continue
+        name, index = READBACK_NAMES[setting]
+        value = device[name] if index is None else device[name][index]
+        if abs(value - written[setting]) > 1e-4 * max(abs(value), abs(written[setting]), 1e-5):
+            mismatches[setting] = (written[setting], value)
+    return mismatches
+
+
+class RunJournal:
+
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+
+    @classmethod
+    def create(cls, csv_filename, steps, channels, closed_loop):
+        journal = cls(journal_path(csv_filename),
+                      {'csv': csv_filename, 'created': time.time(), 'channels': list(channels),
+                       'closed_loop': closed_loop, 'schedule': [step._asdict() for step in steps],
+                       'completed': [], 'step': 0, 'step_elapsed': 0.0, 'written': {},
+                       'segment': 0, 'finished': False})
+        journal.save()
+        return journal
+
+    @classmethod
+    def load(cls, csv_filename):
+        path = journal_path(csv_filename)
+        with open(path) as file:
+            return cls(path, json.load(file))
+
+    def save(self):
+        #Atomic replace: write a temporary file, force it to disk, then rename it over the journal
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(self.data, file, indent = 1)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.path)
+
+    @property
+    def steps(self):
+        return [Step(**step) for step in self.data['schedule']]
+
+    @property
+    def finished(self):
+        return self.data['finished']
+
+    def check_resume(self, channels, closed_loop):
+        #Refuses (AssertionError) to continue a finished run, or one logged with other channels / loop mode
+        assert(not self.finished),                         str(self.data['csv'] + ' already finished every step')
+        assert(self.data['closed_loop'] == closed_loop),   "CLOSED_LOOP_PID/OPEN_LOOP must match the run being resumed"
+        assert(self.data['channels'] == list(channels)),   "'channels' must match the run being resumed (same CSV columns)"
+
+    def resumed(self):
+        #Call when continuing the run, returns the new segment number (see ColumnarWriter)
+        self.data['segment'] += 1
+        self.save()
+        return self.data['segment']
+
+    # Called by ScheduleRunner
+
+    def step_started(self, index, settings):
+        self.data['step'] = index
+        self.data['written'] = dict(settings)
+        self.data['step_started'] = time.time()
+        self.save()
+
+    def progress(self, index, elapsed):
+        self.data['step'] = index
+        self.data['step_elapsed'] = elapsed
+        self.save()
+
+    def step_finished(self, index, reason, minutes):
+        self.data['completed'].append({'step': index, 'reason': reason, 'minutes': minutes, 'ended': time.time()})
+        self.data['step'] = index + 1
+        self.data['step_elapsed'] = 0.0
+        self.data['finished'] = index + 1 == len(self.data['schedule'])
+        self.save()
@@ -0,0 +1,172 @@
+'''
+Timing instrumentation for the acquisition, storage and plotting threads.
+
+A Metrics object holds one Histogram per operation. Fixed log-spaced buckets
+(10 us to ~17 min, 4 per decade) keep observe() O(log buckets) with no
+allocation, so it can stay on in production. Operations recorded by the
+scripts:
+
+    instrument_read     Lakeshore exchange for one sample       (Sampler)
+    sample_lateness     how late a sample started vs its tick   (Sampler)
+    csv_write           writing + flushing one CSV batch        (CSVWriter)
+    columnar_write      same for the binary copy                (ColumnarWriter)
+    draw                one plot refresh, animate()             (scripts)
+
+summary() is a plain-text table (written next to each run's PNG) and
+prometheus_text() the Prometheus text exposition format, served by
+MetricsServer at /metrics when asked for.
+'''
+import bisect
+import http.server
+import threading
+import time
+
+
+# Bucket upper bounds in seconds, 1e-5 ... 1e3
+BUCKETS = tuple(10 ** (exponent / 4) for exponent in range(-20, 13))
+
+
+class Histogram:
+
+    def __init__(self, bounds = BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)     #Last one is everything above the largest bound
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count > 0 else None
+
+    def quantile(self, q):
+        #Upper bound of the bucket holding the q-th quantile (the max if it is in the last bucket)
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for n, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                return min(self.bounds[n], self.max) if n < len(self.bounds) else self.max
+        return self.max
+
+
+class Metrics:
+    '''Named histograms, safe to record into from any thread.'''
+
+    def __init__(self, prefix = 'lakeshore'):
+        self.prefix = prefix
+        self.histograms = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def timer(self, name):
+        #with metrics.timer('draw'): ...
+        return _Timer(self, name)
+
+    def summary(self):
+        '''Plain-text table, one line per operation, times in milliseconds.'''
+        lines = [str('Timing since ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)) +
+                     ' (ms, percentiles are bucket upper bounds)'),
+                 '%-18s %9s %10s %10s %10s %10s %10s' % ('operation', 'count', 'mean', 'p50', 'p95', 'p99', 'max')]
+        with self.lock:
+            for name in sorted(self.histograms):
+                histogram = self.histograms[name]
+                values = [histogram.mean, histogram.quantile(0.5), histogram.quantile(0.95),
+                          histogram.quantile(0.99), histogram.max]
+                lines.append('%-18s %9d' % (name, histogram.count) +
+                             ''.join(' %10.3f' % (value * 1000) for value in values))
+        return '\n'.join(lines) + '\n'
+
+    def write_summary(self, path):
+        with open(path, 'w') as file:
+            file.write(self.summary())
+
+    def prometheus_text(self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.histograms):
+                histogram = self.histograms[name]
+                metric = str(self.prefix + '_' + name + '_seconds')
+                lines.append(str('# TYPE ' + metric + ' histogram'))
+                cumulative = 0
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{le="%g"} %d' % (metric, bound, cumulative))
+                lines.append('%s_bucket{le="+Inf"} %d' % (metric, histogram.count))
+                lines.append('%s_sum %r' % (metric, histogram.total))
+                lines.append('%s_count %d' % (metric, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+class _Timer:
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    '''Serves metrics.prometheus_text() at http://host:port/metrics.'''
+
+    daemon_threads = True
+
+    def __init__(self, metrics, host = '127.0.0.1', port = 9372):
+        self.metrics = metrics
+        http.server.ThreadingHTTPServer.__init__(self, (host, port), _MetricsHandler)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target = self.serve_forever, daemon = True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
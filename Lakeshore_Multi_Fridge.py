@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Read only logger for several fridges at once.
+
+Every Model372 listed in 'fridges' is read concurrently from one process
+(see Lakeshore_Async), each into its own CSV, all plotted in one window.
+The CSVs are written by CSVWriter threads and, with dashboard_port, one
+browser dashboard shows every fridge from the same sampler.
+
+"""
+
+import matplotlib.pyplot as plt
+from matplotlib.animation import FuncAnimation
+from Lakeshore_Acquisition import drain
+from Lakeshore_Async import ControllerConfig, MultiSampler
+from Lakeshore_Dashboard import DashboardServer
+from Lakeshore_Plot import LivePlot
+from Lakeshore_Storage import CSVWriter, allocate_run, csv_header
+import csv
+import sys
+import datetime as dt
+
+
+#    List every fridge to log, one line each
+'''
+####    NOTE: Always set each Lakeshore to ETHERNET MODE by selecting
+####          "interface" --> "Enabled" --> "Ethernet"
+####          after, copy ip_adress from "View IP_Config <Submenu>"
+####          into its line below.
+'''
+fridges = [ControllerConfig('Fridge 1', '169.254.110.0', [6]),
+           ControllerConfig('Fridge 2', '169.254.25.66', [6]),
+          ]
+
+
+# SET PARAMETERS
+innerloop_wait =      60                        # (MUST BE AN INT) Wait time (seconds) between individual data points
+redraw_wait    =      10                        # Wait time (seconds) between plot refreshes, data is taken regardless
+blit_plot      =      True                      # Only redraw the data lines on each refresh (much faster on long runs)
+loop_runtime   =      1440                      # Length (Minutes) of run
+csv_flush_wait =      60                        # Max time (seconds) rows are kept in memory before being written
+csv_fsync      =      False                     # True forces every write onto the disk (survives a power cut)
+dashboard_port =      None                      # e.g. 8372 to watch every fridge at http://127.0.0.1:8372/ (Lakeshore_Dashboard)
+
+
+
+#Error catching when defining variables
+assert(isinstance(loop_runtime, int)), "'loop_runtime' variabel must be an int"
+assert(isinstance(innerloop_wait, int)), "'innerloop_wait' variable must be an int"
+assert(redraw_wait > 0), "'redraw_wait' variable must be a positive number of seconds"
+assert(len(set(fridge.name for fridge in fridges)) == len(fridges)), "Every fridge needs a different name"
+
+
+
+start_time = dt.datetime.now()
+files = {}
+filenames = {}
+for fridge in fridges:
+    #Files are named "ReadOnly_" + fridge name + "_LakeshoreTemp" + (Today's Date)_ run number
+    filename = str('Lakeshore Data/ReadOnly_' + fridge.name.replace(' ', '') + '_LakeshoreTemp(' +
+                   start_time.strftime('%m') + '-' + start_time.strftime('%d') + '-' +
+                   start_time.strftime('%y') + ')_%s.csv')
+    filenames[fridge.name] = allocate_run(filename)
+
+    files[fridge.name] = open(filenames[fridge.name], 'w', newline='')
+    csv.writer(files[fridge.name]).writerow(csv_header(fridge.channels))
+
+
+
+#One window, one block of subplots per fridge
+plt.style.use('bmh')
+n_axes = sum(len(fridge.channels) for fridge in fridges)
+fig, axs = plt.subplots(n_axes, 1, sharex = True, figsize = (10, 3 + 2 * n_axes), squeeze = False)
+plots = {}
+first_axis = 0
+for fridge in fridges:
+    plots[fridge.name] = LivePlot(fridge.channels, fridge.name, blit = blit_plot,
+                                  axs = axs[first_axis:first_axis + len(fridge.channels), 0])
+    first_axis += len(fridge.channels)
+
+
+
+#All fridges are read on one background thread, each on its own schedule. Every fridge's CSV
+#is written in batches by its own writer thread, so disk latency never delays the plot
+sampler = MultiSampler(fridges, innerloop_wait)
+samples = sampler.subscribe()
+csv_writers = {}
+for fridge in fridges:
+    csv_writers[fridge.name] = CSVWriter(files[fridge.name], sampler.subscribe(controller = fridge.name),
+                                         flush_interval = csv_flush_wait, fsync = csv_fsync)
+    csv_writers[fridge.name].start()
+if dashboard_port is not None:
+    #One page with a section per fridge, any number of browser viewers share one bounded subscription
+    dashboard = DashboardServer({fridge.name: fridge.channels for fridge in fridges}, sampler.subscribe(maxsize = 1000),
+                                port = dashboard_port)
+    dashboard.start()
+sampler.start()
+
+
+
+#Plot every new sample with its fridge (the CSVs are written by csv_writers)
+def record():
+    new_samples = drain(samples)
+    for controller, sample in new_samples:
+        plots[controller].add(sample)
+    return len(new_samples)
+
+
+
+def animate(i):
+    record()
+    artists = []
+    for plot in plots.values():
+        artists.extend(plot.draw())
+    return artists
+
+
+
+temp_data = FuncAnimation(fig, animate, interval = (redraw_wait * 1000), blit = blit_plot,
+                          cache_frame_data = False)
+
+try:
+    print("Begin Measurements\nTaking data from " + str(len(fridges)) + " fridges once every " +
+          str(innerloop_wait) + " seconds.")
+    plt.pause(loop_runtime * 60)
+
+except KeyboardInterrupt:
+    print("Program halted")
+
+finally:
+    sampler.stop()
+    record()
+    for name, csv_writer in csv_writers.items():
+        csv_writer.stop()       #Write out everything queued before the file is closed
+        files[name].close()
+    if dashboard_port is not None:
+        dashboard.stop()
+    #One PNG of the combined plot, "ReadOnly_Fridges_LakeshoreTemp" + (Today's Date)_ run number
+    fig.savefig(allocate_run(str('Lakeshore Data/ReadOnly_Fridges_LakeshoreTemp(' + start_time.strftime('%m') + '-' +
+                                 start_time.strftime('%d') + '-' + start_time.strftime('%y') + ')_%s.png')))
+
+    for name, count in sampler.samples_taken.items():
+        print(name, ': ', count, ' samples')
+    for name, error in sampler.errors.items():
+        print(name, ' last error: ', repr(error), ' (', sampler.reconnects[name], ' reconnect attempts)')
+
+sys.exit(0)
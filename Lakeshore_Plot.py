@@ -0,0 +1,293 @@
+'''
+Live temperature plot shared by the Lakeshore scripts.
+
+The figure is built once: one subplot and one persistent Line2D per channel.
+Each refresh only hands the new data to the lines with set_data, so the
+cost of a frame no longer grows with the length of the run. Axis limits
+are widened in steps (with headroom) and only then is the whole figure
+redrawn; every other frame can be blitted.
+
+The data lives in a fixed-size History (see Lakeshore_Buffer): the last
+'window' samples at full resolution and everything older min/max decimated,
+so neither memory nor frame cost grows on multi-day runs.
+
+Saved PNGs do not have to hold up the window either: LivePlot.snapshot()
+copies the data of a time span and SnapshotRenderer draws it into a
+separate figure (no pyplot) in a worker process, so rendering never takes
+the interpreter away from the sampler. Run on its own, this module is that
+worker.
+'''
+import matplotlib.dates as mdates
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import datetime as dt
+import os
+import pickle
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+from Lakeshore_Buffer import History
+
+
+# matplotlib date number of the Unix epoch, independent of the configured date epoch
+UNIX_EPOCH = mdates.date2num(dt.datetime(1970, 1, 1))
+
+
+def to_local_datenum(timestamps):
+    #Epoch seconds -> matplotlib date numbers in local time (the axis shows local time)
+    offset = time.localtime(float(timestamps[-1])).tm_gmtoff
+    return (timestamps + offset) / 86400.0 + UNIX_EPOCH
+
+
+class LivePlot:
+    '''One subplot + line per channel. Pass 'axs' to draw into axes of an existing
+    figure (e.g. several controllers in one window), otherwise a figure is made.'''
+
+    def __init__(self, channels, title = 'Lakeshore Temperature VS Time', title_color = None,
+                 blit = True, headroom = 0.25, window = 2000, history_bins = 2000, axs = None):
+        self.channels = list(channels)
+        self.blit = blit
+        self.headroom = headroom          #Fraction of the current span added when an axis has to grow
+
+        # Data for the lines, 'window' samples at full resolution + decimated older data
+        self.history = History(len(self.channels), window, history_bins)
+
+        # Running data bounds, updated per sample instead of scanning the whole history
+        self.y_min = [None for channel in self.channels]
+        self.y_max = [None for channel in self.channels]
+
+        if axs is None:
+            plt.style.use('bmh')
+            #Initialize figure, 1 subplot per each channel being measured
+            self.fig, axs = plt.subplots(len(self.channels), 1, sharex = True, figsize = (10,6), squeeze = False)
+            self.axs = list(axs[:, 0])
+        else:
+            self.axs = list(axs)
+            self.fig = self.axs[0].figure
+        self.lines = []
+
+        #Makes graph look nice and neat, this only has to happen once
+        for k in range(len(self.channels)):
+            line, = self.axs[k].plot([], [], animated = blit)
+            self.lines.append(line)
+            self.axs[k].ticklabel_format(style = 'plain', useOffset = False, axis = 'y')
+            self.axs[k].set_ylabel(str('CH. ' + str(self.channels[k]) + ' Temp. (K)'))
+
+        if title_color is None:
+            self.axs[0].set_title(title)
+        else:
+            self.axs[0].set_title(title, color = title_color)
+
+        bottom = self.axs[-1]
+        bottom.tick_params(axis = 'x', labelrotation = 50)
+        bottom.xaxis.set_major_locator(mdates.AutoDateLocator(maxticks = 20))
+        bottom.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M:%S'))
+        if bottom is self.fig.axes[-1]:
+            bottom.set_xlabel('Local Time')
+            self.fig.subplots_adjust(bottom = 0.15, top = 0.92)
+
+        self._limits_set = False
+        self._limits_changed = False
+
+    def add(self, sample):
+        #Store one Sample (see Lakeshore_Acquisition) for the next refresh
+        self.history.append(sample.timestamp, sample.readings)
+        for k in range(len(self.channels)):
+            value = sample.readings[k]
+            if value != value:
+                continue                #NaN marks a gap, drawn as a break in the line
+            if self.y_min[k] is None or value < self.y_min[k]:
+                self.y_min[k] = value
+            if self.y_max[k] is None or value > self.y_max[k]:
+                self.y_max[k] = value
+
+    def _grow(self, axis_limits, low, high, min_span):
+        #Returns new limits if [low, high] does not fit inside axis_limits, otherwise None
+        current_low, current_high = axis_limits
+        if self._limits_set and low >= current_low and high <= current_high:
+            return None
+        span = max(high - low, min_span)
+        return (low - span * self.headroom, high + span * self.headroom)
+
+    def _update_limits(self, x_first, x_last):
+        x_limits = self._grow(self.axs[-1].get_xlim(), x_first, x_last, 1 / 1440)   #1 minute, in days
+        if x_limits is not None:
+            #Time only moves forward, so keep the left edge on the first point
+            self.axs[-1].set_xlim(x_first, x_limits[1])
+            self._limits_changed = True
+
+        for k in range(len(self.channels)):
+            if self.y_min[k] is None:
+                continue                #Nothing but gaps so far
+            y_limits = self._grow(self.axs[k].get_ylim(), self.y_min[k], self.y_max[k],
+                                  abs(self.y_max[k]) * 0.01 or 1e-3)
+            if y_limits is not None:
+                self.axs[k].set_ylim(*y_limits)
+                self._limits_changed = True
+        self._limits_set = True
+
+    def draw(self):
+        '''Push the stored data to the lines, returns the artists for FuncAnimation.'''
+        if len(self.history) == 0:
+            return self.lines
+
+        times, values = self.history.data()
+        x = to_local_datenum(times)
+        for k in range(len(self.channels)):
+            self.lines[k].set_data(x, values[:, k])
+
+        self._update_limits(x[0], x[-1])
+        if self._limits_changed and self.blit:
+            #Ticks/labels changed, render the static parts once so the blit background is fresh
+            self.fig.canvas.draw()
+        self._limits_changed = False
+        return self.lines
+
+    def snapshot(self, start = None, end = None):
+        #Copy of the plotted (times, values) between epoch seconds 'start' and 'end', for SnapshotRenderer
+        times, values = self.history.data()
+        keep = np.ones(len(times), dtype = bool)
+        if start is not None:
+            keep &= times >= start
+        if end is not None:
+            keep &= times <= end
+        return times[keep], values[keep]        #Boolean indexing copies
+
+
+def render_snapshot(path, channels, times, values, title = 'Lakeshore Temperature VS Time', title_color = None):
+    '''Saves the same plot as LivePlot to 'path', drawn without pyplot so any thread can call it.'''
+    fig = Figure(figsize = (10,6))
+    FigureCanvasAgg(fig)
+    axs = fig.subplots(len(channels), 1, sharex = True, squeeze = False)[:, 0]
+    x = to_local_datenum(times) if len(times) > 0 else times
+    for k in range(len(channels)):
+        axs[k].plot(x, values[:, k])
+        axs[k].ticklabel_format(style = 'plain', useOffset = False, axis = 'y')
+        axs[k].set_ylabel(str('CH. ' + str(channels[k]) + ' Temp. (K)'))
+    if title_color is None:
+        axs[0].set_title(title)
+    else:
+        axs[0].set_title(title, color = title_color)
+    axs[-1].tick_params(axis = 'x', labelrotation = 50)
+    axs[-1].xaxis.set_major_locator(mdates.AutoDateLocator(maxticks = 20))
+    axs[-1].xaxis.set_major_formatter(mdates.DateFormatter('%H:%M:%S'))
+    axs[-1].set_xlabel('Local Time')
+    fig.subplots_adjust(bottom = 0.15, top = 0.92)
+    fig.savefig(path)
+
+
+def snapshot_worker(jobs, answers):
+    '''Worker process loop: renders pickled render_snapshot() arguments until 'jobs' is closed.
+
+    One line is answered per job, 'ok' or the error.
+    '''
+    plt.style.use('bmh')            #Same look as LivePlot
+    while True:
+        try:
+            job = pickle.load(jobs)
+        except EOFError:
+            return
+        try:
+            render_snapshot(*job)
+            answers.write(b'ok\n')
+        except Exception as ex:
+            answers.write(str(repr(ex).replace('\n', ' ') + '\n').encode())
+        answers.flush()
+
+
+class SnapshotRenderer(threading.Thread):
+    '''Renders PNGs queued with save() one after another, off the GUI thread.
+
+    With process = True the drawing happens in a separate Python process
+    (this module run as a script) that is sent a compact copy of the data:
+    times as float64, readings as float32. Rendering a long history then
+    never holds the GIL while the sampler needs it; this thread only hands
+    the job over and waits for the answer. If several saves to the same
+    path are waiting, only the newest is drawn.
+    '''
+
+    def __init__(self, channels, title = 'Lakeshore Temperature VS Time', title_color = None, process = True):
+        threading.Thread.__init__(self, daemon = True)
+        self.channels = list(channels)
+        self.title = title
+        self.title_color = title_color
+        self.process = process
+        self.jobs = queue.Queue()
+        self.saved = 0
+        self.skipped = 0                #Superseded by a newer save to the same path
+        self.worker = None
+
+    def save(self, path, times, values):
+        #'times'/'values' must not change afterwards, e.g. from LivePlot.snapshot()
+        self.jobs.put((path, times, values))
+
+    def _start_worker(self):
+        #The worker only ever draws off screen
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__)], stdin = subprocess.PIPE,
+                                stdout = subprocess.PIPE, env = dict(os.environ, MPLBACKEND = 'Agg'))
+
+    def _render(self, path, times, values):
+        if not self.process:
+            render_snapshot(path, self.channels, times, values, self.title, self.title_color)
+            return
+        if self.worker is None or self.worker.poll() is not None:
+            self.worker = self._start_worker()
+        job = (path, self.channels, np.asarray(times, dtype = np.float64), np.asarray(values, dtype = np.float32),
+               self.title, self.title_color)
+        try:
+            pickle.dump(job, self.worker.stdin, protocol = pickle.HIGHEST_PROTOCOL)
+            self.worker.stdin.flush()
+            answer = self.worker.stdout.readline()
+        except OSError:
+            answer = b''
+        if answer != b'ok\n':
+            #An empty answer means the worker died, the next job starts a new one
+            raise RuntimeError(answer.decode().strip() or 'snapshot process stopped')
+
+    def _next_jobs(self):
+        #Waits for a job, then takes every other one queued; returns (jobs, stop)
+        jobs = [self.jobs.get()]
+        while True:
+            try:
+                jobs.append(self.jobs.get_nowait())
+            except queue.Empty:
+                break
+        stop = None in jobs
+        jobs = [job for job in jobs if job is not None]
+        newest = {job[0]: k for k, job in enumerate(jobs)}
+        self.skipped += len(jobs) - len(newest)
+        return [job for k, job in enumerate(jobs) if newest[job[0]] == k], stop
+
+    def run(self):
+        if self.process:
+            self.worker = self._start_worker()      #Started now, so the first PNG does not wait for its imports
+        while True:
+            jobs, stop = self._next_jobs()
+            for path, times, values in jobs:
+                try:
+                    self._render(path, times, values)
+                    self.saved += 1
+                except Exception as ex:
+                    print('Could not save', path, ':', repr(ex))
+            if stop:
+                break
+        if self.worker is not None:
+            self.worker.stdin.close()
+            self.worker.wait()
+
+    def stop(self, timeout = None):
+        #Finishes every queued snapshot first
+        self.jobs.put(None)
+        if self.is_alive():
+            self.join(timeout)
+
+
+if __name__ == '__main__':
+    #Ctrl-C in the console reaches the worker too: it keeps going and stops once the renderer closes 'jobs'
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    snapshot_worker(sys.stdin.buffer, sys.stdout.buffer)
@@ -0,0 +1,448 @@
+'''
+Temperature schedules: a list of steps run against the sample stream.
+
+A step holds the heater settings to use (anything left out carries over
+from the step before), how long to wait before the step counts, and when it
+ends: after 'duration' minutes, once the temperature is 'stable' or has
+'settle'd, whichever comes first. Only settings that differ from
+what the instrument already has are sent (see Lakeshore_Settings).
+
+Step file (.yaml/.yml needs PyYAML, .json needs nothing extra):
+
+    defaults: {heater_range: 5, P: 60, I: 30, D: 6, ramp_rate: 10}
+    steps:
+      - {setpoint: 0.010, duration: 30}
+      - setpoint: 0.020
+        wait: 5                                   # seconds before the step counts
+        duration: 120                             # minutes, at most
+        stable: {within: 0.0005, for: 5}          # ends early: 0.5 mK band for 5 minutes
+      - {setpoint: 0.030, stable: {within: 0.0005, for: 5, channel: 6, setpoint: true}}
+      - setpoint: 0.040
+        duration: 60
+        settle: {window: 3, slope: 0.0001, std: 0.0002, tolerance: 0.001}
+
+'stable' keys: 'within' (K) and 'for' (minutes) are required, 'channel'
+defaults to the first channel read and 'setpoint: true' also requires every
+reading in the band to be within 'within' of the setpoint.
+
+'settle' keys (see SettlingDetector): 'window' (minutes), 'slope' (largest
+|slope|, K/min) and 'std' (largest noise about the trend, K) are required;
+'tolerance' (K) also requires the mean to be that close to the setpoint and
+'channels' (default: every channel read) lists the channels that must settle.
+'''
+import collections
+import json
+import math
+import queue
+import threading
+import time
+from Lakeshore_Acquisition import ConnectionLost, is_gap
+from Lakeshore_Settings import SettingsCache
+
+
+# Heater settings a step can hold, in the order they are written
+SETTINGS = ('heater_range', 'P', 'I', 'D', 'ramp_rate', 'setpoint', 'manual_output')
+
+# One step: 'settings' is complete (carried over values included)
+Step = collections.namedtuple('Step', ['settings', 'wait', 'duration', 'stable', 'name', 'settle'],
+                              defaults = (None,))
+
+
+def make_steps(entries, defaults = None):
+    '''Builds Steps from a list of dicts, each inheriting the settings of the one before.'''
+    steps = []
+    settings = dict(defaults or {})
+    for n, entry in enumerate(entries):
+        unknown = set(entry) - set(SETTINGS) - {'wait', 'duration', 'stable', 'settle', 'name'}
+        assert(len(unknown) == 0), str('Step ' + str(n + 1) + ' has unknown keys: ' + ', '.join(sorted(unknown)))
+        assert(entry.get('duration') is not None or entry.get('stable') is not None or
+               entry.get('settle') is not None), \
+            str('Step ' + str(n + 1) + " needs a 'duration' and/or a 'stable' or 'settle' condition")
+        stable = entry.get('stable')
+        if stable is not None:
+            assert('within' in stable and 'for' in stable), \
+                str('Step ' + str(n + 1) + " 'stable' needs 'within' (K) and 'for' (minutes)")
+        settle = entry.get('settle')
+        if settle is not None:
+            assert('window' in settle and 'slope' in settle and 'std' in settle), \
+                str('Step ' + str(n + 1) + " 'settle' needs 'window' (minutes), 'slope' (K/min) and 'std' (K)")
+
+        settings.update((key, entry[key]) for key in SETTINGS if key in entry)
+        steps.append(Step(dict(settings), entry.get('wait', 0), entry.get('duration'), stable,
+                          entry.get('name', str('Step ' + str(n + 1))), settle))
+    return steps
+
+
+def load_schedule(path):
+    #Returns the Steps of a .json or .yaml/.yml step file
+    with open(path) as file:
+        if path.lower().endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError('YAML step files need PyYAML (pip install pyyaml), or use .json')
+            data = yaml.safe_load(file)
+        else:
+            data = json.load(file)
+    if isinstance(data, list):
+        return make_steps(data)
+    return make_steps(data['steps'], data.get('defaults'))
+
+
+def steps_from_lists(closed_loop, setpoint, setpoint_ramprate, loop_runtime, newloop_wait,
+                     P, I, D, heater_range, manual_output, settle = None):
+    #The scripts' parallel lists as Steps, every step lasting its loop_runtime
+    #(or less, if a 'settle' condition is given for every step)
+    entries = []
+    for j in range(len(loop_runtime)):
+        entry = {'heater_range': heater_range[j], 'wait': newloop_wait[j], 'duration': loop_runtime[j],
+                 'settle': settle}
+        if closed_loop:
+            entry.update({'P': P[j], 'I': I[j], 'D': D[j], 'ramp_rate': setpoint_ramprate[j],
+                          'setpoint': setpoint[j]})
+        else:
+            entry['manual_output'] = manual_output[j]
+        entries.append(entry)
+    return make_steps(entries)
+
+
+class StabilityCondition:
+    '''True once the readings have stayed inside a band 'within' wide for 'period' seconds.
+
+    Keeps the longest recent run of readings that fits in the band, with
+    monotonic min/max queues, so each update is O(1) amortized.
+    '''
+
+    def __init__(self, within, period, around = None):
+        self.within = within
+        self.period = period
+        self.around = around             #If given, every reading must also be within 'within' of it
+        self.times = collections.deque()
+        self.highs = collections.deque()   #(time, value), values decreasing
+        self.lows = collections.deque()    #(time, value), values increasing
+
+    def reset(self):
+        self.times.clear()
+        self.highs.clear()
+        self.lows.clear()
+
+    def update(self, t, value):
+        if self.around is not None and abs(value - self.around) > self.within:
+            self.reset()
+            return False
+
+        while self.highs and self.highs[-1][1] <= value:
+            self.highs.pop()
+        self.highs.append((t, value))
+        while self.lows and self.lows[-1][1] >= value:
+            self.lows.pop()
+        self.lows.append((t, value))
+        self.times.append(t)
+
+        #Drop the oldest readings until the rest fit in the band
+        while self.highs[0][1] - self.lows[0][1] > self.within:
+            oldest = self.times.popleft()
+            if self.highs[0][0] == oldest:
+                self.highs.popleft()
+            if self.lows[0][0] == oldest:
+                self.lows.popleft()
+        return t - self.times[0] >= self.period
+
+
+class SettlingDetector:
+    '''Rolling mean, slope and noise of one channel over the last 'window' seconds.
+
+    Running sums of t, v, t^2, t*v and v^2 are updated as readings enter and
+    leave the window, so each update is O(1) whatever the sample rate. The
+    channel counts as settled once a full window has been seen with |slope| at
+    most 'max_slope' (K/s), the scatter about the fitted line at most 'max_std'
+    (K) and, if 'target' is given, the mean within 'tolerance' of it. 'settled'
+    is set the first time that happens and 'time_to_settle' (seconds since the
+    last reset) is kept.
+    '''
+
+    def __init__(self, window, max_slope, max_std, target = None, tolerance = None):
+        self.window = window
+        self.max_slope = max_slope
+        self.max_std = max_std
+        self.target = target
+        self.tolerance = tolerance
+        self.settled = threading.Event()
+        self.readings = collections.deque()
+        self.start = None
+        self.reset()
+
+    def reset(self, now = None):
+        #Start over, e.g. at a new step; times and values are kept relative to the first reading
+        self.readings.clear()
+        self.n = 0
+        self.sum_t = self.sum_v = self.sum_tt = self.sum_tv = self.sum_vv = 0.0
+        self.start = now
+        self.t0 = None
+        self.v0 = None
+        self.time_to_settle = None
+        self.current = False            #What the last update() returned
+        self.settled.clear()
+
+    def _add(self, t, v, sign):
+        self.n += sign
+        self.sum_t += sign * t
+        self.sum_v += sign * v
+        self.sum_tt += sign * t * t
+        self.sum_tv += sign * t * v
+        self.sum_vv += sign * v * v
+
+    @property
+    def mean(self):
+        return self.v0 + self.sum_v / self.n if self.n > 0 else None
+
+    @property
+    def slope(self):
+        #K/s, least squares over the window
+        spread = self.n * self.sum_tt - self.sum_t ** 2
+        if self.n < 2 or spread <= 0:
+            return None
+        return (self.n * self.sum_tv - self.sum_t * self.sum_v) / spread
+
+    @property
+    def std(self):
+        #Standard deviation of the readings about the fitted line
+        slope = self.slope
+        if slope is None:
+            return None
+        var_t = self.sum_tt / self.n - (self.sum_t / self.n) ** 2
+        var_v = self.sum_vv / self.n - (self.sum_v / self.n) ** 2
+        return math.sqrt(max(var_v - slope ** 2 * var_t, 0.0))
+
+    def update(self, t, value):
+        #Returns True while the channel is settled, a NaN / inf reading is ignored
+        if not math.isfinite(value):
+            return self.current
+        if self.start is None:
+            self.start = t
+        if self.t0 is None:
+            self.t0, self.v0 = t, value
+        x, y = t - self.t0, value - self.v0
+        self.readings.append((x, y))
+        self._add(x, y, 1)
+        while self.readings[0][0] < x - self.window:
+            self._add(*self.readings.popleft(), -1)
+
+        if t - self.start < self.window or self.n < 3:
+            self.current = False
+            return False
+        settled = abs(self.slope) <= self.max_slope and self.std <= self.max_std
+        if settled and self.target is not None:
+            settled = abs(self.mean - self.target) <= self.tolerance
+        if settled and not self.settled.is_set():
+            self.time_to_settle = t - self.start
+            self.settled.set()
+        self.current = settled
+        return settled
+
+
+class ScheduleRunner(threading.Thread):
+    '''Runs 'steps' on its own thread, driven by the samples in 'samples'.
+
+    'samples' is a queue from Sampler.subscribe(); step ends are checked as
+    each sample arrives, so nothing waits on sleep() or plt.pause(). 'step'
+    is the index of the current step and 'finished' is set after the last one
+    (or on an error, kept in 'error'). Pass the sampler to have every Sample
+    tagged with its step index.
+
+    To resume an interrupted run, pass 'start_step' and the seconds already
+    spent in it as 'elapsed'; with a RunJournal (see Lakeshore_Journal) every
+    step start, end and, once a minute, the time spent so far are recorded.
+
+    'settled' is set while the current step's 'settle' channels are all settled
+    (cleared at every new step) and 'time_to_settle' holds, per finished step,
+    the minutes it took to settle (None if it never did or had no condition).
+
+    Gap samples (see Lakeshore_Acquisition.gap_sample) count towards a step's
+    duration but not towards its conditions, and neither do NaN readings or
+    the held values of channels the scanner is not on. If the Lakeshore cannot be
+    reached when a step's settings are written, the runner keeps retrying
+    every 'retry_wait' seconds instead of giving up on the run.
+    '''
+
+    def __init__(self, instrument, steps, samples, channels, closed_loop = True, output = 0, sampler = None,
+                 start_step = 0, elapsed = 0.0, journal = None, progress_interval = 60, retry_wait = 5.0):
+        threading.Thread.__init__(self, daemon = True)
+        self.instrument = instrument
+        self.steps = list(steps)
+        self.samples = samples
+        self.channels = list(channels)
+        self.closed_loop = closed_loop
+        self.output = output
+        self.sampler = sampler
+        self.start_step = start_step
+        self.elapsed = elapsed
+        self.journal = journal
+        self.progress_interval = progress_interval      #Seconds between journal updates within a step
+        self.retry_wait = retry_wait
+        self.step = -1
+        self.step_start = None          #Monotonic time the current step counts from (after its wait)
+        self.condition = None
+        self.condition_channel = 0      #Index in 'channels' of the reading the condition watches
+        #Writes go through a settings cache, so unchanged settings cost no round trip
+        self.settings = instrument if isinstance(instrument, SettingsCache) else SettingsCache(instrument, output)
+        self.step_ends = []             #(step name, 'duration' / 'stable' / 'settled', minutes the step took)
+        self.detectors = []             #(index in 'channels', SettlingDetector) for the current step
+        self.settled = threading.Event()
+        self.time_to_settle = []
+        self.finished = threading.Event()
+        self.error = None
+        self._stop_event = threading.Event()
+
+    @property
+    def writes(self):
+        return self.settings.writes
+
+    @property
+    def writes_skipped(self):
+        return self.settings.writes_skipped
+
+    def apply(self, settings):
+        #Writes the step's settings in SETTINGS order, the cache drops the ones that change nothing
+        cache = self.settings
+        wrote = False
+        if 'heater_range' in settings and cache.set_heater_output_range(self.output, settings['heater_range']):
+            print('Heater Range set to: ', settings['heater_range'])
+            wrote = True
+        if self.closed_loop:
+            if 'P' in settings and cache.set_heater_pid(self.output, settings['P'], settings['I'], settings['D']):
+                print('PID set to: ', 'P: ', settings['P'], 'I: ', settings['I'], 'D: ', settings['D'])
+                wrote = True
+            if 'ramp_rate' in settings and cache.set_setpoint_ramp_parameter(self.output, True, settings['ramp_rate']):
+                print('Setpoint being ramped at a rate of ', settings['ramp_rate'], 'K/min')
+                wrote = True
+            if 'setpoint' in settings and cache.set_setpoint_kelvin(self.output, settings['setpoint']):
+                print('Setpoint set to: ', settings['setpoint'], 'K')
+                wrote = True
+        elif 'manual_output' in settings and cache.set_manual_output(self.output, settings['manual_output']):
+            print('Manual output set to: ', settings['manual_output'], ' percent')
+            wrote = True
+
+        if wrote:
+            #One compound query checks everything that was written
+            for setting, (written, device) in cache.verify(self.output).items():
+                print('WARNING: ', setting, ' was set to ', written, ' but the Lakeshore has ', device)
+
+    def begin(self, index, now, elapsed = 0.0):
+        #'elapsed' > 0 continues a step that already ran that many seconds (no wait)
+        step = self.steps[index]
+        print('Setting new param... (' + step.name + ')\n')
+        if self.sampler is not None:
+            self.sampler.loop = index        #Every sample from here on is tagged with this step
+        self.apply(step.settings)
+        if self.sampler is not None:
+            self.sampler.hurry()             #With an adaptive rate, the transient is sampled fast
+        self.step = index
+        self.step_start = now + step.wait if elapsed == 0 else now - elapsed
+        if self.journal is not None:
+            self.journal.step_started(index, step.settings)
+
+        self.condition = None
+        if step.stable is not None:
+            channel = step.stable.get('channel', self.channels[0])
+            self.condition_channel = self.channels.index(channel)
+            around = step.settings.get('setpoint') if step.stable.get('setpoint', False) else None
+            self.condition = StabilityCondition(step.stable['within'], step.stable['for'] * 60, around)
+
+        self.detectors = []
+        self.settled.clear()
+        if step.settle is not None:
+            target = step.settings.get('setpoint') if 'tolerance' in step.settle else None
+            for channel in step.settle.get('channels', self.channels):
+                self.detectors.append((self.channels.index(channel),
+                                       SettlingDetector(step.settle['window'] * 60, step.settle['slope'] / 60,
+                                                        step.settle['std'], target, step.settle.get('tolerance'))))
+        print('Begin ', step.name, ' (' + str(index + 1) + '/' + str(len(self.steps)) + ')')
+
+    def _begin(self, index, now, elapsed = 0.0):
+        #begin(), retried through link drops. Returns False if stopped before it succeeded
+        while True:
+            try:
+                self.begin(index, now, elapsed)
+                return True
+            except ConnectionLost as ex:
+                self.settings.invalidate()       #Unknown which writes got through
+                print('Could not set ', self.steps[index].name, ' (' + str(ex) + '), retrying in ',
+                      self.retry_wait, ' s')
+                if self._stop_event.wait(self.retry_wait):
+                    return False
+                now = time.monotonic()
+
+    @staticmethod
+    def usable(sample, k):
+        #False for a NaN reading or, with the scanner, the held value of a channel it is not on
+        value = sample.readings[k]
+        return value == value and (sample.fresh is None or sample.fresh[k])
+
+    def step_done(self, now, sample = None):
+        #Returns why the current step is over ('stable' / 'settled' / 'duration'), or None
+        if now < self.step_start:
+            return None
+        step = self.steps[self.step]
+        if sample is not None and sample.monotonic >= self.step_start and not is_gap(sample):
+            if self.condition is not None and self.usable(sample, self.condition_channel):
+                if self.condition.update(sample.monotonic, sample.readings[self.condition_channel]):
+                    return 'stable'
+            if len(self.detectors) > 0:
+                settled = [detector.update(sample.monotonic, sample.readings[k]) if self.usable(sample, k)
+                           else detector.current for k, detector in self.detectors]
+                if all(settled):
+                    self.settled.set()
+                    return 'settled'
+                self.settled.clear()
+        if step.duration is not None and now - self.step_start >= step.duration * 60:
+            return 'duration'
+        return None
+
+    def run(self):
+        try:
+            try:
+                self.settings.refresh(self.output)      #Settings the instrument already has are not written again
+            except ConnectionLost:
+                pass                                    #Everything is written once the link is back
+            if not self._begin(self.start_step, time.monotonic(), self.elapsed):
+                return
+            last_progress = time.monotonic()
+            while not self._stop_event.is_set():
+                try:
+                    sample = self.samples.get(timeout = 0.5)
+                    now = sample.monotonic
+                except queue.Empty:
+                    sample = None
+                    now = time.monotonic()
+
+                reason = self.step_done(now, sample)
+                if reason is None:
+                    if self.journal is not None and now - last_progress >= self.progress_interval:
+                        self.journal.progress(self.step, max(0.0, now - self.step_start))
+                        last_progress = now
+                    continue
+                minutes = (now - self.step_start) / 60
+                if self.journal is not None:
+                    self.journal.step_finished(self.step, reason, minutes)
+                self.step_ends.append((self.steps[self.step].name, reason, minutes))
+                self.time_to_settle.append(minutes if reason == 'settled' else None)
+                print('end', self.steps[self.step].name, '(' + reason + ' after', round(minutes, 1), 'min)\n')
+                if self.step + 1 == len(self.steps):
+                    return
+                if not self._begin(self.step + 1, now):
+                    return
+
+            #Stopped part way through a step, keep how far it got
+            if self.journal is not None:
+                self.journal.progress(self.step, max(0.0, time.monotonic() - self.step_start))
+        except Exception as ex:
+            self.error = ex
+            print('Schedule stopped:', repr(ex))
+        finally:
+            self.finished.set()
+
+    def stop(self, timeout = None):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
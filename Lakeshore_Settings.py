@@ -0,0 +1,113 @@
+'''
+Write-through cache of the Model372 heater settings.
+
+SettingsCache wraps the instrument (plain or LockedInstrument) and keeps the
+last known heater range, PID, setpoint ramp, setpoint and manual output of
+each output. A setter only reaches the instrument when the new value differs
+from the known one, so re-sending a step's unchanged settings costs no round
+trip and no time on the bus the sampler is reading from. Readback is one
+compound query (RANGE?;PID?;RAMP?;SETP?;MOUT?) instead of one per getter.
+Everything else is passed straight through to the instrument.
+'''
+import math
+
+
+# Readback queries, answered in this order separated by ';'
+READBACK = ('RANGE?', 'PID?', 'RAMP?', 'SETP?', 'MOUT?')
+
+
+def same(a, b):
+    #Settings are compared loosely, the instrument rounds what it is sent
+    if isinstance(a, tuple):
+        return len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+    return math.isclose(a, b, rel_tol = 1e-4, abs_tol = 1e-9)
+
+
+class SettingsCache:
+
+    def __init__(self, instrument, output = 0):
+        self.instrument = instrument
+        self.output = output             #Heater output used when none is given
+        self.known = {}                  #(output, setting) -> last value written or read back
+        self.writes = 0
+        self.writes_skipped = 0
+        self.readbacks = 0
+
+    def __getattr__(self, name):
+        return getattr(self.instrument, name)
+
+    def _write(self, output, setting, value, write):
+        #Returns True if the value had to be written
+        key = (output, setting)
+        if key in self.known and same(self.known[key], value):
+            self.writes_skipped += 1
+            return False
+        write()
+        self.known[key] = value
+        self.writes += 1
+        return True
+
+    def invalidate(self):
+        #Forget everything, e.g. after a reconnect or a change from the front panel
+        self.known.clear()
+
+    def set_heater_output_range(self, output, heater_range):
+        value = int(getattr(heater_range, 'value', heater_range))
+        return self._write(output, 'range', value,
+                           lambda: self.instrument.set_heater_output_range(output, heater_range))
+
+    def set_heater_pid(self, output, gain, integral, derivative):
+        return self._write(output, 'pid', (float(gain), float(integral), float(derivative)),
+                           lambda: self.instrument.set_heater_pid(output, gain, integral, derivative))
+
+    def set_setpoint_ramp_parameter(self, output, use_ramp, rate):
+        return self._write(output, 'ramp', (int(bool(use_ramp)), float(rate)),
+                           lambda: self.instrument.set_setpoint_ramp_parameter(output, use_ramp, rate))
+
+    def set_setpoint_kelvin(self, output, value):
+        return self._write(output, 'setpoint', float(value),
+                           lambda: self.instrument.set_setpoint_kelvin(output, value))
+
+    def set_manual_output(self, output, value):
+        return self._write(output, 'manual_output', float(value),
+                           lambda: self.instrument.set_manual_output(output, value))
+
+    def read_back(self, output = None):
+        '''Reads every cached setting of 'output' in one exchange, returns {setting: value}.'''
+        output = self.output if output is None else output
+        message = ';'.join(str(query + ' ' + str(output)) for query in READBACK)
+        responses = self.instrument.query(message).split(';')
+        self.readbacks += 1
+        if len(responses) != len(READBACK):
+            raise ValueError(str('Expected ' + str(len(READBACK)) + ' responses from the Lakeshore, got ' +
+                                 str(len(responses))))
+
+        heater_range, pid, ramp, setpoint, manual_output = [response.strip() for response in responses]
+        ramp = ramp.split(',')
+        return {'range': int(heater_range),
+                'pid': tuple(float(value) for value in pid.split(',')),
+                'ramp': (int(ramp[0]), float(ramp[1])),
+                'setpoint': float(setpoint),
+                'manual_output': float(manual_output)}
+
+    def refresh(self, output = None):
+        #Load the instrument's current settings, so writes that change nothing are skipped from the start
+        output = self.output if output is None else output
+        device = self.read_back(output)
+        for setting, value in device.items():
+            self.known[(output, setting)] = value
+        return device
+
+    def verify(self, output = None):
+        '''Reads the settings back in one exchange and returns the ones that differ
+        from what was written, as {setting: (written, instrument)}. The
+        instrument's values are kept from then on.'''
+        output = self.output if output is None else output
+        device = self.read_back(output)
+        mismatches = {}
+        for setting, value in device.items():
+            key = (output, setting)
+            if key in self.known and not same(self.known[key], value):
+                mismatches[setting] = (self.known[key], value)
+            self.known[key] = value
+        return mismatches
@@ -0,0 +1,363 @@
+'''
+Simulated Lakeshore Model372 for testing and benchmarking without a fridge.
+
+SimulatedModel372 can be used directly in place of Model372 in any script,
+or served on a local TCP port with SimulatorServer, in which case the real
+lakeshore.Model372(9600, ip_address = '127.0.0.1') and AsyncModel372 can
+connect to it. Both answer the same text protocol (KRDG?, HTR?, SETP, PID,
+RAMP, MOUT, RANGE, OUTMODE, SCAN, ...), compound ';' messages included.
+
+Thermal model of the mixing chamber stage:
+    C(T) dT/dt = P_heater - k (T^2 - T_base^2)
+with C(T) = c1 * T and P_heater = (range current * output %)^2 * R.
+In closed loop the heater output comes from a PID on the (optionally ramped)
+setpoint, in open loop it is the manual output.
+
+    python Lakeshore_Simulator.py [port]        serves a simulator on 127.0.0.1
+'''
+import math
+import random
+import socketserver
+import sys
+import threading
+import time
+import types
+
+
+# Full scale current (A) of each sample heater range, index = heater_range value
+HEATER_RANGES = [0.0, 31.6e-6, 100e-6, 316e-6, 1e-3, 3.16e-3, 10e-3, 31.6e-3, 100e-3]
+
+# OUTMODE output modes
+OUTPUT_OFF = 0
+OUTPUT_OPEN_LOOP = 2
+OUTPUT_CLOSED_LOOP = 5
+
+
+def _number(value):
+    #Enums from either version of the lakeshore package, bools or plain numbers -> int
+    if hasattr(value, 'value'):
+        value = value.value
+    return int(value)
+
+
+class ThermalModel:
+
+    def __init__(self, base_temperature = 0.008, cooling = 1e-3, heat_capacity = 0.1,
+                 heater_resistance = 120.0, start_temperature = None):
+        self.base_temperature = base_temperature      #K, where the stage ends up with no heat
+        self.cooling = cooling                        #W/K^2, cooling power = cooling * (T^2 - T_base^2)
+        self.heat_capacity = heat_capacity            #J/K^2, C(T) = heat_capacity * T
+        self.heater_resistance = heater_resistance    #Ohm
+        self.temperature = start_temperature or base_temperature
+
+    def step(self, heater_power, dt):
+        T = self.temperature
+        cooling_power = self.cooling * (T ** 2 - self.base_temperature ** 2)
+        T += (heater_power - cooling_power) / (self.heat_capacity * T) * dt
+        self.temperature = max(T, self.base_temperature * 0.5)
+
+
+class SimulatedModel372:
+    '''In-process fake Model372 with a thermal plant, PID and configurable I/O latency.
+
+    latency / jitter : seconds added to every query (mean and standard deviation)
+    time_scale       : simulated seconds per real second (e.g. 60 to run an hour per minute)
+    noise            : relative standard deviation of the readings
+    temperatures     : {channel: K} fixed temperatures of channels other than the control input
+    '''
+
+    def __init__(self, latency = 0.0, jitter = 0.0, time_scale = 1.0, noise = 1e-4,
+                 temperatures = None, plant = None, seed = None, clock = time.monotonic):
+        self.latency = latency
+        self.jitter = jitter
+        self.time_scale = time_scale
+        self.noise = noise
+        self.temperatures = dict(temperatures or {})
+        self.plant = plant or ThermalModel()
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.lock = threading.RLock()
+        self.max_step = 0.5                         #Longest integration step, simulated seconds
+
+        # Instrument state, as set through the protocol
+        self.outmode = [OUTPUT_OFF, 6, 1, 1, 0, 1]  #mode, input, powerup, polarity, filter, delay
+        self.heater_range = 0
+        self.pid = [10.0, 20.0, 0.0]
+        self.ramp = [0, 0.0]                        #enable, K/min
+        self.setpoint = self.plant.temperature      #Target setpoint
+        self.ramped_setpoint = self.setpoint        #Setpoint the PID is following right now
+        self.manual_output = 0.0
+        self.heater_output = 0.0                    #Percent of range, HTR?
+        self.scanner = [6, 0]                       #channel, autoscan
+        self.inset = {}                             #channel: [enable, dwell, pause, curve, tempco]
+        self.intype = {}                            #channel: INTYPE fields
+        self.last_readings = {}                     #Stale values of channels the scanner is not on
+        self._integral = 0.0
+        self._last_error = None
+        self._last_time = self.clock()
+        self.queries = 0
+
+    # --- Plant ------------------------------------------------------------------------------
+
+    def update(self):
+        #Integrate the plant and the PID up to the current time
+        with self.lock:
+            now = self.clock()
+            elapsed = (now - self._last_time) * self.time_scale
+            self._last_time = now
+            steps = max(1, int(math.ceil(elapsed / self.max_step)))
+            for n in range(steps):
+                self._step(elapsed / steps)
+
+    def _step(self, dt):
+        if dt <= 0:
+            return
+        mode = self.outmode[0]
+        if self.ramp[0] and self.ramp[1] > 0:
+            change = self.ramp[1] / 60.0 * dt
+            difference = self.setpoint - self.ramped_setpoint
+            self.ramped_setpoint += max(-change, min(change, difference))
+        else:
+            self.ramped_setpoint = self.setpoint
+
+        if mode == OUTPUT_CLOSED_LOOP:
+            P, I, D = self.pid
+            error = (self.ramped_setpoint - self.plant.temperature) / max(self.ramped_setpoint, 1e-6)
+            derivative = 0.0 if self._last_error is None else (error - self._last_error) / dt
+            self._last_error = error
+            if I > 0:
+                self._integral += error * dt / I
+            output = P * (error + self._integral + D * derivative)
+            if output > 100 or output < 0:
+                #Anti-windup: do not keep integrating into a saturated output
+                if I > 0:
+                    self._integral -= error * dt / I
+                output = max(0.0, min(100.0, output))
+            self.heater_output = output
+        elif mode == OUTPUT_OPEN_LOOP:
+            self.heater_output = max(0.0, min(100.0, self.manual_output))
+        else:
+            self.heater_output = 0.0
+
+        current = HEATER_RANGES[self.heater_range] * self.heater_output / 100.0
+        self.plant.step(current ** 2 * self.plant.heater_resistance, dt)
+
+    def _reading(self, channel):
+        #Channels without a fixed temperature all sit on the stage
+        channel = str(channel).upper()
+        key = channel if channel == 'A' else int(channel)
+        value = self.temperatures.get(key, self.plant.temperature)
+        return value * (1 + self.random.gauss(0, self.noise))
+
+    # --- Protocol ---------------------------------------------------------------------------
+
+    def handle(self, message):
+        '''Run one (possibly ';' compound) message, returns the response or None for commands.'''
+        responses = []
+        with self.lock:
+            self.update()
+            for part in message.split(';'):
+                part = part.strip()
+                if len(part) == 0:
+                    continue
+                response = self._handle_one(part)
+                if response is not None:
+                    responses.append(response)
+        if len(responses) == 0:
+            return None
+        return ';'.join(responses)
+
+    def _handle_one(self, part):
+        name, _, arguments = part.partition(' ')
+        name = name.upper()
+        args = [a.strip() for a in arguments.split(',')] if arguments else []
+
+        if name.endswith('?'):
+            self.queries += 1
+        if name == '*IDN?':
+            return 'LSCI,MODEL372,SIMULATOR/000000,1.0'
+        if name == 'KRDG?':
+            channel = args[0].upper()
+            if channel != 'A' and int(channel) != self.scanner[0]:
+                #Scanner is elsewhere, the instrument only has the last reading of this channel
+                return '%+.6E' % self.last_readings.get(channel, self._reading(channel))
+            value = self._reading(channel)
+            self.last_readings[channel] = value
+            return '%+.6E' % value
+        if name == 'HTR?':
+            return '%+.4E' % self.heater_output
+        if name == 'SETP?':
+            return '%+.6E' % self.setpoint
+        if name == 'SETP':
+            self.setpoint = float(args[1])
+            if not self.ramp[0]:
+                self.ramped_setpoint = self.setpoint
+            return None
+        if name == 'PID?':
+            return '%g,%g,%g' % tuple(self.pid)
+        if name == 'PID':
+            self.pid = [float(value) for value in args[1:4]]
+            self._integral = 0.0
+            return None
+        if name == 'RAMP?':
+            return '%d,%g' % (self.ramp[0], self.ramp[1])
+        if name == 'RAMP':
+            self.ramp = [int(args[1]), float(args[2])]
+            if not self.ramp[0]:
+                self.ramped_setpoint = self.setpoint
+            return None
+        if name == 'MOUT?':
+            return '%g' % self.manual_output
+        if name == 'MOUT':
+            self.manual_output = float(args[1])
+            return None
+        if name == 'RANGE?':
+            return str(self.heater_range)
+        if name == 'RANGE':
+            self.heater_range = int(args[1])
+            return None
+        if name == 'OUTMODE?':
+            return ','.join(str(value) for value in self.outmode)
+        if name == 'OUTMODE':
+            self.outmode = [int(args[1]), int(args[2]) if args[2].upper() != 'A' else 'A'] + \
+                           [int(value) for value in args[3:7]]
+            self._integral = 0.0
+            return None
+        if name == 'SCAN?':
+            return '%d,%d' % tuple(self.scanner)
+        if name == 'SCAN':
+            self.scanner = [int(args[0]), int(args[1])]
+            return None
+        if name == 'INSET?':
+            return ','.join(str(value) for value in self.inset.get(args[0].upper(), [1, 1, 3, 0, 1]))
+        if name == 'INSET':
+            self.inset[args[0].upper()] = [int(value) for value in args[1:6]]
+            return None
+        if name == 'INTYPE?':
+            return ','.join(str(value) for value in self.intype.get(args[0].upper(), [0, 5, 1, 22, 0, 1]))
+        if name == 'INTYPE':
+            self.intype[args[0].upper()] = [int(value) for value in args[1:7]]
+            return None
+        if name.endswith('?'):
+            return '0'
+        return None             #Other commands (EMUL 0, ...) are accepted and ignored
+
+    def _delay(self):
+        if self.latency > 0 or self.jitter > 0:
+            time.sleep(max(0.0, self.random.gauss(self.latency, self.jitter)))
+
+    def query(self, query_string):
+        self._delay()
+        return self.handle(query_string) or ''
+
+    def command(self, command_string):
+        self.handle(command_string)
+
+    # --- Same calls as lakeshore.Model372 ---------------------------------------------------
+
+    def get_kelvin_reading(self, input_channel):
+        return float(self.query(str('KRDG? ' + str(input_channel))))
+
+    def get_heater_output(self, output):
+        return float(self.query(str('HTR? ' + str(output))))
+
+    def get_setpoint_kelvin(self, output_channel):
+        return float(self.query(str('SETP? ' + str(output_channel))))
+
+    def set_setpoint_kelvin(self, output_channel, setpoint):
+        self.command(str('SETP ' + str(output_channel) + ',' + str(setpoint)))
+
+    def set_setpoint_ramp_parameter(self, output, ramp_enable, rate_value):
+        self.command(str('RAMP ' + str(output) + ',' + str(int(ramp_enable)) + ',' + str(rate_value)))
+
+    def set_heater_pid(self, output, gain, integral, derivative):
+        self.command(str('PID ' + str(output) + ',' + str(gain) + ',' + str(integral) + ',' + str(derivative)))
+
+    def get_heater_pid(self, output):
+        values = [float(value) for value in self.query(str('PID? ' + str(output))).split(',')]
+        #Older lakeshore versions (the ones the scripts were written for) call D 'ramp_rate'
+        return {'gain': values[0], 'integral': values[1], 'derivative': values[2], 'ramp_rate': values[2]}
+
+    def set_manual_output(self, output, value):
+        self.command(str('MOUT ' + str(output) + ',' + str(value)))
+
+    def get_manual_output(self, output):
+        return float(self.query(str('MOUT? ' + str(output))))
+
+    def set_heater_output_range(self, output_channel, heater_range):
+        self.command(str('RANGE ' + str(output_channel) + ',' + str(_number(heater_range))))
+
+    def get_heater_output_range(self, output_channel):
+        return int(self.query(str('RANGE? ' + str(output_channel))))
+
+    def configure_heater(self, output_channel, settings):
+        input_channel = settings.input_channel
+        input_channel = getattr(input_channel, 'value', input_channel)
+        polarity = 0 if settings.polarity is None else _number(settings.polarity)
+        self.command(str('OUTMODE ' + str(output_channel) + ',' + str(_number(settings.output_mode)) + ',' +
+                         str(input_channel) + ',' + str(int(settings.powerup_enable)) + ',' +
+                         str(polarity) + ',' + str(int(settings.reading_filter)) + ',' + str(settings.delay)))
+
+    def get_scanner_status(self):
+        channel, status = self.query('SCAN?').split(',')
+        return {'input_channel': int(channel), 'status': bool(int(status))}
+
+    def set_scanner_status(self, input_channel, status):
+        self.command(str('SCAN ' + str(input_channel) + ',' + str(int(status))))
+
+    def get_input_channel_parameters(self, input_channel):
+        values = [int(value) for value in self.query(str('INSET? ' + str(input_channel))).split(',')]
+        return types.SimpleNamespace(enable = bool(values[0]), dwell_time = values[1], pause_time = values[2],
+                                     curve_number = values[3], temperature_coefficient = values[4])
+
+
+class _SimulatorHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        simulator = self.server.simulator
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            message = line.decode('utf-8').strip()
+            if len(message) == 0:
+                continue
+            response = simulator.handle(message)
+            if response is not None:
+                simulator._delay()
+                self.wfile.write(response.encode('utf-8') + b'\r\n')
+
+
+class SimulatorServer(socketserver.ThreadingTCPServer):
+    '''Serves a SimulatedModel372 on a TCP port, like the instrument's Ethernet interface.'''
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, simulator = None, host = '127.0.0.1', port = 7777):
+        self.simulator = simulator or SimulatedModel372()
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), _SimulatorHandler)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        #Serve on a background thread, returns the thread
+        thread = threading.Thread(target = self.serve_forever, daemon = True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 7777
+    server = SimulatorServer(port = port)
+    print('Simulated Model372 on 127.0.0.1:' + str(server.port) + ', Ctrl-C to stop')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
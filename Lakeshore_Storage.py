@@ -0,0 +1,518 @@
+'''
+Writing acquired samples to disk.
+
+CSVWriter runs on its own thread and consumes Samples from a Sampler
+subscription. Rows are collected in memory and written out in one batch
+every 'flush_rows' rows or 'flush_interval' seconds, whichever comes first,
+so a slow disk or network share never delays a reading. With fsync = True
+every batch is also forced onto the disk, so a power cut loses at most the
+last flush_interval seconds.
+
+RotatingCSVWriter is a CSVWriter that starts a new file every so many
+minutes or bytes by itself. The switch happens between two consecutive
+samples on the writer thread, so continuous logging never pauses the
+sampler and no sample falls between two files.
+
+RunStats summarizes what a writer wrote (time span, per-channel count, min,
+max, mean) as it goes, for the run catalog (see Lakeshore_Catalog).
+
+ColumnarWriter does the same for a binary copy of the data: fixed-size
+records (float64 epoch time, loop and segment index, heater output,
+setpoint and one float64 per channel) appended to a .bin file, described by
+a .json file next to it. load_columnar() memory-maps the records, so even a
+month of 1 Hz data opens in milliseconds and only the columns used are read.
+
+RotatingDeltaWriter is a compressed alternative to the CSV for long
+unattended runs (.dlt files). A channel's reading is only stored when it
+has moved by more than its deadband since the last one stored, or after
+'max_interval' seconds; the others are held. Stored values are quantized
+and delta encoded, and the stream is zlib compressed, flushed at every
+batch. load_delta() rebuilds every sample, in the same records as
+load_columnar().
+'''
+import csv
+import datetime as dt
+import json
+import os
+import queue
+import re
+import struct
+import threading
+import time
+import zlib
+import numpy as np
+
+
+def allocate_run(pattern):
+    '''Reserves and returns the next free file name for 'pattern' (one '%s' for the run number).
+
+    The directory is listed once and numbering carries on after the highest run
+    already in it. The name is reserved by creating the (empty) file exclusively,
+    so two scripts starting at the same time never get the same run.
+    '''
+    directory, name = os.path.split(pattern)
+    prefix, suffix = name.split('%s')
+    run_name = re.compile(re.escape(prefix) + r'(\d+)' + re.escape(suffix) + '$')
+    runs = [int(match.group(1)) for match in map(run_name.match, os.listdir(directory or '.')) if match]
+    run = max(runs, default = 0) + 1
+    while True:
+        try:
+            os.close(os.open(pattern % run, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))     #rw, less the umask
+            return pattern % run
+        except FileExistsError:
+            run += 1        #Taken since the listing, try the next one
+
+
+def time_row(sample):
+    #The scripts' CSV layout: local time (accurate to seconds), then one column per channel
+    return [dt.datetime.fromtimestamp(sample.timestamp).strftime('%H:%M:%S')] + list(sample.readings)
+
+
+class RunStats:
+    '''Running summary of the samples written to one file.
+
+    Gap samples (see Lakeshore_Acquisition.gap_sample) and readings the
+    scanner marked stale are left out of the per-channel numbers.
+    '''
+
+    def __init__(self, channels):
+        self.channels = list(channels)
+        n = len(self.channels)
+        self.samples = 0
+        self.gaps = 0
+        self.started = None             #Epoch seconds of the first and last sample
+        self.ended = None
+        self.count = [0] * n
+        self.min = [None] * n
+        self.max = [None] * n
+        self.total = [0.0] * n
+        self.first = [None] * n         #First and last reading of each channel
+        self.last = [None] * n
+
+    def add(self, sample):
+        self.samples += 1
+        if self.started is None:
+            self.started = sample.timestamp
+        self.ended = sample.timestamp
+        read = False
+        for k, value in enumerate(sample.readings):
+            if value != value or (sample.fresh is not None and not sample.fresh[k]):
+                continue
+            read = True
+            self.count[k] += 1
+            self.total[k] += value
+            if self.min[k] is None or value < self.min[k]:
+                self.min[k] = value
+            if self.max[k] is None or value > self.max[k]:
+                self.max[k] = value
+            if self.first[k] is None:
+                self.first[k] = value
+            self.last[k] = value
+        if not read:
+            self.gaps += 1
+
+    def channel_summary(self):
+        #One dict per channel, the catalog's columns
+        return [{'channel': str(channel), 'count': self.count[k], 'min': self.min[k], 'max': self.max[k],
+                 'mean': self.total[k] / self.count[k] if self.count[k] > 0 else None,
+                 'first': self.first[k], 'last': self.last[k]}
+                for k, channel in enumerate(self.channels)]
+
+
+class BatchedWriter(threading.Thread):
+    '''Collects rows from a sample queue and hands them to write_rows() in batches.'''
+
+    metric = 'write'            #Name of the batch write time in a Metrics (see Lakeshore_Metrics)
+
+    def __init__(self, file, samples, flush_rows = 100, flush_interval = 5.0, fsync = False, metrics = None):
+        threading.Thread.__init__(self, daemon = True)
+        self.file = file                      #Open file, written and flushed from this thread only
+        self.samples = samples                #Queue from Sampler.subscribe()
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.metrics = metrics
+        self.rows_written = 0
+        self.flushes = 0
+        self.max_flush_time = 0.0
+        self._stop_event = threading.Event()
+
+    def row(self, sample):
+        raise NotImplementedError
+
+    def write_rows(self, rows):
+        raise NotImplementedError
+
+    def write(self, rows):
+        start = time.monotonic()
+        self.write_rows(rows)
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        elapsed = time.monotonic() - start
+        self.rows_written += len(rows)
+        self.flushes += 1
+        self.max_flush_time = max(self.max_flush_time, elapsed)
+        if self.metrics is not None:
+            self.metrics.observe(self.metric, elapsed)
+
+    def run(self):
+        pending = []
+        last_flush = time.monotonic()
+        while True:
+            stopping = self._stop_event.is_set()
+            wait = max(0.0, min(0.5, last_flush + self.flush_interval - time.monotonic()))
+            try:
+                pending.append(self.row(self.samples.get(timeout = 0 if stopping else wait)))
+                while True:
+                    pending.append(self.row(self.samples.get_nowait()))
+            except queue.Empty:
+                pass
+
+            now = time.monotonic()
+            if len(pending) > 0 and (stopping or len(pending) >= self.flush_rows or
+                                     now - last_flush >= self.flush_interval):
+                self.write(pending)
+                pending = []
+                last_flush = now
+            elif len(pending) == 0:
+                last_flush = now
+
+            if stopping and self.samples.empty():
+                return
+
+    def stop(self, timeout = None):
+        #Writes out everything already queued before the thread ends
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+
+class CSVWriter(BatchedWriter):
+
+    metric = 'csv_write'
+
+    def __init__(self, file, samples, flush_rows = 100, flush_interval = 5.0, fsync = False, row = time_row,
+                 metrics = None, stats = None):
+        #'file' is an open text file, the header is written and the file closed by the caller
+        BatchedWriter.__init__(self, file, samples, flush_rows, flush_interval, fsync, metrics)
+        self.format_row = row
+        self.stats = stats              #Optional RunStats, updated with every sample written
+        self.writer = csv.writer(file)
+
+    def row(self, sample):
+        if self.stats is not None:
+            self.stats.add(sample)
+        return self.format_row(sample)
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+
+
+def csv_header(channels):
+    #The scripts' header row, matching time_row()
+    return ['Time:'] + [str('CH. ' + str(channel) + ' (K):') for channel in channels]
+
+
+class RotatingCSVWriter(CSVWriter):
+    '''Writes to a new CSV every 'rotate_minutes' and/or 'rotate_bytes'.
+
+    new_file(timestamp) returns the (already reserved) name of the file that
+    starts with the sample taken at 'timestamp', e.g. through allocate_run().
+    The first file is made right away and is in 'filename'. A file is due
+    for rotation once the next sample is 'rotate_minutes' after the file's
+    first one, or once a batch leaves it over 'rotate_bytes'; that sample is
+    the first row of the next file. Files are switched as batches are
+    written, so a file is closed at most 'flush_interval' seconds after its
+    last sample. on_rotate(filename, stats) is called from this thread with
+    each finished file and the RunStats of its rows; the current file's are
+    in 'stats'. The writer owns its files and closes them.
+    '''
+
+    def __init__(self, new_file, header, samples, rotate_minutes = None, rotate_bytes = None, on_rotate = None,
+                 flush_rows = 100, flush_interval = 5.0, fsync = False, row = time_row, metrics = None,
+                 channels = None):
+        #'channels' names the columns in the RunStats, by default they are numbered from 1
+        self.new_file = new_file
+        self.header = header
+        self.rotate_seconds = None if rotate_minutes is None else rotate_minutes * 60
+        self.rotate_bytes = rotate_bytes
+        self.on_rotate = on_rotate
+        self.channels = list(channels) if channels is not None else list(range(1, len(header)))
+        self.filename = new_file(time.time())
+        self.rotations = 0
+        self._full = False              #Set when the current file passed rotate_bytes
+        CSVWriter.__init__(self, self._open(self.filename), samples, flush_rows, flush_interval, fsync,
+                           lambda sample: (sample, row(sample)), metrics, RunStats(self.channels))
+
+    def row(self, sample):
+        #Stats are kept in write_rows(), where the file each sample goes to is known
+        return self.format_row(sample)
+
+    def _open(self, filename):
+        file = open(filename, 'w', newline = '')
+        self.writer = csv.writer(file)
+        self.writer.writerow(self.header)
+        return file
+
+    def _close(self):
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.file.close()
+
+    def _due(self, timestamp):
+        if self.stats.started is None:
+            return False
+        return self._full or (self.rotate_seconds is not None and
+                              timestamp - self.stats.started >= self.rotate_seconds)
+
+    def _rotate(self, timestamp):
+        finished, stats = self.filename, self.stats
+        self._close()
+        self.filename = self.new_file(timestamp)
+        self.file = self._open(self.filename)
+        self.stats = RunStats(self.channels)
+        self._full = False
+        self.rotations += 1
+        if self.on_rotate is not None:
+            self.on_rotate(finished, stats)
+
+    def write_rows(self, rows):
+        #rows are (sample, row); split the batch wherever a new file is due
+        start = 0
+        for k, (sample, row) in enumerate(rows):
+            if self._due(sample.timestamp):
+                self._write(rows[start:k])
+                self._rotate(sample.timestamp)
+                start = k
+            self.stats.add(sample)
+        self._write(rows[start:])
+        if self.rotate_bytes is not None and self.file.tell() >= self.rotate_bytes:
+            self._full = True
+
+    def _write(self, rows):
+        #(sample, row) pairs, all for the current file
+        self.writer.writerows([row for sample, row in rows])
+
+    def stop(self, timeout = None):
+        CSVWriter.stop(self, timeout)
+        self._close()
+
+
+def columnar_dtype(channels):
+    #One fixed-size record per sample
+    fields = [('time', '<f8'), ('loop', '<i4'), ('segment', '<i4'),
+              ('heater_output', '<f8'), ('setpoint', '<f8')]
+    for channel in channels:
+        fields.append((str('ch' + str(channel)), '<f8'))
+    return np.dtype(fields)
+
+
+class ColumnarWriter(BatchedWriter):
+    '''Appends samples to '<base>.bin' and describes them in '<base>.json'.
+
+    Opening an existing file appends to it (the metadata must match), so a
+    resumed run keeps one file; use a new 'segment' number for each restart.
+    '''
+
+    metric = 'columnar_write'
+
+    def __init__(self, base, channels, samples, segment = 0, metadata = None,
+                 flush_rows = 100, flush_interval = 5.0, fsync = False, metrics = None):
+        self.channels = list(channels)
+        self.dtype = columnar_dtype(self.channels)
+        self.segment = segment
+        self.data_path = str(base + '.bin')
+        self.metadata_path = str(base + '.json')
+
+        description = {'format': 'Lakeshore columnar v1',
+                       'dtype': [list(field) for field in self.dtype.descr],
+                       'channels': [str(channel) for channel in self.channels],
+                       'columns': {'time': 'epoch seconds (UTC)',
+                                   'loop': 'index of the loop/step (-1 = none)',
+                                   'segment': 'acquisition segment, new after each restart',
+                                   'heater_output': 'percent of range',
+                                   'setpoint': 'K'},
+                       'units': {str('ch' + str(channel)): 'K' for channel in self.channels},
+                       'created': time.time()}
+        description.update(metadata or {})
+
+        if os.path.exists(self.metadata_path):
+            with open(self.metadata_path) as existing:
+                existing = json.load(existing)
+            assert(existing['dtype'] == description['dtype']), \
+                str(self.metadata_path + ' has different columns, use a new file name')
+        else:
+            with open(self.metadata_path, 'w') as metadata_file:
+                json.dump(description, metadata_file, indent = 2)
+
+        BatchedWriter.__init__(self, open(self.data_path, 'ab'), samples, flush_rows, flush_interval, fsync, metrics)
+
+    def row(self, sample):
+        return ((sample.timestamp, -1 if getattr(sample, 'loop', None) is None else sample.loop, self.segment,
+                 np.nan if sample.heater_output is None else sample.heater_output,
+                 np.nan if sample.setpoint is None else sample.setpoint) + tuple(sample.readings))
+
+    def write_rows(self, rows):
+        np.array(rows, dtype = self.dtype).tofile(self.file)
+
+    def stop(self, timeout = None):
+        BatchedWriter.stop(self, timeout)
+        self.file.close()
+
+
+def load_columnar(base):
+    '''Returns (records, metadata) for '<base>.bin' / '<base>.json'.
+
+    'records' is a read-only np.memmap of structured records: records['time'],
+    records['ch6'], ... A record cut short by a crash at the end is ignored.
+    '''
+    with open(str(base + '.json')) as metadata_file:
+        metadata = json.load(metadata_file)
+    dtype = np.dtype([tuple(field) for field in metadata['dtype']])
+    n_records = os.path.getsize(str(base + '.bin')) // dtype.itemsize
+    if n_records == 0:
+        return np.zeros(0, dtype = dtype), metadata
+    return np.memmap(str(base + '.bin'), dtype = dtype, mode = 'r', shape = (n_records,)), metadata
+
+
+DELTA_MAGIC = b'LSDELTA1\n'
+# Everything in a sample other than the channels, stored like a channel without deadband
+DELTA_SERIES = ('loop', 'segment', 'heater_output', 'setpoint')
+
+
+def delta_record_dtype(n_series):
+    #One record per sample in the (compressed) stream: ms since the previous sample (the first
+    #one since the epoch), bit k of 'written' set when series k was stored, of 'nan' when that
+    #was a NaN, and the change of each stored series in quanta (0 when it was not stored)
+    return np.dtype([('dt', '<i8'), ('written', '<u8'), ('nan', '<u8')] +
+                    [(str('d' + str(k)), '<i8') for k in range(n_series)])
+
+
+class RotatingDeltaWriter(RotatingCSVWriter):
+    '''Writes samples to compressed, deadband filtered .dlt files (rotating like RotatingCSVWriter).
+
+    A channel's reading is stored when it differs from the last one stored
+    by more than its 'deadband' (K, one number or {channel: K}), when
+    'max_interval' seconds have passed since, and around gaps; otherwise
+    the last one is held. Loop, segment, heater output and setpoint are
+    stored whenever they change. Readings are rounded to 'quantum' (K), which
+    is far below the instrument's resolution, so deadband = 0 only drops
+    repeated values and is lossless.
+
+    A file is a short header (DELTA_MAGIC, the JSON length and a JSON
+    description) followed by one zlib stream of delta_record_dtype()
+    records, sync flushed at every batch, so a crash loses at most the last
+    'flush_interval' seconds. Every file starts from scratch and reads on
+    its own. Read them with load_delta().
+    '''
+
+    metric = 'delta_write'
+
+    def __init__(self, new_file, channels, samples, deadband = 0, max_interval = None, quantum = 1e-9,
+                 rotate_minutes = None, rotate_bytes = None, on_rotate = None, flush_rows = 100,
+                 flush_interval = 5.0, fsync = False, metrics = None, segment = 0, metadata = None):
+        channels = list(channels)
+        if not isinstance(deadband, dict):
+            deadband = {channel: deadband for channel in channels}
+        self.series = list(DELTA_SERIES) + [str('ch' + str(channel)) for channel in channels]
+        self.quantum = [1, 1, 1e-4, 1e-9] + [quantum] * len(channels)
+        self.deadband = [0] * len(DELTA_SERIES) + [deadband.get(channel, 0) for channel in channels]
+        self.max_interval = max_interval
+        self.segment = segment
+        self.record_dtype = delta_record_dtype(len(self.series))
+        self.description = {'format': 'Lakeshore delta v1',
+                            'dtype': [list(field) for field in columnar_dtype(channels).descr],
+                            'channels': [str(channel) for channel in channels],
+                            'series': self.series, 'quantum': self.quantum, 'deadband': self.deadband,
+                            'max_interval': max_interval}
+        self.description.update(metadata or {})
+        RotatingCSVWriter.__init__(self, new_file, None, samples, rotate_minutes, rotate_bytes, on_rotate,
+                                   flush_rows, flush_interval, fsync, lambda sample: None, metrics, channels)
+
+    def _open(self, filename):
+        #New file: header, then a fresh zlib stream and deadband state
+        header = json.dumps(dict(self.description, created = time.time())).encode()
+        file = open(filename, 'wb')
+        file.write(DELTA_MAGIC + struct.pack('<I', len(header)) + header)
+        self.compressor = zlib.compressobj()
+        self._last_ms = 0
+        self._last = [None] * len(self.series)          #Last value stored, in quanta
+        self._stored_at = [None] * len(self.series)     #and when
+        self._nan = [False] * len(self.series)          #True while the last thing stored is a NaN
+        return file
+
+    def _close(self):
+        self.file.write(self.compressor.flush(zlib.Z_FINISH))
+        RotatingCSVWriter._close(self)
+
+    def values(self, sample):
+        #One value per series
+        return ([-1 if getattr(sample, 'loop', None) is None else sample.loop, self.segment,
+                 np.nan if sample.heater_output is None else sample.heater_output,
+                 np.nan if sample.setpoint is None else sample.setpoint] + list(sample.readings))
+
+    def _write(self, rows):
+        records = np.zeros(len(rows), dtype = self.record_dtype)
+        for n, (sample, row) in enumerate(rows):
+            ms = int(round(sample.timestamp * 1000))
+            records['dt'][n] = ms - self._last_ms
+            self._last_ms = ms
+            written = 0
+            nan = 0
+            for k, value in enumerate(self.values(sample)):
+                if value != value:
+                    if not self._nan[k]:
+                        written |= 1 << k
+                        nan |= 1 << k
+                        self._nan[k] = True
+                    continue
+                quantized = int(round(value / self.quantum[k]))
+                last = self._last[k]
+                if last is None or self._nan[k] or abs(quantized - last) * self.quantum[k] > self.deadband[k] or \
+                        (self.max_interval is not None and k >= len(DELTA_SERIES) and
+                         sample.timestamp - self._stored_at[k] >= self.max_interval):
+                    written |= 1 << k
+                    records[str('d' + str(k))][n] = quantized - (0 if last is None else last)
+                    self._last[k] = quantized
+                    self._stored_at[k] = sample.timestamp
+                    self._nan[k] = False
+            records['written'][n] = written
+            records['nan'][n] = nan
+        self.file.write(self.compressor.compress(records.tobytes()) + self.compressor.flush(zlib.Z_SYNC_FLUSH))
+
+
+def load_delta(path):
+    '''Returns (records, metadata) of a .dlt file from RotatingDeltaWriter.
+
+    'records' holds every sample taken, in the same structured records as
+    load_columnar(): records['time'], records['ch6'], ... Readings that were
+    not stored (inside the deadband) are the last one stored. A stream cut
+    short by a crash is read up to its last complete sample.
+    '''
+    with open(path, 'rb') as file:
+        data = file.read()
+    assert(data.startswith(DELTA_MAGIC)), str(path + ' is not a Lakeshore delta file')
+    start = len(DELTA_MAGIC) + 4
+    length, = struct.unpack_from('<I', data, len(DELTA_MAGIC))
+    metadata = json.loads(data[start:start + length].decode())
+    raw = zlib.decompressobj().decompress(data[start + length:])
+
+    record_dtype = delta_record_dtype(len(metadata['series']))
+    stream = np.frombuffer(raw, dtype = record_dtype, count = len(raw) // record_dtype.itemsize)
+    records = np.zeros(len(stream), dtype = np.dtype([tuple(field) for field in metadata['dtype']]))
+    records['time'] = np.cumsum(stream['dt']) / 1000
+    index = np.arange(len(stream))
+    for k, (name, quantum) in enumerate(zip(metadata['series'], metadata['quantum'])):
+        written = (stream['written'] >> np.uint64(k)) & np.uint64(1) == 1
+        nan = (stream['nan'] >> np.uint64(k)) & np.uint64(1) == 1
+        #Unstored samples have a change of 0, so the running sum holds the last value stored
+        values = np.cumsum(stream[str('d' + str(k))]) * quantum
+        last_stored = np.maximum.accumulate(np.where(written, index, -1)) if len(stream) > 0 else index
+        missing = (last_stored < 0) | nan[np.maximum(last_stored, 0)]
+        if records.dtype[name].kind == 'f':
+            records[name] = np.where(missing, np.nan, values)
+        else:
+            records[name] = np.where(missing, -1, np.round(values))
+    return records, metadata
@@ -3,14 +3,15 @@ Created on September 5th, 2021
 Author: Christopher Cravey
 Lab: Dominique Laroche @ UF
 '''
-from matplotlib import ticker
 import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation
 from lakeshore import Model372
 from lakeshore.model_372 import Model372HeaterOutputSettings, \
 Model372OutputMode, Model372Polarity
+from Lakeshore_Acquisition import LockedInstrument, Sampler, drain
+from Lakeshore_Plot import LivePlot
+from Lakeshore_Storage import CSVWriter, allocate_run
 import csv
-import os
 import datetime as dt
 import time
 start_time = dt.datetime.now()
@@ -23,6 +24,7 @@ start_time = dt.datetime.now()
 ####          into my_instrument below.
 '''
 my_instrument = Model372(9600, ip_address = '169.254.81.60')
+my_instrument = LockedInstrument(my_instrument)    #Shared by the sampler thread and the loop below
 
 
 #ENTER CUSTOM FILENAME
@@ -50,6 +52,8 @@ setpoint = [0.015, 0.001, 0.01]       # Must be in Kelvin
 loop_runtime = [0.2, 0.2, 0.2]      # Length (Minutes) of each loop
 newloop_wait = [5, 5, 5]            # Wait time (seconds) before taking data from a new loop
 innerloop_wait = 3                  # Wait time (seconds) between individual data points
+redraw_wait = 3                     # Wait time (seconds) between plot refreshes, data is taken regardless
+blit_plot = True                    # Only redraw the data lines on each refresh (much faster on long runs)
 
 
 P = [80, 80, 80]                    
@@ -72,23 +76,17 @@ heater_range = [0, 0, 0]
 
 
 
-#Search Lakeshore Data for the same filename and increment if it already exists
-def run_number(filename):
-    run = 1
-    while os.path.exists(filename % run):
-        run += 1
-    return filename % run
 
 #If left empty the file will automatically be named "LakeshoreTemp" + (Today's Date)_ run number
 if len(filename) == 0:
     filename = str('Lakeshore Data/LakeshoreTemp(' + start_time.strftime('%m') + '-' +\
                    start_time.strftime('%d') + '-' + start_time.strftime('%y') + ')_%s.csv')
-    filename = run_number(filename)     #add index number to filename
+    filename = allocate_run(filename)     #add the next free run number to filename
     
 else:
     filename = str('Lakeshore Data/' + filename + ('_%s.csv'))
     
-    filename = run_number(filename)     #add index number to filename
+    filename = allocate_run(filename)     #add the next free run number to filename
 
 
 
@@ -107,57 +105,43 @@ with open(filename, 'w', newline='') as file:
     
         
 
-# Initialize arrays to store data
-    x = []
-    y = []
-    
-#y is a 2-D array where each column cooresponds to temperature of channel being measured
-    for l in range(len(channels)):
-        y.append([])
+#Initialize figure, 1 subplot and 1 line per each channel being measured
+    plot = LivePlot(channels, blit = blit_plot)
+    fig = plot.fig
         
+#Start the sampler, it reads the Lakeshore every innerloop_wait seconds on its own thread
+#so a slow redraw never delays a data point. animate() only consumes what it produced.
+    sampler = Sampler(my_instrument, channels, innerloop_wait)
+    samples = sampler.subscribe()
+
+#The CSV is written by its own thread, in batches, so disk latency never delays a reading
+    csv_writer = CSVWriter(file, sampler.subscribe())
+    csv_writer.start()
+    sampler.start()
+
 
+#Store every new sample for plotting (the CSV is written by csv_writer)
+    def record():
+        new_samples = drain(samples)
+        for sample in new_samples:
+            plot.add(sample)
+        return len(new_samples)
 
-#Initialize figure, 1 subplot per each channel being measured
-    fig, axs = plt.subplots(len(channels), 1, sharex = True, figsize=(10,6))
-    plt.style.use('bmh')
- 
 
 
-#animation funtion, each time it is called it takes data + updates figure
+
+#animation funtion, each time it is called it stores new data + updates the lines
     def animate(i):
-        # x is local time, accurate to seconds
-        x.append(dt.datetime.now().strftime('%H:%M:%S')) 
-        
-        csv_input = []
-        csv_input.append(x[i])        
-
-        for k in range(len(channels)):
-            y[k].append(my_instrument.get_kelvin_reading(channels[k]))
-            
-            csv_input.append(y[k][i])
-            
-            axs[k].clear()                #Plot data, make graph look nice
-            axs[k].plot(x, y[k])
-            axs[k].ticklabel_format(style = 'plain', useOffset = False, axis = 'y')
-            axs[k].set_ylabel(str('CH. ' + str(channels[k]) + ' Temp. (K)'))
-        
-        #Write data
-        writer.writerow(csv_input)
-      
-        #Makes graph look nice and neat
-        axs[0].set_title('Lakeshore Temperature VS Time')
-        axs[len(channels) - 1].set_xlabel('Local Time')
-        axs[len(channels) - 1].tick_params(axis = 'x', labelrotation = 50)
-        xticks = ticker.MaxNLocator(20)
-        axs[len(channels) - 1].xaxis.set_major_locator(xticks)
-        plt.subplots_adjust(bottom = 0.15, top = 0.92)
+        record()
+        return plot.draw()
 
 
 
 
 #This function calls the animate function after every interval, as set by the user
-#Interval = time between data points in milliseconds
-    temp_data = FuncAnimation(fig, animate, interval = (innerloop_wait * 1000))
+#Interval = time between plot refreshes in milliseconds
+    temp_data = FuncAnimation(fig, animate, interval = (redraw_wait * 1000), blit = blit_plot,
+                              cache_frame_data = False)
 
 
 #For loop of the actual time loops
@@ -184,6 +168,11 @@ with open(filename, 'w', newline='') as file:
         plt.pause(loop_runtime[j] * 60)      
         print('end loop ', j + 1, '\n')
 
+#Stop acquisition and write out anything still queued before the CSV closes
+    sampler.stop()
+    csv_writer.stop()
+    record()
+    print('Lakeshore read time per sample: ', round(sampler.mean_latency * 1000, 1), 'ms average, ', round(sampler.max_latency * 1000, 1), 'ms max')
 
 print('\n\n\nAll loops complete...')
 
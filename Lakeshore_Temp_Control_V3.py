@@ -3,14 +3,23 @@ Created on September 5th, 2021
 Author: Christopher Cravey
 Lab: Dominique Laroche @ UF
 '''
-from matplotlib import ticker
 import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation
 from lakeshore import Model372
 from lakeshore.model_372 import Model372HeaterOutputSettings, \
 Model372OutputMode, Model372Polarity
+from Lakeshore_Acquisition import AdaptiveRate, ResilientInstrument, Sampler, ScannerScheduler, drain
+from Lakeshore_Autotune import GainTable
+from Lakeshore_Catalog import RunCatalog
+from Lakeshore_Dashboard import DashboardServer
+from Lakeshore_Journal import RunJournal, device_mismatches
+from Lakeshore_Metrics import Metrics, MetricsServer
+from Lakeshore_Plot import LivePlot, SnapshotRenderer
+from Lakeshore_Schedule import ScheduleRunner, load_schedule, steps_from_lists
+from Lakeshore_Settings import SettingsCache
+from Lakeshore_Storage import ColumnarWriter, CSVWriter, RunStats, allocate_run
+from Lakeshore_Simulator import SimulatedModel372
 import csv
-import os
 import datetime as dt
 import time
 start_time = dt.datetime.now()
@@ -22,7 +31,12 @@ start_time = dt.datetime.now()
 ####          after, copy ip_adress from "View IP_Config <Submenu>"
 ####          into my_instrument below.
 '''
-my_instrument = Model372(9600, ip_address = '169.254.25.66')
+SIMULATE = False            #True runs against a simulated Model372 (Lakeshore_Simulator), no fridge needed
+if SIMULATE:
+    my_instrument = SimulatedModel372()
+else:
+    my_instrument = Model372(9600, ip_address = '169.254.25.66')
+my_instrument = ResilientInstrument(my_instrument)    #Shared by the sampler thread and the loop below, reconnects after a link drop
 
 
 
@@ -33,6 +47,28 @@ filename = ''
 
 
 
+#ENTER A STEP FILE (.yaml or .json, see Lakeshore_Schedule for the format)
+#OR
+#LEAVE EMPTY ('') to use the lists in SET PARAMETERS below
+schedule_file = ''
+
+
+
+#ENTER A GAIN TABLE made by Lakeshore_Autotune (e.g. 'Lakeshore Data/gain_table.json') to take
+#P, I, D and heater_range of every CLOSED LOOP step from the band its setpoint is in
+#OR
+#LEAVE EMPTY ('') to use the values given below / in the step file
+gain_table_file = ''
+
+
+
+#TO CONTINUE AN INTERRUPTED RUN, enter its CSV (e.g. 'Lakeshore Data/LakeshoreTemp(10-18-26)_3.csv')
+#The schedule, the step and the time already spent in it come from its journal (see Lakeshore_Journal)
+#LEAVE EMPTY ('') to start a new run
+resume_file = ''
+
+
+
 
 #CHOOSE HEATER TYPE
 #Choose if you want to control heater via PID or manual heater percentages
@@ -46,11 +82,25 @@ OPEN_LOOP          =      False               #Simply turns on heater to a const
 
 channels           =      [6]                 # (MUST BE AN ARRAY) Which lakeshore channels to read 
 innerloop_wait     =      3                   # (MUST BE AN INT) Wait time (seconds) between individual data points
+adaptive_wait      =      None                # e.g. (1, 30) to sample every 1 to 30 s instead: fast after a step starts or while the temperature changes
+redraw_wait        =      3                   # Wait time (seconds) between plot refreshes, data is taken regardless
+blit_plot          =      True                # Only redraw the data lines on each refresh (much faster on long runs)
+USE_SCANNER        =      False               # True if 'channels' go through the scanner, only one is live at a time
+csv_flush_wait     =      10                  # Max time (seconds) rows are kept in memory before being written
+csv_fsync          =      False               # True forces every write onto the disk (survives a power cut)
+columnar_data      =      False               # Also save a binary copy (.bin + .json) that loads much faster than the CSV
+dashboard_port     =      None                # e.g. 8372 to also watch the run at http://127.0.0.1:8372/ (Lakeshore_Dashboard)
+metrics_port       =      None                # e.g. 9372 to serve timing histograms at http://127.0.0.1:9372/metrics (Lakeshore_Metrics)
+catalog_file       =      'Lakeshore Data/catalog.sqlite'   # Run catalog the run is added to (Lakeshore_Catalog), None for no catalog
+snapshot_every     =      None                # e.g. 10 to also update the PNG every 10 minutes during long steps
 
 setpoint           =      [0.010]             # Must be in Kelvin,         only used during CLOSED LOOP 
 setpoint_ramprate  =      [10]                # Kevlin/Min Ramp Rate,      only used during CLOSED LOOP           
 loop_runtime       =      [30]               # Length (Minutes) of each loop
 newloop_wait       =      [5]                 # Wait time (seconds) before taking data from a new loop
+settle_on          =      None                # e.g. {'window': 5, 'slope': 1e-4, 'std': 2e-4} ends a loop early once every
+                                              # channel has settled: over 'window' minutes |slope| <= 'slope' (K/min) and the
+                                              # noise <= 'std' (K); add 'tolerance' (K) to also require being at the setpoint
 
 heater_range       =      [0]       #See dictionary below for values
 '''                                Dictionary of heater_range values...
@@ -81,14 +131,44 @@ manual_output      =      [15]           ; '''manual_output is for OPEN LOOP'''
 assert(isinstance(CLOSED_LOOP_PID, bool)),      "CLOSED_LOOP_PID must be True/False"
 assert(isinstance(OPEN_LOOP, bool)),            "OPEN_LOOP must be True/False"
 assert(CLOSED_LOOP_PID != OPEN_LOOP),           "Either OPEN_LOOP or CLOSED_LOOP must be True"
-if CLOSED_LOOP_PID == True:
-    assert(len(setpoint)==len(setpoint_ramprate)==len(loop_runtime)==len(newloop_wait)==len(P)==len(I)==len(D)==len(heater_range)), \
+#The lists below SET PARAMETERS are only used without a step file or a run to resume
+if len(schedule_file) == 0 and len(resume_file) == 0:
+    if CLOSED_LOOP_PID == True:
+        assert(len(setpoint)==len(setpoint_ramprate)==len(loop_runtime)==len(newloop_wait)==len(P)==len(I)==len(D)==len(heater_range)), \
                                                 "Make sure that (setpoint, loop_runtime, newloop_wait, P, I, D, and heater_range) all are LISTS with equal length"
-else:
-    assert(len(loop_runtime)==len(newloop_wait)==len(manual_output)==len(heater_range)), \
+    else:
+        assert(len(loop_runtime)==len(newloop_wait)==len(manual_output)==len(heater_range)), \
                                                 "Make sure that (setpoint, loop_runtime, newloop_wait, manual_ouput, and heater_range) all are LISTS with equal length"
 assert(isinstance(channels, list) & isinstance(channels[0], int)),             "'channels' variable must be a list containing integer(s)"  
 assert(isinstance(innerloop_wait, int)),        "'innerloop_wait' variable must be an int"
+assert(redraw_wait > 0),         "'redraw_wait' variable must be a positive number of seconds"
+
+
+
+#The run as a list of steps, each ending after its time or once it is stable
+if len(resume_file) > 0:
+    journal = RunJournal.load(resume_file)
+    journal.check_resume(channels, CLOSED_LOOP_PID)        #Same channels and loop mode, not finished yet
+    steps = journal.steps
+    start_step = journal.data['step']
+    start_elapsed = journal.data['step_elapsed']
+    segment = journal.resumed()       #Samples after the restart are marked as a new segment
+    print('Resuming ', resume_file, ' at step ', start_step + 1, ' after ', round(start_elapsed / 60, 1), ' min')
+else:
+    if len(schedule_file) > 0:
+        steps = load_schedule(schedule_file)
+    else:
+        steps = steps_from_lists(CLOSED_LOOP_PID, setpoint, setpoint_ramprate, loop_runtime, newloop_wait,
+                                 P, I, D, heater_range, manual_output, settle = settle_on)
+    if len(gain_table_file) > 0:
+        steps = GainTable.load(gain_table_file).apply(steps)
+        for step in steps:
+            if 'setpoint' in step.settings:
+                print(step.name, ': ', step.settings['setpoint'], 'K uses P: ', step.settings['P'], 'I: ',
+                      step.settings['I'], 'D: ', step.settings['D'], 'heater range: ', step.settings['heater_range'])
+    start_step = 0
+    start_elapsed = 0.0
+    segment = 0
 
 
 
@@ -109,153 +189,193 @@ if OPEN_LOOP == True:
     my_instrument.configure_heater(0, Open_Loop_Settings)
 
 
+#Heater settings go through a cache, so writes that change nothing are skipped
+heater_settings = SettingsCache(my_instrument)
+if len(resume_file) > 0:
+    #Anything changed while the program was down is reported, the runner sets it again
+    for setting, (expected, device) in device_mismatches(journal.data['written'], heater_settings.read_back(),
+                                                         CLOSED_LOOP_PID).items():
+        print('WARNING: ', setting, ' is ', device, ' on the Lakeshore, the journal has ', expected)
+
+
 
 
 
-#Search Lakeshore Data for the same filename and increment if it already exists
-def run_number(filename):
-    run = 1
-    while os.path.exists(filename % run):
-        run += 1
-    return filename % run
 
 
 #If filename = '', the file will automatically be named "LakeshoreTemp" + (Today's Date)_ run number
-if len(filename) == 0:
+if len(resume_file) > 0:
+    filename = resume_file
+    
+elif len(filename) == 0:
     filename = str('Lakeshore Data/LakeshoreTemp(' + start_time.strftime('%m') + '-' +\
                    start_time.strftime('%d') + '-' + start_time.strftime('%y') + ')_%s.csv')
-    filename = run_number(filename)     #add index number to filename
+    filename = allocate_run(filename)     #add the next free run number to filename
     
 else:
     filename = str('Lakeshore Data/' + filename + ('_%s.csv'))
     
-    filename = run_number(filename)     #add index number to filename
+    filename = allocate_run(filename)     #add the next free run number to filename
+
+
 
 
 
 
+#The journal records each step as it starts and ends, so an interrupted run can be resumed
+if len(resume_file) == 0:
+    journal = RunJournal.create(filename, steps, channels, CLOSED_LOOP_PID)
 
+#The run is in the catalog from the start with its schedule, its summary is added when it ends
+catalog = None if catalog_file is None else RunCatalog(catalog_file)
+if catalog is not None:
+    catalog.record_run(filename, 'Lakeshore_Temp_Control_V3', steps = steps, closed_loop = CLOSED_LOOP_PID)
 
-#CREATE CSV TO SAVE DATA:
-with open(filename, 'w', newline='') as file:
+
+
+#CREATE CSV TO SAVE DATA (a resumed run carries on at the end of its CSV):
+with open(filename, 'a' if len(resume_file) > 0 else 'w', newline='') as file:
     writer = csv.writer(file)
     csv_header=['Time:']
     
     for n in range(len(channels)):
         csv_header.append(str('CH. ' + str(str(channels[n]) + ' (K):')))
         
-    writer.writerow(csv_header)
+    if len(resume_file) == 0:
+        writer.writerow(csv_header)
     
         
 
-# Initialize arrays to store data
-    x = []
-    y = []
-    
-#y is a 2-D array where each column cooresponds to temperature of channel being measured
-    for l in range(len(channels)):
-        y.append([])
-        
+#Initialize figure, 1 subplot and 1 line per each channel being measured
+    plot = LivePlot(channels, blit = blit_plot)
+    fig = plot.fig
 
+#The PNG is drawn by another process from a copy of the plotted data, the window and the sampler never wait for it
+    snapshots = SnapshotRenderer(channels)
+    snapshots.start()
+        
+#Start the sampler, it reads the Lakeshore every innerloop_wait seconds on its own thread
+#so a slow redraw never delays a data point. animate() only consumes what it produced.
+#With a scanner, readings follow each channel's pause/dwell time and are flagged fresh/stale
+    scanner = ScannerScheduler(my_instrument, channels) if USE_SCANNER else None
+    metrics = Metrics()             #Timing of reads, writes and redraws, summarized next to the PNG
+    rate = None if adaptive_wait is None else AdaptiveRate(*adaptive_wait)      #See Lakeshore_Acquisition.AdaptiveRate
+    sampler = Sampler(my_instrument, channels, innerloop_wait, scanner = scanner, metrics = metrics, rate = rate)
+    samples = sampler.subscribe()
+
+#The CSV is written by its own thread, in batches, so disk latency never delays a reading
+    run_stats = RunStats(channels)      #Min/max/mean of each channel, for the run catalog
+    csv_writer = CSVWriter(file, sampler.subscribe(), flush_interval = csv_flush_wait, fsync = csv_fsync, metrics = metrics,
+                           stats = run_stats)
+    csv_writer.start()
+
+#Optional binary copy of the data, with the loop index and run parameters (see Lakeshore_Storage.load_columnar)
+    if columnar_data:
+        data_writer = ColumnarWriter(filename[:-4], channels, sampler.subscribe(), segment = segment,
+                                     flush_interval = csv_flush_wait, fsync = csv_fsync, metrics = metrics,
+                                     metadata = {'script': 'Lakeshore_Temp_Control_V3', 'csv': filename,
+                                                 'closed_loop_pid': CLOSED_LOOP_PID,
+                                                 'schedule': [step._asdict() for step in steps]})
+        data_writer.start()
+
+#Optional browser view, any number of viewers share one bounded subscription
+    if dashboard_port is not None:
+        dashboard = DashboardServer(channels, sampler.subscribe(maxsize = 1000), port = dashboard_port)
+        dashboard.start()
+    if metrics_port is not None:
+        metrics_server = MetricsServer(metrics, port = metrics_port)
+        metrics_server.start()
+
+#Steps are run on their own thread as the samples come in, only changed settings are written
+    runner = ScheduleRunner(heater_settings, steps, sampler.subscribe(), channels,
+                            closed_loop = CLOSED_LOOP_PID, sampler = sampler,
+                            start_step = start_step, elapsed = start_elapsed, journal = journal)
+    sampler.start()
+
+
+#Store every new sample for plotting (the CSV is written by csv_writer)
+    def record():
+        new_samples = drain(samples)
+        for sample in new_samples:
+            plot.add(sample)
+        return len(new_samples)
+
+
+
+
+#animation funtion, each time it is called it stores new data + updates the lines
+    def animate(i):
+        with metrics.timer('draw'):
+            record()
+            return plot.draw()
 
-#Initialize figure, 1 subplot per each channel being measured
-    fig, axs = plt.subplots(len(channels), 1, sharex = True, figsize=(10,6))
-    plt.style.use('bmh')
- 
 
 
-#animation funtion, each time it is called it takes data + updates figure
-    def animate(i):
-        # x is local time, accurate to seconds
-        x.append(dt.datetime.now().strftime('%H:%M:%S')) 
-        
-        csv_input = []
-        csv_input.append(x[i])        
 
-        for k in range(len(channels)):
-            y[k].append(my_instrument.get_kelvin_reading(channels[k]))
-            
-            csv_input.append(y[k][i])
-            
-            if len(channels) > 1:
-                axs[k].clear()                #Plot data, make graph look nice
-                axs[k].plot(x, y[k])
-                axs[k].ticklabel_format(style = 'plain', useOffset = False, axis = 'y')
-                axs[k].set_ylabel(str('CH. ' + str(channels[k]) + ' Temp. (K)'))
-            
-            else:
-                axs.clear()                #Plot data, make graph look nice
-                axs.plot(x, y[k])
-                axs.ticklabel_format(style = 'plain', useOffset = False, axis = 'y')
-                axs.set_ylabel(str('CH. ' + str(channels[k]) + ' Temp. (K)'))
-        
-        #Write data
-        writer.writerow(csv_input)
-        file.flush()
-        
-        if len(channels) > 1:
-        #Makes graph look nice and neat
-            axs[0].set_title('Lakeshore Temperature VS Time')
-            axs[len(channels) - 1].set_xlabel('Local Time')
-            axs[len(channels) - 1].tick_params(axis = 'x', labelrotation = 50)
-            xticks = ticker.MaxNLocator(20)
-            axs[len(channels) - 1].xaxis.set_major_locator(xticks)
-            plt.subplots_adjust(bottom = 0.15, top = 0.92)
-        
-        else:
-            axs.set_title('Lakeshore Temperature VS Time')
-            axs.set_xlabel('Local Time')
-            axs.tick_params(axis = 'x', labelrotation = 50)
-            xticks = ticker.MaxNLocator(20)
-            axs.xaxis.set_major_locator(xticks)
-            plt.subplots_adjust(bottom = 0.15, top = 0.92)
-            
+#This function calls the animate function after every interval, as set by the user
+#Interval = time between plot refreshes in milliseconds
+    temp_data = FuncAnimation(fig, animate, interval = (redraw_wait * 1000), blit = blit_plot,
+                              cache_frame_data = False)
 
 
+#SAVE FIGURE, queued for the snapshot process
+    def save_figure():
+        record()
+        snapshots.save(str(filename[:-4] + '.png'), *plot.snapshot())    #replace .csv with .png
 
 
-#This function calls the animate function after every interval, as set by the user
-#Interval = time between data points in milliseconds
-    temp_data = FuncAnimation(fig, animate, interval = (innerloop_wait * 1000))
 
 
-#For loop of the actual time loops
-    for j in range(len(loop_runtime)):
-        print('Setting new param...\n')
-        
-        my_instrument.set_heater_output_range(0, heater_range[j])
-        print("Heater Range set to: ", my_instrument.get_heater_output_range(0))
-        
-        
-        if CLOSED_LOOP_PID == True:
-            my_instrument.set_heater_pid(0, P[j], I[j], D[j])
-            pid = my_instrument.get_heater_pid(0)
-            print("Using CLOSED LOOP PID settings")
-            print("PID set to: ", 'P: ', pid['gain'], 'I: ', pid['integral'], 'D: ', pid['ramp_rate'])
-        
-            my_instrument.set_setpoint_ramp_parameter(0, True, setpoint_ramprate[j])
-            my_instrument.set_setpoint_kelvin(0, setpoint[j])
-            print("Setpoint set to: ", setpoint[j], "K")
-            print("Setpoingt being ramped at a rate of ", setpoint_ramprate[j], "K/min")
-            
-        if OPEN_LOOP == True:
-            my_instrument.set_manual_output(0, manual_output[j])
-            print("Using OPEN LOOP settings")
-            print("Manual output set to: ", my_instrument.get_manual_output(0), " percent")
+#Run the steps, plt.pause() keeps the plot responsive while the runner and sampler work
+    print("Using CLOSED LOOP PID settings" if CLOSED_LOOP_PID else "Using OPEN LOOP settings")
+    runner.start()
+    saved_step = start_step
+    saved_at = time.monotonic()
+    try:
+        while not runner.finished.is_set():
+            plt.pause(1)
             
-        
-      
-        
-        print('Waiting before taking data...')
-        time.sleep(newloop_wait[j])
-    #plt.pause() pauses execution of program while temp_data continues taking data
-        print('Begin loop ', j + 1)
-        plt.pause(loop_runtime[j] * 60)
-        
-    #SAVE FIGURE
-        fig.savefig(str(filename[:-4] + '.png'))    #replace .csv with .png
-        print('end loop ', j + 1, '\n')
-
+        #SAVE FIGURE after every finished step, and every snapshot_every minutes if set
+            if runner.step != saved_step or \
+                    (snapshot_every is not None and time.monotonic() - saved_at >= snapshot_every * 60):
+                save_figure()
+                saved_step = runner.step
+                saved_at = time.monotonic()
+
+#A runner that died (e.g. the journal could not be saved) fails the run instead of completing it,
+#its journal is left unfinished so it can be resumed with resume_file once the cause is fixed
+        if runner.error is not None:
+            raise RuntimeError(str('The schedule stopped on an error, resume it with resume_file = ' +
+                                   repr(filename))) from runner.error
+
+#Stop acquisition, save the PNG and write out anything still queued before the CSV closes,
+#also on Ctrl-C so a resumed run carries on from the last sample
+    finally:
+        runner.stop()
+        sampler.stop()
+        save_figure()           #The final PNG, also for a step cut short by Ctrl-C
+        csv_writer.stop()
+        if columnar_data:
+            data_writer.stop()
+        if dashboard_port is not None:
+            dashboard.stop()
+        if metrics_port is not None:
+            metrics_server.stop()
+        snapshots.stop()        #Waits for the last PNG
+        metrics.write_summary(str(filename[:-4] + '_timing.txt'))
+        if catalog is not None:
+            #A resumed run adds this session's samples to the ones already recorded
+            catalog.record_run(filename, 'Lakeshore_Temp_Control_V3', run_stats, merge = len(resume_file) > 0)
+            catalog.close()
+    record()
+    print('Lakeshore read time per sample: ', round(sampler.mean_latency * 1000, 1), 'ms average, ', round(sampler.max_latency * 1000, 1), 'ms max')
+    if adaptive_wait is not None:
+        print('Samples taken: ', sampler.samples_taken, ' at ', adaptive_wait[0], ' to ', adaptive_wait[1], ' s intervals')
+    if sampler.gaps > 0:
+        print('Gap samples (Lakeshore unreachable): ', sampler.gaps, ', reconnects: ', my_instrument.reconnects)
+    print('Settings written: ', runner.writes, ', unchanged and skipped: ', runner.writes_skipped)
+    for (name, reason, minutes), settle_time in zip(runner.step_ends, runner.time_to_settle):
+        print(name, ' time to settle: ', 'not settled' if settle_time is None else str(round(settle_time, 1)) + ' min')
 
 print('\n\n\nAll loops complete...')
 
@@ -6,15 +6,20 @@ Lab: Dominique Laroche @ UF
 
 """
 
-from matplotlib import ticker
 import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation
 from lakeshore import Model372
-import csv
-import os
+from Lakeshore_Acquisition import AdaptiveRate, ResilientInstrument, Sampler, ScannerScheduler, drain
+from Lakeshore_Catalog import RunCatalog
+from Lakeshore_Dashboard import DashboardServer
+from Lakeshore_Metrics import Metrics, MetricsServer
+from Lakeshore_Plot import LivePlot, SnapshotRenderer
+from Lakeshore_Storage import ColumnarWriter, RotatingCSVWriter, RotatingDeltaWriter, allocate_run, csv_header
+from Lakeshore_Simulator import SimulatedModel372
+import queue
 import sys
-import datetime as dt
 import time
+import datetime as dt
 
 
 #    Locate and initialize Lakeshore Model, must include USB Baude Rate (Typically 9600)
@@ -24,154 +29,199 @@ import time
 ####          after, copy ip_adress from "View IP_Config <Submenu>"
 ####          into my_instrument below.
 '''
-my_instrument = Model372(9600, ip_address = '169.254.110.0')
+SIMULATE = False            #True runs against a simulated Model372 (Lakeshore_Simulator), no fridge needed
+if SIMULATE:
+    my_instrument = SimulatedModel372()
+else:
+    my_instrument = Model372(9600, ip_address = '169.254.110.0')
+my_instrument = ResilientInstrument(my_instrument)   #Reconnects after a link drop
+
+
+
+# SET PARAMETERS
+channels       =      [6]                       # (MUST BE AN ARRAY) Which lakeshore channels to read 
+innerloop_wait =      60                        # (MUST BE AN INT) Wait time (seconds) between individual data points
+adaptive_wait  =      None                      # e.g. (10, 300) to sample every 10 to 300 s instead: faster while the temperature changes (Lakeshore_Acquisition.AdaptiveRate)
+redraw_wait    =      10                        # Wait time (seconds) between plot refreshes, data is taken regardless
+blit_plot      =      True                      # Only redraw the data lines on each refresh (much faster on long runs)
+USE_SCANNER    =      False                     # True if 'channels' go through the scanner, only one is live at a time
+loop_runtime   =      1440                      # Length (Minutes) of each file, the next one carries on without a gap
+rotate_mb      =      None                      # e.g. 50 to also start a new file once one reaches this size (MB)
+csv_flush_wait =      60                        # Max time (seconds) rows are kept in memory before being written
+csv_fsync      =      False                     # True forces every write onto the disk (survives a power cut)
+columnar_data  =      False                     # Also save a binary copy (.bin + .json) that loads much faster than the CSV
+delta_data     =      False                     # Compressed .dlt files instead of CSVs: a reading is only stored once it changes (Lakeshore_Storage.load_delta)
+deadband       =      0                         # With delta_data: change (K) before a channel is stored again, one number or {channel: K}, 0 = lossless
+deadband_wait  =      600                       # With delta_data: store each channel at least this often (seconds), changed or not
+dashboard_port =      None                      # e.g. 8372 to also watch the run at http://127.0.0.1:8372/ (Lakeshore_Dashboard)
+metrics_port   =      None                      # e.g. 9372 to serve timing histograms at http://127.0.0.1:9372/metrics (Lakeshore_Metrics)
+catalog_file   =      'Lakeshore Data/catalog.sqlite'  # Run catalog each finished file is added to (Lakeshore_Catalog), None for no catalog
+snapshot_every =      None                      # e.g. 30 to also update the current file's PNG every 30 minutes
+
+
+
+#Error catching when defining variables
+assert(isinstance(loop_runtime, int)), "'loop_runtime' variabel must be an int"
+assert(isinstance(channels, list)), "'channels' variable must be a list"  
+assert(isinstance(innerloop_wait, int)), "'innerloop_wait' variable must be an int"
+assert(redraw_wait > 0), "'redraw_wait' variable must be a positive number of seconds"
+
+
+
+#ENTER CUSTOM FILENAME
+#OR 
+#LEAVE EMPTY ('') and a name will be generated based on today's date
+filename = ''
+
+
+
+extension = '.dlt' if delta_data else '.csv'
+
+def new_file(timestamp):
+    #Name of the file starting at 'timestamp'. If left empty the file will automatically be
+    #named "ReadOnly_LakeshoreTemp" + (Date of its first sample)_ run number
+    if len(filename) == 0:
+        start_time = dt.datetime.fromtimestamp(timestamp)
+        pattern = str('Lakeshore Data/ReadOnly_LakeshoreTemp(' + start_time.strftime('%m') + '-' +\
+                      start_time.strftime('%d') + '-' + start_time.strftime('%y') + ')_%s' + extension)
+    else:
+        pattern = str('Lakeshore Data/' + filename + '_%s' + extension)
+    return allocate_run(pattern)     #add the next free run number to filename
+
+
+
+#The sampler and the CSV writer run for the whole program. The writer starts the next file
+#itself, between two consecutive samples, so nothing stops or is lost at a new file.
+#With a scanner, readings follow each channel's pause/dwell time and are flagged fresh/stale
+scanner = ScannerScheduler(my_instrument, channels) if USE_SCANNER else None
+metrics = Metrics()             #Timing of reads, writes and redraws, summarized next to each file
+rate = None if adaptive_wait is None else AdaptiveRate(*adaptive_wait)
+sampler = Sampler(my_instrument, channels, innerloop_wait, scanner = scanner, metrics = metrics, rate = rate)
+samples = sampler.subscribe()
+csv_samples = sampler.subscribe()
+data_samples = sampler.subscribe() if columnar_data else None
+if dashboard_port is not None:
+    dashboard = DashboardServer(channels, sampler.subscribe(maxsize = 1000), port = dashboard_port)
+    dashboard.start()     #Any number of browser viewers share this one bounded subscription
+if metrics_port is not None:
+    MetricsServer(metrics, port = metrics_port).start()
+
+
+
+#Finished files are reported by the writer thread with a summary of their samples (RunStats),
+#the PNG is saved and the file added to the run catalog from the loop below
+catalog = None if catalog_file is None else RunCatalog(catalog_file)
+finished_files = queue.Queue()
+if delta_data:
+    #Same files, rotation and reports, only the format differs (see Lakeshore_Storage.RotatingDeltaWriter)
+    csv_writer = RotatingDeltaWriter(new_file, channels, csv_samples, deadband = deadband, max_interval = deadband_wait,
+                                     rotate_minutes = loop_runtime,
+                                     rotate_bytes = None if rotate_mb is None else rotate_mb * 1e6,
+                                     on_rotate = lambda *finished: finished_files.put(finished),
+                                     flush_interval = csv_flush_wait, fsync = csv_fsync, metrics = metrics,
+                                     metadata = {'script': 'READ_ONLY_Lakeshore_Temp_V2'})
+else:
+    csv_writer = RotatingCSVWriter(new_file, csv_header(channels), csv_samples,
+                                   rotate_minutes = loop_runtime,
+                                   rotate_bytes = None if rotate_mb is None else rotate_mb * 1e6,
+                                   on_rotate = lambda *finished: finished_files.put(finished), channels = channels,
+                                   flush_interval = csv_flush_wait, fsync = csv_fsync, metrics = metrics)
+csv_writer.start()
+
+#Optional binary copy of the data (see Lakeshore_Storage.load_columnar), one file for the whole program
+if columnar_data:
+    data_writer = ColumnarWriter(csv_writer.filename[:-4], channels, data_samples,
+                                 flush_interval = csv_flush_wait, fsync = csv_fsync, metrics = metrics,
+                                 metadata = {'script': 'READ_ONLY_Lakeshore_Temp_V2', 'csv': csv_writer.filename})
+    data_writer.start()
 
+
+
+#Initialize figure, 1 subplot and 1 line per each channel being measured
+plot = LivePlot(channels, '(READ ONLY) Temp vs Time', title_color = 'red', blit = blit_plot)
+fig = plot.fig
+
+#PNGs are drawn by another process from a copy of the plotted data, the window and the data never wait for them
+snapshots = SnapshotRenderer(channels, '(READ ONLY) Temp vs Time', title_color = 'red')
+snapshots.start()
+
+#Store every new sample for plotting (the CSV is written by csv_writer)
+def record():
+    new_samples = drain(samples)
+    for sample in new_samples:
+        plot.add(sample)
+    return len(new_samples)
+
+
+
+#animation funtion, each time it is called it stores new data + updates the lines
+def animate(i):
+    with metrics.timer('draw'):
+        record()
+        return plot.draw()
+
+
+
+def save_file(finished, stats):
+    #SAVE FIGURE of one finished file, only its own time span
+    record()
+    if stats.started is not None:
+        times, values = plot.snapshot(stats.started, stats.ended)
+        snapshots.save(str(finished[:-4] + '.png'), times, values)    #replace .csv with .png
+    metrics.write_summary(str(finished[:-4] + '_timing.txt'))
+    if catalog is not None:
+        catalog.record_run(finished, 'READ_ONLY_Lakeshore_Temp_V2', stats)
+
+    print("\n\n" + finished + " has been saved.")
+    print('Lakeshore read time per sample: ', round(sampler.mean_latency * 1000, 1), 'ms average, ', round(sampler.max_latency * 1000, 1), 'ms max')
+    if adaptive_wait is not None:
+        print('Samples in the file: ', stats.samples, ', current interval: ', round(sampler.interval, 1), 's')
+    if sampler.gaps > 0:
+        print('Gap samples (Lakeshore unreachable): ', sampler.gaps, ', reconnects: ', my_instrument.reconnects)
+
+
+
+def save_current():
+    #PNG of the file still being written, from its first sample up to now
+    current, stats = csv_writer.filename, csv_writer.stats
+    if stats.started is not None:
+        record()
+        snapshots.save(str(current[:-4] + '.png'), *plot.snapshot(stats.started))
+
+
+
+sampler.start()
+
+#This function calls the animate function after every interval, as set by the user
+#Interval = time between plot refreshes in milliseconds
+temp_data = FuncAnimation(fig, animate, interval = (redraw_wait * 1000), blit = blit_plot,
+                          cache_frame_data = False)
+
+print("Begin Measurements\nTaking data once every " +
+      (str(innerloop_wait) if adaptive_wait is None else str(adaptive_wait[0]) + " to " + str(adaptive_wait[1])) +
+      " seconds, saving to " + csv_writer.filename)
 try:
+    #plt.pause() keeps the window responsive, temp_data takes care of the plot
+    saved_at = time.monotonic()
     while True == True:
-        start_time = dt.datetime.now()
-        #ENTER CUSTOM FILENAME
-        #OR 
-        #LEAVE EMPTY ('') and a name will be generated based on today's date
-        filename = ''
-        
-        
-        
-        
-        # SET PARAMETERS
-        channels       =      [6]                       # (MUST BE AN ARRAY) Which lakeshore channels to read 
-        innerloop_wait =      60                        # (MUST BE AN INT) Wait time (seconds) between individual data points
-        loop_runtime   =      1440                      # Length (Minutes) of run
-        
-         
-        
-        #Error catching when defining variables
-        assert(isinstance(loop_runtime, int)), "'loop_runtime' variabel must be an int"
-        assert(isinstance(channels, list)), "'channels' variable must be a list"  
-        assert(isinstance(innerloop_wait, int)), "'innerloop_wait' variable must be an int"
-        
-        
-        
-        #Search Lakeshore Data for the same filename and increment if it already exists
-        def run_number(filename):
-            run = 1
-            while os.path.exists(filename % run):
-                run += 1
-            return filename % run
-        
-        #If left empty the file will automatically be named "LakeshoreTemp" + (Today's Date)_ run number
-        if len(filename) == 0:
-            filename = str('Lakeshore Data/ReadOnly_LakeshoreTemp(' + start_time.strftime('%m') + '-' +\
-                           start_time.strftime('%d') + '-' + start_time.strftime('%y') + ')_%s.csv')
-            filename = run_number(filename)     #add index number to filename
-            
-        else:
-            filename = str('Lakeshore Data/' + filename + ('_%s.csv'))
-            
-            filename = run_number(filename)     #add index number to filename
-        
-    
-    
-    
-    
-        
-        #CREATE CSV TO SAVE DATA:
-        with open(filename, 'w', newline='') as file:
-            writer = csv.writer(file)
-            csv_header=['Time:']
-            
-            for n in range(len(channels)):
-                csv_header.append(str('CH. ' + str(str(channels[n]) + ' (K):')))
-                
-            writer.writerow(csv_header)
-            
-                
-        
-        # Initialize arrays to store data
-            x = []
-            y = []
-            
-        #y is a 2-D array where each column cooresponds to temperature of channel being measured
-            for l in range(len(channels)):
-                y.append([])
-                
-        
-        
-        #Initialize figure, 1 subplot per each channel being measured
-            fig, axs = plt.subplots(len(channels), 1, sharex = True, figsize=(10,6))
-            plt.style.use('bmh')
-         
-        
-        
-        #animation funtion, each time it is called it takes data + updates figure
-            def animate(i):
-                # x is local time, accurate to seconds
-                x.append(dt.datetime.now().strftime('%H:%M:%S')) 
-                
-                csv_input = []
-                csv_input.append(x[i])        
-        
-                for k in range(len(channels)):
-                    y[k].append(my_instrument.get_kelvin_reading(channels[k]))
-                    
-                    csv_input.append(y[k][i])
-                    
-                    if len(channels) > 1:
-                        axs[k].clear()                #Plot data, make graph look nice
-                        axs[k].plot(x, y[k])
-                        axs[k].ticklabel_format(style = 'plain', useOffset = False, axis = 'y')
-                        axs[k].set_ylabel(str('CH. ' + str(channels[k]) + ' Temp. (K)'))
-                    
-                    else:
-                        axs.clear()                #Plot data, make graph look nice
-                        axs.plot(x, y[k])
-                        axs.ticklabel_format(style = 'plain', useOffset = False, axis = 'y')
-                        axs.set_ylabel(str('CH. ' + str(channels[k]) + ' Temp. (K)'))
-                
-                #Write data
-                writer.writerow(csv_input)
-                file.flush()
-                
-                if len(channels) > 1:
-                #Makes graph look nice and neat
-                    axs[0].set_title('(READ ONLY) Temp vs Time', color = 'red')
-                    axs[len(channels) - 1].set_xlabel('Local Time')
-                    axs[len(channels) - 1].tick_params(axis = 'x', labelrotation = 50)
-                    xticks = ticker.MaxNLocator(20)
-                    axs[len(channels) - 1].xaxis.set_major_locator(xticks)
-                    plt.subplots_adjust(bottom = 0.15, top = 0.92)
-                
-                else:
-                    axs.set_title('(READ ONLY) Temp vs Time', color = 'red')
-                    axs.set_xlabel('Local Time')
-                    axs.tick_params(axis = 'x', labelrotation = 50)
-                    xticks = ticker.MaxNLocator(20)
-                    axs.xaxis.set_major_locator(xticks)
-                    plt.subplots_adjust(bottom = 0.15, top = 0.92)
-                    
-        
-        
-        
-        
-            #This function calls the animate function after every interval, as set by the user
-            #Interval = time between data points in milliseconds
-            time.sleep(10)
-            temp_data = FuncAnimation(fig, animate, interval = (innerloop_wait * 1000))
-        
-        
-            #plt.pause() pauses execution of program while temp_data continues taking data
-            print("Begin Measurements\nTaking data once every " + str(innerloop_wait) + " seconds.")
-            plt.pause(loop_runtime * 60)
-            
-        
-        
-        #SAVE FIGURE
-        fig.savefig(str(filename[:-4] + '.png'))    #replace .csv with .png
-        plt.close()
-        
-        
-        
-        print("\n\nPlot has been saved, beginning new read only plot.")
+        plt.pause(1)
+        for finished in drain(finished_files):
+            save_file(*finished)
+        if snapshot_every is not None and time.monotonic() - saved_at >= snapshot_every * 60:
+            save_current()
+            saved_at = time.monotonic()
 
 except KeyboardInterrupt:
     print("Program halted")
-    sys.exit(0)
+
+finally:
+    sampler.stop()
+    csv_writer.stop()       #Write out everything queued before the file is closed
+    if columnar_data:
+        data_writer.stop()
+    for finished in drain(finished_files):
+        save_file(*finished)
+    save_file(csv_writer.filename, csv_writer.stats)
+    snapshots.stop()
+
+sys.exit(0)
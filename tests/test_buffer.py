@@ -0,0 +1,45 @@
+import numpy as np
+from Lakeshore_Buffer import History, MinMaxHistory
+
+
+def test_falling_data_is_drawn_falling():
+    #A cooldown must not show as a sawtooth, also after bins have been merged
+    history = MinMaxHistory(2, capacity = 8, samples_per_bin = 4)
+    for t in range(100):
+        history.append(float(t), [100.0 - t, float(t)])
+    times, values = history.data()
+    assert history.samples_per_bin > 4
+    assert np.all(np.diff(times) >= 0)
+    assert np.all(np.diff(values[:, 0]) <= 0)
+    assert np.all(np.diff(values[:, 1]) >= 0)
+    assert values[0, 0] == 100.0 and values[0, 1] == 0.0
+
+
+def test_gap_does_not_blank_bins():
+    history = MinMaxHistory(1, capacity = 8, samples_per_bin = 2)
+    for t in range(64):
+        history.append(float(t), [float('nan') if t == 5 else float(t)])
+    times, values = history.data()
+    assert not np.any(np.isnan(values))
+    assert values.min() == 0.0 and values.max() == 63.0
+
+
+def test_history_meets_window():
+    #Every sample is either in a bin or in the window, never both and never neither
+    history = History(1, window = 50, history_bins = 20)
+    for t in range(10000):
+        history.append(float(t), [float(10000 - t)])
+    times, values = history.data()
+    assert np.all(np.diff(times) >= 0)
+    assert np.all(np.diff(values[:, 0]) <= 0)
+    assert times[0] == 0.0 and times[-1] == 9999.0
+    assert np.sum(times == 9950.0) == 1            #First sample of the window, drawn once
+    assert times[-51] == 9949.0                    #The last bin ends right before it
+
+
+def test_window_only_until_full():
+    history = History(1, window = 10, history_bins = 4)
+    for t in range(10):
+        history.append(float(t), [float(t)])
+    times, values = history.data()
+    assert list(times) == list(range(10))
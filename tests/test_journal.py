@@ -0,0 +1,67 @@
+import pytest
+from Lakeshore_Acquisition import LockedInstrument, Sampler
+from Lakeshore_Journal import RunJournal
+from Lakeshore_Schedule import ScheduleRunner, make_steps
+from Lakeshore_Simulator import SimulatedModel372
+
+STEPS = make_steps([{'heater_range': 5, 'P': 60, 'I': 30, 'D': 6, 'ramp_rate': 10, 'setpoint': 0.010, 'duration': 0.005},
+                    {'setpoint': 0.012, 'duration': 0.02},
+                    {'setpoint': 0.014, 'duration': 0.005}])
+
+
+def start(journal, start_step = 0, elapsed = 0.0):
+    instrument = LockedInstrument(SimulatedModel372(seed = 0))
+    sampler = Sampler(instrument, [6], 0.02)
+    runner = ScheduleRunner(instrument, journal.steps, sampler.subscribe(), [6], sampler = sampler,
+                            start_step = start_step, elapsed = elapsed, journal = journal, progress_interval = 0.1)
+    sampler.start()
+    runner.start()
+    return sampler, runner
+
+
+def stop(sampler, runner):
+    runner.stop()
+    sampler.stop()
+    assert runner.error is None
+
+
+def test_resume_interrupted_run(tmp_path):
+    csv = str(tmp_path / 'LakeshoreTemp_1.csv')
+    journal = RunJournal.create(csv, STEPS, [6], True)
+    sampler, runner = start(journal)
+    while runner.step < 1:
+        assert not runner.finished.wait(0.05)
+    assert not runner.finished.wait(0.5)            #Interrupted part way through step 2
+    stop(sampler, runner)
+
+    journal = RunJournal.load(csv)
+    journal.check_resume([6], True)
+    assert not journal.finished
+    assert journal.data['step'] == 1 and len(journal.data['completed']) == 1
+    assert 0.3 < journal.data['step_elapsed'] < 1.2
+    assert journal.data['written']['setpoint'] == 0.012
+    assert journal.resumed() == 1 and RunJournal.load(csv).data['segment'] == 1
+
+    sampler, runner = start(journal, journal.data['step'], journal.data['step_elapsed'])
+    assert runner.finished.wait(30)
+    stop(sampler, runner)
+    #Step 2 only ran what was left of it
+    assert [name for name, reason, minutes in runner.step_ends] == ['Step 2', 'Step 3']
+    assert runner.step_ends[0][2] == pytest.approx(0.02, abs = 0.01)
+    journal = RunJournal.load(csv)
+    assert journal.finished and len(journal.data['completed']) == 3
+    with pytest.raises(AssertionError):
+        journal.check_resume([6], True)
+
+
+def test_resume_refuses_other_channels_or_mode(tmp_path):
+    csv = str(tmp_path / 'LakeshoreTemp_1.csv')
+    RunJournal.create(csv, STEPS, [6, 1], True)
+    journal = RunJournal.load(csv)
+    journal.check_resume([6, 1], True)
+    with pytest.raises(AssertionError, match = 'channels'):
+        journal.check_resume([6], True)
+    with pytest.raises(AssertionError, match = 'channels'):
+        journal.check_resume([1, 6], True)
+    with pytest.raises(AssertionError, match = 'OPEN_LOOP'):
+        journal.check_resume([6, 1], False)
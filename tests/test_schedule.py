@@ -0,0 +1,69 @@
+import numpy as np
+from Lakeshore_Acquisition import LockedInstrument, Sample, Sampler
+from Lakeshore_Schedule import ScheduleRunner, SettlingDetector, make_steps
+from Lakeshore_Simulator import SimulatedModel372
+
+PID = {'heater_range': 5, 'P': 60, 'I': 30, 'D': 6, 'ramp_rate': 10}
+
+
+def run_steps(steps, channels = [6], timeout = 30, **kwargs):
+    #Runs 'steps' against a simulated Model372, returns the finished runner
+    instrument = LockedInstrument(SimulatedModel372(seed = 0))
+    sampler = Sampler(instrument, channels, 0.02)
+    runner = ScheduleRunner(instrument, steps, sampler.subscribe(), channels, sampler = sampler, **kwargs)
+    sampler.start()
+    runner.start()
+    try:
+        assert runner.finished.wait(timeout)
+    finally:
+        runner.stop()
+        sampler.stop()
+    assert runner.error is None
+    return runner
+
+
+def test_settling_detector():
+    rng = np.random.default_rng(0)
+    detector = SettlingDetector(window = 10, max_slope = 1e-3, max_std = 1e-3)
+    assert not detector.update(0.0, float('nan'))
+    results = [detector.update(float(t), 1.0 + 1e-4 * rng.standard_normal()) for t in range(1, 30)]
+    assert not results[0] and results[-1]
+    assert detector.settled.is_set() and detector.time_to_settle == 10.0
+
+    ramp = SettlingDetector(window = 10, max_slope = 1e-3, max_std = 1e-3)
+    assert not any(ramp.update(float(t), 0.01 * t) for t in range(30))
+
+
+def test_stability_ignores_nan_and_stale():
+    #Held scanner values and NaN readings must never make a step 'stable'
+    steps = make_steps([{'heater_range': 0, 'manual_output': 0, 'stable': {'within': 1e-3, 'for': 10 / 60}}])
+    runner = ScheduleRunner(SimulatedModel372(), steps, None, [6, 1], closed_loop = False)
+    runner.begin(0, 0.0)
+    for t in range(15):
+        assert runner.step_done(t, Sample(t, t, [5.0, float(t)], None, None, 0.0, [False, True], 0)) is None
+    runner.begin(0, 100.0)
+    for t in range(100, 115):
+        reading = float('nan') if t == 100 else float(t)
+        assert runner.step_done(t, Sample(t, t, [reading, 0.0], None, None, 0.0, None, 0)) is None
+    for t in range(115, 140):
+        reason = runner.step_done(t, Sample(t, t, [5.0, 0.0], None, None, 0.0, None, 0))
+    assert reason == 'stable'
+
+
+def test_steps_end_after_duration():
+    steps = make_steps([dict(PID, setpoint = 0.010, duration = 0.01), {'setpoint': 0.012, 'duration': 0.01}])
+    runner = run_steps(steps)
+    assert [(name, reason) for name, reason, minutes in runner.step_ends] == \
+        [('Step 1', 'duration'), ('Step 2', 'duration')]
+    assert all(0.01 <= minutes < 0.05 for name, reason, minutes in runner.step_ends)
+    assert runner.writes > 0
+
+
+def test_steps_end_when_stable_or_settled():
+    #At base temperature with the heater off the readings only carry the simulator's noise
+    steps = make_steps([{'heater_range': 0, 'manual_output': 0, 'duration': 5,
+                         'stable': {'within': 1e-5, 'for': 0.01}},
+                        {'duration': 5, 'settle': {'window': 0.01, 'slope': 1e-3, 'std': 1e-5}}])
+    runner = run_steps(steps, closed_loop = False)
+    assert [reason for name, reason, minutes in runner.step_ends] == ['stable', 'settled']
+    assert runner.time_to_settle[1] is not None
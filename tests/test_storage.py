@@ -0,0 +1,71 @@
+import os
+import queue
+import numpy as np
+from Lakeshore_Acquisition import Sample, gap_sample
+from Lakeshore_Storage import RotatingDeltaWriter, load_delta
+
+START = 1.7e9
+
+
+def samples(n, rng, gaps = ()):
+    readings = np.c_[0.01 + 1e-6 * rng.standard_normal(n), np.full(n, 4.0)]
+    items = []
+    for k in range(n):
+        if k in gaps:
+            items.append(gap_sample(2, START + k, k, 0.0, k // 100))
+        else:
+            items.append(Sample(START + k, k, list(readings[k]), 12.5, 0.01, 0.0, None, k // 100))
+    return readings, items
+
+
+def write(tmp_path, items, **kwargs):
+    #Runs a RotatingDeltaWriter over 'items', returns the files it made in order
+    q = queue.Queue()
+    for item in items:
+        q.put(item)
+    names = []
+
+    def new_file(timestamp):
+        names.append(str(tmp_path / str('run_' + str(len(names) + 1) + '.dlt')))
+        return names[-1]
+
+    writer = RotatingDeltaWriter(new_file, [6, 'A'], q, flush_rows = 100, **kwargs)
+    writer.start()
+    writer.stop()
+    return names
+
+
+def load_all(names):
+    loaded = [load_delta(name) for name in names]
+    return np.concatenate([records for records, metadata in loaded]), loaded[0][1]
+
+
+def test_round_trip_with_gaps_and_rotation(tmp_path):
+    gaps = set(range(500, 520)) | {1234}
+    readings, items = samples(3000, np.random.default_rng(0), gaps)
+    names = write(tmp_path, items, rotate_minutes = 10)      #A new file every 600 samples
+    assert len(names) == 5
+
+    records, metadata = load_all(names)
+    assert metadata['channels'] == ['6', 'A']
+    assert len(records) == 3000
+    assert np.allclose(records['time'], START + np.arange(3000), rtol = 0, atol = 1e-3)
+    missing = np.isnan(records['ch6'])
+    assert set(np.flatnonzero(missing)) == gaps
+    assert np.abs(records['ch6'][~missing] - readings[~missing, 0]).max() <= 1e-9
+    assert np.all(records['chA'][~missing] == 4.0)
+    assert np.all(records['loop'][~missing] == (np.arange(3000) // 100)[~missing])
+    assert np.all(records['setpoint'][~missing] == 0.01)
+
+
+def test_deadband_holds_readings(tmp_path):
+    readings, items = samples(2000, np.random.default_rng(1))
+    os.mkdir(tmp_path / 'lossless')
+    os.mkdir(tmp_path / 'deadband')
+    lossless = write(tmp_path / 'lossless', items)
+    held = write(tmp_path / 'deadband', items, deadband = 3e-6, max_interval = 60)
+
+    records, metadata = load_all(held)
+    assert len(records) == 2000
+    assert np.abs(records['ch6'] - readings[:, 0]).max() <= 3e-6 + 1e-9
+    assert sum(os.path.getsize(name) for name in held) < sum(os.path.getsize(name) for name in lossless) / 2